@@ -12,6 +12,22 @@ from core.controller.relval_controller import RelValController
 relval_controller = RelValController()
 
 
+def output_script(api, script_hash, build_script):
+    """
+    Return 304 Not Modified if client already has the script with given hash
+    Otherwise build the script and return it with the hash as an ETag
+    """
+    if script_hash in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = api.output_text(build_script(), content_type='text/plain')
+
+    response.set_etag(script_hash)
+    # Make clients revalidate every time instead of using a stale copy
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 class CreateRelValAPI(APIBase):
     """
     Endpoint for creating relval
@@ -33,6 +49,33 @@ class CreateRelValAPI(APIBase):
         return self.output_text({'response': obj.get_json(), 'success': True, 'message': ''})
 
 
+class ValidateRelValsAPI(APIBase):
+    """
+    Endpoint for validating one or multiple relvals without creating them
+    """
+
+    def __init__(self):
+        APIBase.__init__(self)
+
+    @APIBase.ensure_request_data
+    @APIBase.exceptions_to_errors
+    @APIBase.ensure_role('manager')
+    def post(self):
+        """
+        Validate a single RelVal dict or a list of RelVal dicts, return a list of errors for each
+        """
+        data = flask.request.data
+        relval_json = json.loads(data.decode('utf-8'))
+        if isinstance(relval_json, dict):
+            results = relval_controller.validate([relval_json])[0]
+        elif isinstance(relval_json, list):
+            results = relval_controller.validate(relval_json)
+        else:
+            raise ValueError('Expected a single RelVal dict or a list of RelVal dicts')
+
+        return self.output_text({'response': results, 'success': True, 'message': ''})
+
+
 class DeleteRelValAPI(APIBase):
     """
     Endpoint for deleting one or multiple relvals
@@ -104,7 +147,7 @@ class GetRelValAPI(APIBase):
         """
         Get a single with given prepid
         """
-        obj = relval_controller.get(prepid)
+        obj = relval_controller.get_read_only(prepid)
         return self.output_text({'response': obj.get_json(), 'success': True, 'message': ''})
 
 
@@ -125,12 +168,12 @@ class GetEditableRelValAPI(APIBase):
             prepid = clean_split(prepid, ',')
             if len(prepid) == 1:
                 # Return one object if there is only one prepid
-                relval = relval_controller.get(prepid[0])
+                relval = relval_controller.get_read_only(prepid[0])
                 editing_info = relval_controller.get_editing_info(relval)
                 relval = relval.get_json()
             else:
                 # Return a list if there are multiple prepids
-                relval = [relval_controller.get(p) for p in prepid]
+                relval = [relval_controller.get_read_only(p) for p in prepid]
                 editing_info = [relval_controller.get_editing_info(r) for r in relval]
                 relval = [r.get_json() for r in relval]
 
@@ -158,10 +201,12 @@ class GetCMSDriverAPI(APIBase):
         """
         Get a text file with RelVal's cmsDriver.py commands
         """
-        relval = relval_controller.get(prepid)
+        relval = relval_controller.get_read_only(prepid)
         for_submission = flask.request.args.get('submission', '').lower() == 'true'
-        commands = relval_controller.get_cmsdriver(relval, for_submission)
-        return self.output_text(commands, content_type='text/plain')
+        script_hash = relval_controller.get_script_hash(relval, 'cmsdriver', for_submission)
+        return output_script(self,
+                             script_hash,
+                             lambda: relval_controller.get_cmsdriver(relval, for_submission))
 
 
 class GetConfigUploadAPI(APIBase):
@@ -177,9 +222,11 @@ class GetConfigUploadAPI(APIBase):
         """
         Get a text file with relval's cmsDriver.py commands
         """
-        relval = relval_controller.get(prepid)
-        commands = relval_controller.get_config_upload_file(relval)
-        return self.output_text(commands, content_type='text/plain')
+        relval = relval_controller.get_read_only(prepid)
+        script_hash = relval_controller.get_script_hash(relval, 'config_upload')
+        return output_script(self,
+                             script_hash,
+                             lambda: relval_controller.get_config_upload_file(relval))
 
 
 class GetRelValJobDictAPI(APIBase):
@@ -195,13 +242,96 @@ class GetRelValJobDictAPI(APIBase):
         """
         Get a text file with ReqMgr2's dictionary
         """
-        relval = relval_controller.get(prepid)
+        relval = relval_controller.get_read_only(prepid)
         dict_string = json.dumps(relval_controller.get_job_dict(relval),
                                  indent=2,
                                  sort_keys=True)
         return self.output_text(dict_string, content_type='text/plain')
 
 
+class GetRelValJobDictsAPI(APIBase):
+    """
+    Endpoint for getting dictionaries with job information for ReqMgr2 of multiple RelVals
+    Response is newline delimited JSON - one line per RelVal
+    """
+
+    max_limit = 1000
+
+    def __init__(self):
+        APIBase.__init__(self)
+
+    def stream_job_dicts(self, query_string, limit, page=0):
+        """
+        Return a response that streams job dicts as newline delimited JSON
+        If page is full, there might be more results and X-Next-Page header
+        has number of the next page
+        """
+        if not query_string:
+            raise ValueError('Expected a query or a list of prepids')
+
+        if limit < 1 or limit > self.max_limit:
+            raise ValueError(f'Limit must be between 1 and {self.max_limit}, got {limit}')
+
+        if page < 0:
+            raise ValueError(f'Page must not be negative, got {page}')
+
+        count, job_dicts = relval_controller.get_job_dicts(query_string, limit, page)
+
+        def generate():
+            for prepid, job_dict, error in job_dicts:
+                if error:
+                    line = {'prepid': prepid, 'success': False, 'message': error}
+                else:
+                    line = {'prepid': prepid, 'success': True, 'job_dict': job_dict}
+
+                yield json.dumps(line, sort_keys=True) + '\n'
+
+        response = flask.Response(flask.stream_with_context(generate()),
+                                  mimetype='application/x-ndjson')
+        if count >= limit:
+            response.headers['X-Next-Page'] = str(page + 1)
+
+        return response
+
+    @APIBase.exceptions_to_errors
+    def get(self):
+        """
+        Get ReqMgr2's dictionaries of RelVals that match the query, e.g. ?prepid=a,b,c
+        At most limit (up to 1000) RelVals are returned, others can be fetched
+        with page parameter, X-Next-Page header is set if page is full
+        """
+        args = flask.request.args.to_dict()
+        limit = int(args.pop('limit', self.max_limit))
+        page = int(args.pop('page', 0))
+        query_string = '&&'.join([f'{key}={value}' for key, value in args.items()])
+        return self.stream_job_dicts(query_string, limit, page)
+
+    @APIBase.ensure_request_data
+    @APIBase.exceptions_to_errors
+    def post(self):
+        """
+        Get ReqMgr2's dictionaries of RelVals with prepids in the provided JSON list
+        Up to 1000 prepids can be requested at once
+        """
+        data = flask.request.data
+        prepids = json.loads(data.decode('utf-8'))
+        if not isinstance(prepids, list):
+            raise ValueError('Expected a list of prepids')
+
+        prepids = [p.get('prepid', '') if isinstance(p, dict) else p for p in prepids]
+        invalid_prepids = [p for p in prepids if not isinstance(p, str)]
+        if invalid_prepids:
+            raise ValueError(f'Expected prepids to be strings, got {invalid_prepids[:5]}')
+
+        prepids = [p.strip() for p in prepids if p.strip()]
+        if len(prepids) > self.max_limit:
+            raise ValueError(f'At most {self.max_limit} prepids can be requested at once, '
+                             f'got {len(prepids)}')
+
+        query_string = f'prepid={",".join(prepids)}' if prepids else ''
+        return self.stream_job_dicts(query_string, max(len(prepids), 1))
+
+
 class GetDefaultRelValStepAPI(APIBase):
     """
     Endpoint for getting a default (empty) step that could be used as a template
@@ -280,12 +410,13 @@ class RelValPreviousStatus(APIBase):
             results = relval_controller.previous_status(relval)
             results = results.get_json()
         elif isinstance(relval_json, list):
-            results = []
+            relvals = []
             for single_relval_json in relval_json:
                 prepid = single_relval_json.get('prepid')
                 relval = relval_controller.get(prepid)
-                results.append(relval_controller.previous_status(relval))
+                relvals.append(relval)
 
+            results = relval_controller.previous_statuses(relvals)
             results = [x.get_json() for x in results]
         else:
             raise ValueError('Expected a single RelVals dict or a list of RelVals dicts')
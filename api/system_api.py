@@ -1,13 +1,21 @@
 """
 Module that contains all system APIs
 """
+import re
 import time
+import json
 import os.path
+import flask
 from core_lib.api.api_base import APIBase
 from core_lib.utils.locker import Locker
 from core_lib.database.database import Database
 from core_lib.utils.user_info import UserInfo
 from core.utils.submitter import RequestSubmitter
+from core.utils.cache import TTLCache
+from core.utils.ssh_pool import SSHPool
+from core.utils.voms_proxy import VOMSProxy
+from core.utils.notifier import Notifier
+from core.utils.timing import LatencyTracker
 
 
 class SubmissionWorkerStatusAPI(APIBase):
@@ -22,8 +30,15 @@ class SubmissionWorkerStatusAPI(APIBase):
     def get(self):
         """
         Get status of all request submission workers
+        If timings=true is given, also return latency statistics of submission
+        stages and their steps
         """
         status = RequestSubmitter().get_worker_status()
+        if flask.request.args.get('timings', '').lower() == 'true':
+            status = {'workers': status,
+                      'timings': {**LatencyTracker.get_all_stats('stage.'),
+                                  **LatencyTracker.get_all_stats('submission.')}}
+
         return self.output_text({'response': status, 'success': True, 'message': ''})
 
 
@@ -38,7 +53,7 @@ class SubmissionQueueAPI(APIBase):
     @APIBase.exceptions_to_errors
     def get(self):
         """
-        Get status of all request submission workers
+        Get prepids of RelVals waiting in the persistent submission queue
         """
         status = RequestSubmitter().get_names_in_queue()
         return self.output_text({'response': status, 'success': True, 'message': ''})
@@ -221,3 +236,72 @@ class UptimeInfoAPI(APIBase):
                                               'seconds': seconds},
                                  'success': True,
                                  'message': ''})
+
+
+class MetricsAPI(APIBase):
+    """
+    Endpoint for getting internal performance metrics, such as cache statistics
+    """
+
+    def __init__(self):
+        APIBase.__init__(self)
+
+    @APIBase.exceptions_to_errors
+    def get(self):
+        """
+        Get hit/miss counters and sizes of all caches, SSH connection pool usage,
+        VOMS proxy age and renewals, notification queue and latencies of timed operations
+        If format=prometheus is given, return numeric values in Prometheus text format
+        """
+        metrics = {'caches': TTLCache.get_all_stats(),
+                   'ssh_pool': SSHPool().get_stats(),
+                   'voms_proxy': VOMSProxy().get_stats(),
+                   'notifications': Notifier().get_stats(),
+                   'timings': LatencyTracker.get_all_stats()}
+        if flask.request.args.get('format', '').lower() == 'prometheus':
+            lines = [f'{name} {value}' for name, value in self.flatten('relval', metrics)]
+            return self.output_text('\n'.join(lines) + '\n', content_type='text/plain')
+
+        return self.output_text({'response': metrics, 'success': True, 'message': ''})
+
+    def flatten(self, prefix, value):
+        """
+        Return (metric name, value) pairs of all numeric values in nested dictionary
+        """
+        if isinstance(value, dict):
+            pairs = []
+            for key, nested_value in value.items():
+                name = re.sub('[^a-zA-Z0-9_]', '_', f'{prefix}_{key}')
+                pairs.extend(self.flatten(name, nested_value))
+
+            return pairs
+
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return []
+
+        return [(prefix, value)]
+
+
+class InvalidateCacheAPI(APIBase):
+    """
+    Endpoint for removing entries from an in-memory cache
+    """
+
+    def __init__(self):
+        APIBase.__init__(self)
+
+    @APIBase.ensure_request_data
+    @APIBase.exceptions_to_errors
+    @APIBase.ensure_role('administrator')
+    def post(self):
+        """
+        Remove a key or, if key is not given, all entries from a cache with given name
+        """
+        data = json.loads(flask.request.data.decode('utf-8'))
+        name = data.get('name')
+        cache = TTLCache.get_cache(name)
+        if cache is None:
+            raise ValueError(f'Cache "{name}" does not exist')
+
+        cache.invalidate(data.get('key'))
+        return self.output_text({'response': cache.get_stats(), 'success': True, 'message': ''})
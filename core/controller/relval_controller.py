@@ -3,22 +3,21 @@ Module that contains RelValController class
 """
 import json
 import time
+import hashlib
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import DuplicateKeyError
 from environment import (
     REMOTE_PATH,
-    REMOTE_SSH_NODE,
-    REMOTE_SSH_PASSWORD,
-    REMOTE_SSH_USERNAME,
     CMSWEB_URL,
     DEVELOPMENT,
 )
 from core_lib.database.database import Database
 from core_lib.controller.controller_base import ControllerBase
-from core_lib.utils.ssh_executor import SSHExecutor
 from core_lib.utils.common_utils import (
     clean_split,
     cmsweb_reject_workflows,
     config_cache_lite_setup,
-    dbs_datasetlist,
     get_hash,
     get_workflows_from_stats,
     get_workflows_from_stats_for_prepid,
@@ -26,6 +25,10 @@ from core_lib.utils.common_utils import (
     run_commands_in_cmsenv,
 )
 from core.utils.submitter import RequestSubmitter
+from core.utils.cache import TTLCache
+from core.utils.ssh_pool import SSHPool
+from core.utils.dbs import get_access_types, invalidate_dbs_cache
+from core.utils.document_updates import save_changes, bulk_save_changes, set_next_version
 from core.model.ticket import Ticket
 from core.model.relval import RelVal
 from core.model.relval_step import RelValStep
@@ -41,11 +44,15 @@ DEAD_WORKFLOW_STATUS = {
     "aborted-completed",
 }
 
+# Rendered bash scripts by hash of RelVal attributes that they depend on
+script_cache = TTLCache("scripts", ttl=3600, max_size=5000)
+
 
 class RelValController(ControllerBase):
     """
     RelVal controller performs all actions with RelVal objects
     """
+    # pylint: disable=too-many-public-methods
 
     def __init__(self):
         ControllerBase.__init__(self)
@@ -53,32 +60,100 @@ class RelValController(ControllerBase):
         self.model_class = RelVal
 
     def create(self, json_data):
-        cmssw_release = json_data.get("cmssw_release").split("/")[-1]
-        batch_name = json_data.get("batch_name")
+        """
+        Create a new RelVal from given dictionary, RelVal is built without
+        setter checks and validated once with the compiled validators
+        """
+        relval = self.model_class(json_data, False)
+        # Prepid is generated when RelVal is saved
+        relval.set("prepid", "TempRelValObject-00000")
+        errors = self.validate([relval])[0]
+        if errors:
+            raise AssertionError(f'Invalid RelVal: {", ".join(errors)}')
+
+        return self.create_validated(relval)
+
+    def create_validated(self, relval):
+        """
+        Create a new RelVal from an object that was already validated, object
+        is saved as it is, without building or checking it again
+        """
+        cmssw_release = relval.get("cmssw_release").split("/")[-1]
+        batch_name = relval.get("batch_name")
         # Use workflow name for prepid if possible, if not - first step name
-        if json_data.get("workflow_name"):
-            workflow_name = json_data["workflow_name"]
-        else:
-            first_step = RelValStep(json_input=json_data.get("steps")[0])
-            workflow_name = first_step.get_short_name()
-            json_data["workflow_name"] = workflow_name
+        workflow_name = relval.get("workflow_name")
+        if not workflow_name:
+            workflow_name = relval.get("steps")[0].get_short_name()
+            relval.set("workflow_name", workflow_name)
 
         prepid_part = f"{cmssw_release}__{batch_name}-{workflow_name}".strip("-_")
-        json_data["prepid"] = f"{prepid_part}-00000"
-        relval_db = Database("relvals")
+        relval_db = Database(self.database_name)
         with self.locker.get_lock(f"generate-relval-prepid-{prepid_part}"):
             # Get a new serial number
             serial_number = self.get_highest_serial_number(
                 relval_db, f"{prepid_part}-*"
             )
             serial_number += 1
-            # Form a new temporary prepid
             prepid = f"{prepid_part}-{serial_number:05d}"
-            json_data["prepid"] = prepid
-            relval = super().create(json_data)
-
+            relval.set("prepid", prepid)
+            relval.set("_id", prepid)
+            relval.add_history("create", prepid, None)
+            try:
+                relval_db.collection.insert_one(relval.get_json())
+            except DuplicateKeyError as ex:
+                raise AssertionError(f'Object with prepid "{prepid}" already exists') from ex
+
+        relval.clear_changes()
         return relval
 
+    def validate(self, relvals):
+        """
+        Validate multiple RelVals or RelVal dictionaries, return a list of lists
+        of errors
+        Validation functions are built once per model class and run on all
+        RelVals and steps, RelVal objects are validated as they are, only
+        dictionaries are built into objects to get defaults and structural checks
+        """
+        relval_validator = self.model_class.get_validator()
+        step_validator = RelValStep.get_validator()
+        results = []
+        for relval in relvals:
+            if not isinstance(relval, self.model_class):
+                try:
+                    relval = self.model_class(relval, False)
+                except Exception as ex:  # pylint: disable=broad-exception-caught
+                    results.append([str(ex)])
+                    continue
+
+            relval_json = relval.get_json()
+
+            errors = relval_validator(relval_json)
+            for index, step_json in enumerate(relval_json["steps"]):
+                errors.extend(f"Step {index + 1}: {error}" for error in step_validator(step_json))
+
+            results.append(errors)
+
+        return results
+
+    def get_read_only(self, prepid):
+        """
+        Return a RelVal that wraps the stored document without copying or
+        validating it. Steps are built only when accessed and values are copied
+        only if they are changed, so this is meant for read-only use
+        """
+        relval_json = Database(self.database_name).get(prepid)
+        if not relval_json:
+            raise AssertionError(f'Object "{prepid}" does not exist')
+
+        return self.model_class(json_input=relval_json, read_only=True)
+
+    def before_update(self, old_obj, new_obj, changed_values):
+        """
+        Bump version of the document, fail if it was changed in the meantime
+        """
+        # pylint: disable=unused-argument
+        set_next_version(old_obj, new_obj)
+
     def after_update(self, old_obj, new_obj, changed_values):
         self.logger.info("Changed values: %s", changed_values)
         if "workflow_name" in changed_values:
@@ -88,7 +163,7 @@ class RelValController(ControllerBase):
             new_relval.set("history", old_obj.get("history"))
             new_relval.add_history("rename", [old_prepid, new_prepid], None)
             relvals_db = Database("relvals")
-            relvals_db.save(new_relval.get_json())
+            save_changes(relvals_db, new_relval)
             self.logger.info("Created %s as rename of %s", new_prepid, old_prepid)
             new_obj.set("prepid", new_prepid)
             # Update the ticket...
@@ -107,7 +182,7 @@ class RelValController(ControllerBase):
                     created_relvals.append(new_prepid)
                     ticket.set("created_relvals", created_relvals)
                     ticket.add_history("rename", [old_prepid, new_prepid], None)
-                    tickets_db.save(ticket.get_json())
+                    save_changes(tickets_db, ticket)
 
             self.delete(old_obj.get_json())
 
@@ -135,6 +210,7 @@ class RelValController(ControllerBase):
         editing_info["workflow_id"] = False
         editing_info["workflow_name"] = is_new
         editing_info["steps"] = is_new
+        editing_info["submission_stage"] = False
         editing_info["execute_steps"] = True
 
         return editing_info
@@ -155,36 +231,94 @@ class RelValController(ControllerBase):
 
                 ticket.set("created_relvals", created_relvals)
                 ticket.add_history("remove_relval", prepid, None)
-                tickets_db.save(ticket.get_json())
+                save_changes(tickets_db, ticket)
 
-    def get_cmsdriver(self, relval, for_submission=False):
+    def get_script_hash(self, relval, script_type, for_submission=False):
+        """
+        Return a hash of RelVal attributes that given bash script depends on
+        Same hash means same script, so it can be used as a cache key and as an ETag
+        """
+        attributes = {
+            key: relval.get(key)
+            for key in (
+                "prepid",
+                "cmssw_release",
+                "scram_arch",
+                "cpu_cores",
+                "fragment",
+                "execute_steps",
+            )
+        }
+        # Use steps with default values, so stored and freshly built RelVals match
+        attributes["steps"] = [step.get_json() for step in relval.get("steps")]
+        key = json.dumps([script_type, for_submission, attributes], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_cached_script(self, relval, script_type, for_submission, build_script):
+        """
+        Return bash script from the cache or build and cache it
+        """
+        script_hash = self.get_script_hash(relval, script_type, for_submission)
+        script = script_cache.get(script_hash)
+        if script is None:
+            script = build_script()
+            script_cache.set(script_hash, script)
+
+        return script
+
+    def get_cmsdriver(self, relval, for_submission=False, skip_configs=None):
         """
         Get bash script with cmsDriver commands for a given RelVal
         If script will be used for submission, replace input file with placeholder
+        Steps whose config file names are in skip configs are left out
+        """
+        if skip_configs:
+            return relval.get_cmsdrivers(for_submission, skip_configs)
+
+        return self.get_cached_script(
+            relval,
+            "cmsdriver",
+            for_submission,
+            lambda: self.build_cmsdriver(relval, for_submission),
+        )
+
+    def build_cmsdriver(self, relval, for_submission=False):
+        """
+        Build bash script with cmsDriver commands for a given RelVal
         """
         self.logger.debug("Getting cmsDriver commands for %s", relval.get_prepid())
         return relval.get_cmsdrivers(for_submission)
 
-    def get_config_upload_file(self, relval):
+    def get_config_upload_file(self, relval, skip_configs=None):
         """
         Get bash script that would upload config files to ReqMgr2
+        Configs whose names are in skip configs are left out
+        """
+        if skip_configs:
+            return self.build_config_upload_file(relval, skip_configs)
+
+        return self.get_cached_script(
+            relval,
+            "config_upload",
+            False,
+            lambda: self.build_config_upload_file(relval),
+        )
+
+    def build_config_upload_file(self, relval, skip_configs=None):
+        """
+        Build bash script that would upload config files to ReqMgr2
         """
         self.logger.debug("Getting config upload script for %s", relval.get_prepid())
-        database_url = CMSWEB_URL.replace("https://", "").replace("http://", "")
         bash = ["#!/bin/bash", ""]
 
-        steps = relval.get("steps")
+        skip_configs = skip_configs or set()
+        steps = [
+            step
+            for step in relval.get("steps")
+            if step.get_config_file_name() not in skip_configs
+        ]
         # Check if all expected config files are present
-        for step in steps:
-            config_name = step.get_config_file_name()
-            if config_name:
-                bash += [
-                    f'if [ ! -s "{config_name}.py" ]; then',
-                    f'  echo "File {config_name}.py is missing" >&2',
-                    "  exit 1",
-                    "fi",
-                    "",
-                ]
+        bash += self.get_config_file_checks(steps)
 
         # Use ConfigCacheLite and TweakMakerLite instead of WMCore
         bash += config_cache_lite_setup().split("\n")
@@ -214,17 +348,7 @@ class RelValController(ControllerBase):
                 ).split("\n")
                 commands = []
 
-            commands.append(
-                (
-                    "$PYTHON_INT config_uploader.py "
-                    f"--file $(pwd)/{config_name}.py "
-                    f"--label {config_name} "
-                    "--group ppd "
-                    "--user $(echo $USER) "
-                    f"--db {database_url} || exit $?"
-                )
-            )
-
+            commands.append(self.get_config_upload_command(config_name))
             previous_cmssw = step_cmssw
             previous_scram = scram_arch
 
@@ -236,6 +360,226 @@ class RelValController(ControllerBase):
 
         return "\n".join(bash)
 
+    def get_config_file_checks(self, steps):
+        """
+        Return bash lines that fail if any of expected config files is missing
+        """
+        bash = []
+        for step in steps:
+            config_name = step.get_config_file_name()
+            if config_name:
+                bash += [
+                    f'if [ ! -s "{config_name}.py" ]; then',
+                    f'  echo "File {config_name}.py is missing" >&2',
+                    "  exit 1",
+                    "fi",
+                    "",
+                ]
+
+        return bash
+
+    def get_config_upload_command(self, config_name, uploader="config_uploader.py"):
+        """
+        Return command that uploads a single config file to ReqMgr2
+        """
+        database_url = CMSWEB_URL.replace("https://", "").replace("http://", "")
+        return (
+            f"$PYTHON_INT {uploader} "
+            f"--file $(pwd)/{config_name}.py "
+            f"--label {config_name} "
+            "--group ppd "
+            "--user $(echo $USER) "
+            f"--db {database_url} || exit $?"
+        )
+
+    def get_config_group(self, relval):
+        """
+        Return (CMSSW release, scram arch) if all configs of the RelVal can be
+        generated in one shared environment together with other RelVals
+        Return None if RelVal has to be handled on its own
+        """
+        if relval.get("fragment"):
+            # Fragment is built into the release area, it cannot be shared
+            return None
+
+        environments = relval.get_cmsdriver_commands(for_submission=True)
+        if len(environments) != 1:
+            return None
+
+        cmssw, scram_arch, _ = environments[0]
+        return cmssw, scram_arch
+
+    def wrap_group_commands(self, prepid, commands):
+        """
+        Run commands of a single RelVal in its own directory and subshell and
+        surround the output with markers, so it can be split by prepid
+        """
+        return (
+            [f'echo "=== {prepid} start ==="', "(", f"cd {prepid} || exit $?"]
+            + commands
+            + [") 2>&1", f'echo "=== {prepid} exit code $? ==="', ""]
+        )
+
+    def split_group_output(self, output):
+        """
+        Split output of a group script to a dictionary of prepid -> (exit code, output)
+        Exit code is None if RelVal did not finish
+        """
+        results = {}
+        prepid = None
+        lines = []
+        for line in output.split("\n"):
+            if prepid is None:
+                if line.startswith("=== ") and line.endswith(" start ==="):
+                    prepid = line[4:-10]
+                    lines = []
+
+                continue
+
+            if line == f"=== {prepid} start ===":
+                continue
+
+            if line.startswith(f"=== {prepid} exit code ") and line.endswith(" ==="):
+                exit_code = line[len(f"=== {prepid} exit code ") : -4]
+                results[prepid] = (int(exit_code), "\n".join(lines))
+                prepid = None
+                continue
+
+            lines.append(line)
+
+        if prepid is not None:
+            results[prepid] = (None, "\n".join(lines))
+
+        return results
+
+    def get_group_cmsdriver(self, relvals, skip_configs=None):
+        """
+        Get bash script that generates configs of multiple RelVals with the same
+        config group in one environment, each RelVal in its own directory
+        Skip configs is a dictionary of prepid -> config file names to leave out
+        """
+        skip_configs = skip_configs or {}
+        cmssw, scram_arch = self.get_config_group(relvals[0])
+        self.logger.debug(
+            "Getting cmsDriver commands for %s RelVals in %s %s",
+            len(relvals),
+            cmssw,
+            scram_arch,
+        )
+        bash = ["#!/bin/bash", ""]
+        commands = []
+        for relval in relvals:
+            prepid = relval.get_prepid()
+            if self.get_config_group(relval) != (cmssw, scram_arch):
+                raise AssertionError(f"{prepid} does not belong to {cmssw} {scram_arch} group")
+
+            _, _, relval_commands = relval.get_cmsdriver_commands(
+                True, skip_configs.get(prepid)
+            )[0]
+            commands += [f"mkdir -p {prepid}"]
+            commands += self.wrap_group_commands(prepid, relval_commands)
+
+        bash += run_commands_in_cmsenv(commands, cmssw, scram_arch).split("\n")
+        return "\n".join(bash)
+
+    def get_group_config_upload_file(self, relvals, skip_configs=None):
+        """
+        Get bash script that uploads configs of multiple RelVals with the same
+        config group to ReqMgr2 in one environment
+        Skip configs is a dictionary of prepid -> config file names to leave out
+        """
+        skip_configs = skip_configs or {}
+        cmssw, scram_arch = self.get_config_group(relvals[0])
+        bash = ["#!/bin/bash", ""]
+        # Use ConfigCacheLite and TweakMakerLite instead of WMCore
+        bash += config_cache_lite_setup().split("\n")
+        bash += [""]
+        commands = []
+        for relval in relvals:
+            relval_skip_configs = skip_configs.get(relval.get_prepid(), set())
+            steps = [
+                step
+                for step in relval.get("steps")
+                if step.get_config_file_name() not in relval_skip_configs
+            ]
+            relval_commands = self.get_config_file_checks(steps)
+            for step in steps:
+                config_name = step.get_config_file_name()
+                if config_name:
+                    relval_commands.append(
+                        self.get_config_upload_command(config_name, "../config_uploader.py")
+                    )
+
+            commands += self.wrap_group_commands(relval.get_prepid(), relval_commands)
+
+        bash += run_commands_in_cmsenv(commands, cmssw, scram_arch).split("\n")
+        return "\n".join(bash)
+
+    def get_known_config_ids(self, relvals):
+        """
+        Return a dictionary of prepid -> {config file name: config id} of configs
+        that were already uploaded with the same config key
+        If RelVal executes steps, configs are reused only if all of them are known,
+        because steps depend on output of previous steps
+        """
+        keys = {relval.get_prepid(): relval.get_config_keys() for relval in relvals}
+        all_keys = list({key for relval_keys in keys.values() for key in relval_keys.values()})
+        if not all_keys:
+            return {}
+
+        config_ids_db = Database("config_ids")
+        known = {
+            entry["_id"]: entry["config_id"]
+            for entry in config_ids_db.collection.find({"_id": {"$in": all_keys}})
+        }
+        result = {}
+        for relval in relvals:
+            prepid = relval.get_prepid()
+            relval_known = {
+                config_name: known[key]
+                for config_name, key in keys[prepid].items()
+                if key in known
+            }
+            if relval.get("execute_steps") and len(relval_known) < len(keys[prepid]):
+                relval_known = {}
+
+            if relval_known:
+                self.logger.info(
+                    "Reusing %s/%s configs of %s",
+                    len(relval_known),
+                    len(keys[prepid]),
+                    prepid,
+                )
+                result[prepid] = relval_known
+
+        return result
+
+    def save_config_ids(self, relval):
+        """
+        Record config key -> config id of all uploaded configs of the RelVal
+        """
+        config_ids = {
+            step.get_config_file_name(): step.get("config_id")
+            for step in relval.get("steps")
+            if step.get_config_file_name() and step.get("config_id")
+        }
+        config_ids_db = Database("config_ids")
+        now = int(time.time())
+        for config_name, key in relval.get_config_keys().items():
+            if config_name not in config_ids:
+                continue
+
+            config_ids_db.collection.replace_one(
+                {"_id": key},
+                {
+                    "_id": key,
+                    "config_id": config_ids[config_name],
+                    "prepid": relval.get_prepid(),
+                    "created": now,
+                },
+                upsert=True,
+            )
+
     def get_task_dict(self, relval, step, step_index):
         # pylint: disable=too-many-statements
         """
@@ -280,7 +624,7 @@ class RelValController(ControllerBase):
 
             else:
                 task_dict["InputTask"] = input_step.get_short_name()
-                _, input_module = step.get_input_eventcontent(input_step)
+                _, input_module = step.get_input_eventcontent()
                 task_dict["InputFromOutputModule"] = f"{input_module}output"
 
             if step.get("lumis_per_job") != "":
@@ -448,6 +792,31 @@ class RelValController(ControllerBase):
 
         return job_dict
 
+    def get_job_dicts(self, query_string, limit, page=0):
+        """
+        Return number of RelVals in given page of the query results and a
+        generator of (prepid, job dict, error message) for these RelVals.
+        All documents are fetched in a single database query, wrapped as
+        read-only RelVals and job dicts are compiled lazily. RelVals that fail
+        to compile are yielded with an error message instead of a job dict
+        """
+        relval_db = Database(self.database_name)
+        query_string = relval_db.build_query_with_types(query_string, self.model_class)
+        relval_jsons = relval_db.query(query_string, page=page, limit=limit)
+        self.logger.info("Compiling %s job dicts for %s", len(relval_jsons), query_string)
+
+        def compile_job_dicts():
+            for relval_json in relval_jsons:
+                prepid = relval_json.get("prepid")
+                try:
+                    relval = self.model_class(json_input=relval_json, read_only=True)
+                    yield prepid, self.get_job_dict(relval), None
+                except Exception as ex:  # pylint: disable=broad-exception-caught
+                    self.logger.error("Error compiling job dict for %s: %s", prepid, ex)
+                    yield prepid, None, str(ex)
+
+        return len(relval_jsons), compile_job_dicts()
+
     def apply_job_dict_overwrite(self, job_dict, overwrite):
         """
         Apply overwrites to job dictionary
@@ -478,30 +847,69 @@ class RelValController(ControllerBase):
         self.logger.debug(
             "Resolve auto conditions of:\n%s", json.dumps(conditions_tree, indent=2)
         )
-        remote_directory = REMOTE_PATH.rstrip("/")
-        resolve_command = []
+        # autoCond of a release never changes, so resolved values are kept in database
+        globaltags_db = Database("auto_globaltags")
+        entry_ids = {}
         for cmssw_version, scram_tree in conditions_tree.items():
             for scram_arch, conditions in scram_tree.items():
-                conditions_str = ",".join(list(conditions.keys()))
-                resolve_command += run_commands_in_cmsenv(
-                    [
-                        "$PYTHON_INT resolve_auto_global_tag.py "
-                        f'"{cmssw_version}" '
-                        f'"{scram_arch}" '
-                        f'"{conditions_str}" || exit $?'
-                    ],
-                    cmssw_version,
-                    scram_arch,
-                ).split("\n")
+                for condition in conditions:
+                    entry_id = f"{cmssw_version}__{scram_arch}__{condition}"
+                    entry_ids[entry_id] = (cmssw_version, scram_arch, condition)
+
+        cached_entries = globaltags_db.collection.find({"_id": {"$in": list(entry_ids)}})
+        for entry in cached_entries:
+            cmssw_version, scram_arch, condition = entry_ids[entry["_id"]]
+            conditions_tree[cmssw_version][scram_arch][condition] = entry["globaltag"]
+
+        missing_tree = {}
+        missing_count = 0
+        for cmssw_version, scram_arch, condition in entry_ids.values():
+            if not conditions_tree[cmssw_version][scram_arch][condition]:
+                missing_tree.setdefault(cmssw_version, {}).setdefault(scram_arch, {})[
+                    condition
+                ] = None
+                missing_count += 1
 
         self.logger.debug(
-            "Resolve auto conditions command:\n%s", "\n".join(resolve_command)
+            "Auto conditions found in cache: %s, missing: %s",
+            len(entry_ids) - missing_count,
+            missing_count,
         )
-        with SSHExecutor(
-            host=REMOTE_SSH_NODE,
-            username=REMOTE_SSH_USERNAME,
-            password=REMOTE_SSH_PASSWORD,
-        ) as ssh_executor:
+        if not missing_tree:
+            return
+
+        try:
+            self.resolve_auto_conditions_remotely(missing_tree)
+        finally:
+            # Keep whatever was resolved, even if some releases failed
+            for cmssw_version, scram_tree in missing_tree.items():
+                for scram_arch, conditions in scram_tree.items():
+                    for condition, resolved in conditions.items():
+                        if not resolved:
+                            continue
+
+                        conditions_tree[cmssw_version][scram_arch][condition] = resolved
+                        entry = {
+                            "_id": f"{cmssw_version}__{scram_arch}__{condition}",
+                            "cmssw_release": cmssw_version,
+                            "scram_arch": scram_arch,
+                            "conditions": condition,
+                            "globaltag": resolved,
+                            "created": int(time.time()),
+                        }
+                        globaltags_db.collection.replace_one(
+                            {"_id": entry["_id"]}, entry, upsert=True
+                        )
+
+    def resolve_auto_conditions_remotely(self, conditions_tree):
+        """
+        Resolve global tags of given conditions tree on a remote machine
+        Conditions tree has the same structure as in resolve_auto_conditions
+        Each release and scram arch is resolved concurrently over its own connection,
+        resolved values are put in the tree even if some other release fails
+        """
+        remote_directory = REMOTE_PATH.rstrip("/")
+        with SSHPool().connection() as ssh_executor:
             # Upload python script to resolve auto globaltag by upload script
             stdout, stderr, exit_code = ssh_executor.execute_command(
                 f"mkdir -p {remote_directory}"
@@ -519,40 +927,98 @@ class RelValController(ControllerBase):
                 "./core/utils/resolve_auto_global_tag.py",
                 f"{remote_directory}/resolve_auto_global_tag.py",
             )
-            script_name = f"resolve_{get_hash(resolve_command)}.sh"
+
+        releases = [
+            (cmssw_version, scram_arch, list(conditions.keys()))
+            for cmssw_version, scram_tree in conditions_tree.items()
+            for scram_arch, conditions in scram_tree.items()
+        ]
+        errors = []
+        max_workers = min(len(releases), SSHPool.max_size)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(self.resolve_release_auto_conditions, *release)
+                for release in releases
+            ]
+            for (cmssw_version, scram_arch, _), future in zip(releases, futures):
+                try:
+                    resolved = future.result()
+                except Exception as ex:  # pylint: disable=broad-exception-caught
+                    errors.append(f"{cmssw_version} ({scram_arch}): {ex}")
+                    continue
+
+                conditions_tree[cmssw_version][scram_arch].update(resolved)
+
+        if errors:
+            raise RuntimeError(f'Error resolving auto globaltags: {"; ".join(errors)}')
+
+    def resolve_release_auto_conditions(self, cmssw_version, scram_arch, conditions):
+        """
+        Resolve auto conditions of single release and scram arch on a remote machine
+        Return a dictionary of conditions and resolved global tags
+        """
+        start_time = time.time()
+        remote_directory = REMOTE_PATH.rstrip("/")
+        conditions_str = ",".join(conditions)
+        resolve_command = run_commands_in_cmsenv(
+            [
+                "$PYTHON_INT resolve_auto_global_tag.py "
+                f'"{cmssw_version}" '
+                f'"{scram_arch}" '
+                f'"{conditions_str}" || exit $?'
+            ],
+            cmssw_version,
+            scram_arch,
+        ).split("\n")
+        self.logger.debug(
+            "Resolve auto conditions command:\n%s", "\n".join(resolve_command)
+        )
+        script_name = f"resolve_{get_hash(resolve_command)}.sh"
+        command = [
+            f"cd {remote_directory}",
+            f"chmod +x {script_name}",
+            f"./{script_name}",
+            f"rm {script_name}",
+        ]
+        with SSHPool().connection() as ssh_executor:
             ssh_executor.upload_as_file(
                 "\n".join(resolve_command), f"{remote_directory}/{script_name}"
             )
-            command = [
-                f"cd {remote_directory}",
-                f"chmod +x {script_name}",
-                f"./{script_name}",
-                f"rm {script_name}",
-            ]
             stdout, stderr, exit_code = ssh_executor.execute_command(command)
-            if exit_code != 0:
-                self.logger.error(
-                    "Error resolving auto global tags:\nstdout:%s\nstderr:%s",
-                    stdout,
-                    stderr,
-                )
-                raise RuntimeError(f"Error resolving auto globaltags: {stderr}")
 
+        if exit_code != 0:
+            self.logger.error(
+                "Error resolving auto global tags of %s (%s):\nstdout:%s\nstderr:%s",
+                cmssw_version,
+                scram_arch,
+                stdout,
+                stderr,
+            )
+            raise RuntimeError(stderr)
+
+        resolved_conditions = {}
         tags = [x for x in clean_split(stdout, "\n") if x.startswith("GlobalTag:")]
         for resolved_tag in tags:
             split_resolved_tag = clean_split(resolved_tag, " ")
-            cmssw_version = split_resolved_tag[1]
-            scram_arch = split_resolved_tag[2]
-            conditions = split_resolved_tag[3]
+            condition = split_resolved_tag[3]
             resolved = split_resolved_tag[4]
             self.logger.debug(
                 "Resolved %s to %s in %s (%s)",
-                conditions,
+                condition,
                 resolved,
                 cmssw_version,
                 scram_arch,
             )
-            conditions_tree[cmssw_version][scram_arch][conditions] = resolved
+            resolved_conditions[condition] = resolved
+
+        self.logger.info(
+            "Resolved %s auto conditions of %s (%s) in %.2fs",
+            len(resolved_conditions),
+            cmssw_version,
+            scram_arch,
+            time.time() - start_time,
+        )
+        return resolved_conditions
 
     def get_default_step(self):
         """
@@ -569,9 +1035,48 @@ class RelValController(ControllerBase):
         relval_db = Database(self.database_name)
         relval.set("status", status)
         relval.add_history("status", status, None, timestamp)
-        relval_db.save(relval.get_json())
+        save_changes(relval_db, relval)
         self.logger.info('Set "%s" status to "%s"', relval.get_prepid(), status)
 
+    def update_statuses(self, changes, other_relvals=()):
+        """
+        Set new statuses to many RelVals, update their history accordingly and
+        save only changed attributes to database with a single bulk write
+        Changes is a list of (relval, status, timestamp) tuples, changes of
+        other RelVals that do not change status are saved in the same write
+        Return a dictionary of prepids and errors of RelVals that were not saved
+        """
+        relval_db = Database(self.database_name)
+        for relval, status, timestamp in changes:
+            relval.set("status", status)
+            relval.add_history("status", status, None, timestamp)
+
+        errors = bulk_save_changes(
+            relval_db, [change[0] for change in changes] + list(other_relvals)
+        )
+        for relval, status, _ in changes:
+            prepid = relval.get_prepid()
+            if prepid not in errors:
+                self.logger.info('Set "%s" status to "%s"', prepid, status)
+
+        return errors
+
+    def raise_errors(self, errors):
+        """
+        Raise an AssertionError with errors of all RelVals that failed in a
+        bulk operation, error of a single RelVal is raised as it is
+        """
+        if not errors:
+            return
+
+        if len(errors) == 1:
+            raise AssertionError(next(iter(errors.values())))
+
+        messages = [f"{prepid}: {error}" for prepid, error in sorted(errors.items())]
+        raise AssertionError(
+            f"{len(errors)} RelVals failed:\n" + "\n".join(messages)
+        )
+
     def next_status(self, relvals):
         """
         Trigger list of RelVals to move to next status
@@ -614,6 +1119,35 @@ class RelValController(ControllerBase):
 
         return results
 
+    def previous_statuses(self, relvals):
+        """
+        Trigger list of RelVals to move to previous status
+        Approved RelVals are moved back to new together, other RelVals one by one
+        Errors of all RelVals that could not be moved are raised afterwards
+        """
+        results = []
+        changes = []
+        errors = {}
+        with ExitStack() as stack:
+            for relval in relvals:
+                prepid = relval.get_prepid()
+                try:
+                    if relval.get("status") == "approved":
+                        stack.enter_context(self.locker.get_nonblocking_lock(prepid))
+                        changes.append(self.get_back_to_new_change(relval))
+                    else:
+                        results.append(self.previous_status(relval))
+                except Exception as ex:
+                    errors[prepid] = str(ex)
+
+            errors.update(self.update_statuses(changes))
+
+        self.raise_errors(errors)
+        results += [relval for relval, _, _ in changes]
+        # Keep the original order of RelVals
+        results = {relval.get_prepid(): relval for relval in results}
+        return [results[relval.get_prepid()] for relval in relvals]
+
     def previous_status(self, relval):
         """
         Trigger RelVal to move to previous status
@@ -688,35 +1222,41 @@ class RelValController(ControllerBase):
                         )
 
         conditions_tree = self.get_resolved_conditions(relvals)
-        results = []
-        # Go through relvals and set resolved globaltags from the updated dict
-        for relval in relvals:
-            prepid = relval.get_prepid()
-            with self.locker.get_nonblocking_lock(prepid):
-                for step in relval.get("steps"):
-                    if step.get_step_type() != "cms_driver":
-                        # Collect only driver steps that have conditions
-                        continue
-
-                    conditions = step.get("driver")["conditions"]
-                    if conditions.startswith("auto:"):
-                        cmssw = step.get_release()
-                        scram = step.get_scram_arch()
-                        resolved_conditions = conditions_tree[cmssw][scram][conditions]
-                        step.set("resolved_globaltag", resolved_conditions)
-                    else:
-                        step.set("resolved_globaltag", conditions)
-
-                self.update_status(relval, "approved")
-                results.append(relval)
-
-        return results
+        changes = []
+        errors = {}
+        with ExitStack() as stack:
+            # Go through relvals and set resolved globaltags from the updated dict
+            for relval in relvals:
+                prepid = relval.get_prepid()
+                try:
+                    stack.enter_context(self.locker.get_nonblocking_lock(prepid))
+                    for step in relval.get("steps"):
+                        if step.get_step_type() != "cms_driver":
+                            # Collect only driver steps that have conditions
+                            continue
+
+                        conditions = step.get("driver")["conditions"]
+                        if conditions.startswith("auto:"):
+                            cmssw = step.get_release()
+                            scram = step.get_scram_arch()
+                            resolved_conditions = conditions_tree[cmssw][scram][conditions]
+                            step.set("resolved_globaltag", resolved_conditions)
+                        else:
+                            step.set("resolved_globaltag", conditions)
+
+                    changes.append((relval, "approved", None))
+                except Exception as ex:
+                    errors[prepid] = str(ex)
+
+            errors.update(self.update_statuses(changes))
+
+        self.raise_errors(errors)
+        return [relval for relval, _, _ in changes]
 
     def get_dataset_access_types(self, relvals):
         """
         Return a dictionary of dataset access types
         """
-        dataset_access_types = {}
         datasets_to_check = set()
         for relval in relvals:
             for step in relval.get("steps"):
@@ -733,184 +1273,287 @@ class RelValController(ControllerBase):
         if not datasets_to_check:
             return {}
 
-        dbs_datasets = dbs_datasetlist(list(datasets_to_check))
-        for dataset in dbs_datasets:
-            dataset_name = dataset["dataset"]
-            if dataset_name not in datasets_to_check:
-                continue
-
-            access_type = dataset.get("dataset_access_type", "unknown")
-            datasets_to_check.remove(dataset_name)
-            dataset_access_types[dataset_name] = access_type
-
+        dataset_access_types = get_access_types(datasets_to_check)
+        datasets_to_check -= set(dataset_access_types)
         if datasets_to_check:
             datasets_to_check = ", ".join(list(datasets_to_check))
             raise RuntimeError(f"Could not get status for datasets: {datasets_to_check}")
 
         return dataset_access_types
 
+    def create_indexes(self):
+        """
+        Create indexes used by bulk RelVal operations
+        """
+        relval_db = Database(self.database_name)
+        # Newest campaign timestamp of a campaign
+        relval_db.collection.create_index(
+            [("cmssw_release", 1), ("batch_name", 1), ("campaign_timestamp", -1)]
+        )
+
+    def check_datasets_for_submission(self, relval, dataset_access_types):
+        """
+        Make sure all input and pileup datasets of RelVal are VALID in DBS
+        """
+        for step in relval.get("steps"):
+            if step.get_step_type() == "input_file":
+                dataset = step.get("input")["dataset"]
+            elif step.get("driver")["pileup_input"]:
+                dataset = step.get("driver")["pileup_input"]
+            else:
+                continue
+
+            dataset = dataset[dataset.index("/") :]
+            access_type = dataset_access_types[dataset]
+            if access_type.lower() != "valid":
+                # Look it up again next time, dataset might be made VALID
+                invalidate_dbs_cache(dataset)
+                raise AssertionError(f"{dataset} type is {access_type}, it must be VALID")
+
+    def get_campaign_timestamp(self, cmssw_release, batch_name):
+        """
+        Return timestamp of a campaign (CMSSW + Batch Name) that RelVals are
+        submitted to: newest timestamp of the campaign if it is less than an
+        hour old or current time otherwise
+        Campaign lock must be held by the caller
+        """
+        # Threshold in seconds
+        threshold = 3600
+        now = int(time.time())
+        relval_db = Database(self.database_name)
+        # Get RelVal with newest timestamp in this campaign (CMSSW + Batch Name)
+        relvals_with_timestamp = (
+            relval_db.collection.find(
+                {"cmssw_release": cmssw_release, "batch_name": batch_name},
+                {"campaign_timestamp": 1},
+            )
+            .sort("campaign_timestamp", -1)
+            .limit(1)
+        )
+        newest_timestamp = 0
+        for relval_with_timestamp in relvals_with_timestamp:
+            newest_timestamp = relval_with_timestamp.get("campaign_timestamp", 0)
+
+        self.logger.info(
+            "Newest timestamp for %s__%s is %s (%s), threshold is %s",
+            cmssw_release,
+            batch_name,
+            newest_timestamp,
+            (newest_timestamp - now),
+            threshold,
+        )
+        if newest_timestamp == 0 or newest_timestamp < now - threshold:
+            newest_timestamp = now
+
+        self.logger.info(
+            "Campaign timestamp for %s__%s will be set to %s",
+            cmssw_release,
+            batch_name,
+            newest_timestamp,
+        )
+        return newest_timestamp
+
     def move_relvals_to_submitting(self, relvals):
         """
         Try to add RelVals to submission queue and get sumbitted
+        RelVals of the same campaign get campaign timestamp with a single lookup
+        and are updated in the database with a single bulk write, errors of
+        RelVals that cannot be moved are raised afterwards
         """
-        results = []
         dataset_access_types = self.get_dataset_access_types(relvals)
+        by_campaign = {}
         for relval in relvals:
-            prepid = relval.get_prepid()
-            with self.locker.get_nonblocking_lock(prepid):
-                batch_name = relval.get("batch_name")
-                cmssw_release = relval.get("cmssw_release").split("/")[-1]
-                relval_db = Database("relvals")
-                # Make sure all datasets are VALID in DBS
-                steps = relval.get("steps")
-                for step in steps:
-                    if step.get_step_type() == "input_file":
-                        dataset = step.get("input")["dataset"]
-                    elif step.get("driver")["pileup_input"]:
-                        dataset = step.get("driver")["pileup_input"]
-                    else:
-                        continue
+            batch_name = relval.get("batch_name")
+            cmssw_release = relval.get("cmssw_release").split("/")[-1]
+            by_campaign.setdefault((cmssw_release, batch_name), []).append(relval)
 
-                    dataset = dataset[dataset.index("/") :]
-                    access_type = dataset_access_types[dataset]
-                    if access_type.lower() != "valid":
-                        raise AssertionError(
-                            f"{dataset} type is {access_type}, it must be VALID"
-                        )
+        relval_db = Database(self.database_name)
+        results = []
+        errors = {}
+        for (cmssw_release, batch_name), campaign_relvals in by_campaign.items():
+            with ExitStack() as stack:
+                ready = []
+                for relval in sorted(campaign_relvals, key=lambda r: r.get_prepid()):
+                    prepid = relval.get_prepid()
+                    try:
+                        stack.enter_context(self.locker.get_nonblocking_lock(prepid))
+                        self.check_datasets_for_submission(relval, dataset_access_types)
+                        ready.append(relval)
+                    except Exception as ex:
+                        errors[prepid] = str(ex)
+
+                if not ready:
+                    continue
 
-                # Create or find campaign timestamp
-                # Threshold in seconds
-                threshold = 3600
-                locker_key = f"move-relval-to-submitting-{cmssw_release}__{batch_name}"
-                with self.locker.get_lock(locker_key):
-                    now = int(time.time())
-                    # Get RelVal with newest timestamp in this campaign (CMSSW + Batch Name)
-                    db_query = f"cmssw_release={cmssw_release}&&batch_name={batch_name}"
-                    relvals_with_timestamp = relval_db.query(
-                        db_query,
-                        limit=1,
-                        sort_attr="campaign_timestamp",
-                        sort_asc=False,
-                    )
-                    newest_timestamp = 0
-                    if relvals_with_timestamp:
-                        newest_timestamp = relvals_with_timestamp[0].get(
-                            "campaign_timestamp", 0
-                        )
+                try:
+                    # Create or find campaign timestamp
+                    locker_key = f"move-relval-to-submitting-{cmssw_release}__{batch_name}"
+                    with self.locker.get_lock(locker_key):
+                        timestamp = self.get_campaign_timestamp(cmssw_release, batch_name)
+                        for relval in ready:
+                            relval.set("campaign_timestamp", timestamp)
+                            relval.set("status", "submitting")
+                            relval.set("submission_stage", "config")
+                            relval.add_history("status", "submitting", None)
+
+                        campaign_errors = bulk_save_changes(relval_db, ready)
+                except Exception as ex:
+                    campaign_errors = {relval.get_prepid(): str(ex) for relval in ready}
+
+                errors.update(campaign_errors)
+                saved = [r for r in ready if r.get_prepid() not in campaign_errors]
+                if not saved:
+                    continue
 
-                    self.logger.info(
-                        "Newest timestamp for %s__%s is %s (%s), threshold is %s",
-                        cmssw_release,
-                        batch_name,
-                        newest_timestamp,
-                        (newest_timestamp - now),
-                        threshold,
-                    )
-                    if newest_timestamp == 0 or newest_timestamp < now - threshold:
-                        newest_timestamp = now
-
-                    self.logger.info(
-                        "Campaign timestamp for %s__%s will be set to %s",
-                        cmssw_release,
-                        batch_name,
-                        newest_timestamp,
-                    )
-                    relval.set("campaign_timestamp", newest_timestamp)
-                    self.update_status(relval, "submitting")
+                self.logger.info(
+                    'Set "%s" status to "submitting"',
+                    ", ".join(r.get_prepid() for r in saved),
+                )
+                try:
+                    RequestSubmitter().enqueue(saved, self)
+                except Exception as ex:
+                    # Saved RelVals are queued again when submitter is restarted
+                    errors.update({relval.get_prepid(): str(ex) for relval in saved})
 
-                RequestSubmitter().add(relval, self)
-                results.append(relval)
+                results.extend(saved)
 
+        self.raise_errors(errors)
         return results
 
     def move_relvals_to_done(self, relvals):
         """
         Try to move RelVal to done or archived status
+        Stats2 workflows of all RelVals are fetched concurrently before any
+        lock is taken, then updated workflows and statuses of all RelVals are
+        saved with a single bulk write, errors of RelVals that cannot be moved
+        are raised afterwards
         """
-        results = []
+        changes = []
+        updated = []
+        errors = {}
         # RelVal will not have recoveries, so "completed" is the last state
         done_status = ("completed",)
         archived_status = ("normal-archived", "rejected-archived", "aborted-archived")
         # Archived threshold - if workflow is archived for more than a week, but
         # is not done normally (VALID datasets) - move it to 'archived' status
         archived_threshold = time.time() - 7 * 24 * 3600
-        for relval in relvals:
-            prepid = relval.get_prepid()
-            with self.locker.get_nonblocking_lock(prepid):
-                relval = self.update_workflows(relval)
-                workflows = relval.get("workflows")
-                workflows = [
-                    w for w in workflows if w["type"].lower() != "resubmission"
-                ]
-                if not workflows:
-                    raise AssertionError(
-                        f"{prepid} does not have any workflows in computing"
+        fetched_workflows = self.fetch_stats_workflows_for_relvals(relvals)
+        with ExitStack() as stack:
+            for relval in relvals:
+                prepid = relval.get_prepid()
+                try:
+                    stack.enter_context(self.locker.get_nonblocking_lock(prepid))
+                    stats_workflows = fetched_workflows[prepid]
+                    if isinstance(stats_workflows, Exception):
+                        raise stats_workflows
+
+                    relval = self.get(prepid)
+                    # Workflows might have been added since they were fetched
+                    stats_workflows = self.fetch_stats_workflows(relval, stats_workflows)
+                    self.apply_stats_workflows(relval, stats_workflows)
+                    updated.append(relval)
+                    changes.append(
+                        self.get_done_change(
+                            relval, done_status, archived_status, archived_threshold
+                        )
                     )
+                except Exception as ex:
+                    errors[prepid] = str(ex)
+
+            # RelVals that cannot be moved yet still get their workflows updated
+            moved = {id(change[0]) for change in changes}
+            errors.update(
+                self.update_statuses(
+                    changes, [relval for relval in updated if id(relval) not in moved]
+                )
+            )
 
-                last_workflow = workflows[-1]
-                datasets = last_workflow["output_datasets"]
-                status_history = last_workflow["status_history"]
-                # Get all not-VALID datasets
-                not_valid_datasets = [
-                    d["name"] for d in datasets if d["type"].lower() != "valid"
-                ]
-                # Get time when workflow became completed
-                completed_timestamp = None
-                for status in status_history:
-                    if status["status"] in done_status:
-                        completed_timestamp = status["time"]
-                        break
-
-                # All datasets are VALID and workflow was 'completed'
-                if not not_valid_datasets and completed_timestamp:
-                    self.update_status(relval, "done", completed_timestamp)
-                    results.append(relval)
-                    continue
-
-                # Get time when workflow became archived
-                archived_timestamp = None
-                for status in status_history:
-                    if status["status"] in archived_status:
-                        archived_timestamp = status["time"]
-                        break
-
-                # Workflow was archived for more than the threshold
-                if archived_timestamp and archived_timestamp <= archived_threshold:
-                    self.update_status(relval, "archived", archived_timestamp)
-                    results.append(relval)
-                    continue
-
-                if not_valid_datasets:
-                    datatiers = [ds.split("/")[-1] for ds in not_valid_datasets]
-                    raise AssertionError(
-                        f'Could not move {prepid} to "done" because '
-                        f"{len(not_valid_datasets)} datasets are not VALID: "
-                        f'{", ".join(datatiers)}'
-                    )
+        self.raise_errors(errors)
+        return [relval for relval, _, _ in changes]
 
-                last_workflow_name = last_workflow["name"]
-                if not completed_timestamp:
-                    raise AssertionError(
-                        f'Could not move {prepid} to "done" because '
-                        f'{last_workflow} is not yet "completed"'
-                    )
+    def get_done_change(self, relval, done_status, archived_status, archived_threshold):
+        """
+        Return (relval, status, timestamp) change that moves RelVal with
+        updated workflows to done or archived status
+        Raise an error if RelVal cannot be moved to any of these statuses
+        """
+        prepid = relval.get_prepid()
+        workflows = relval.get("workflows")
+        workflows = [w for w in workflows if w["type"].lower() != "resubmission"]
+        if not workflows:
+            raise AssertionError(f"{prepid} does not have any workflows in computing")
+
+        last_workflow = workflows[-1]
+        datasets = last_workflow["output_datasets"]
+        status_history = last_workflow["status_history"]
+        # Get all not-VALID datasets
+        not_valid_datasets = [d["name"] for d in datasets if d["type"].lower() != "valid"]
+        # Get time when workflow became completed
+        completed_timestamp = None
+        for status in status_history:
+            if status["status"] in done_status:
+                completed_timestamp = status["time"]
+                break
+
+        # All datasets are VALID and workflow was 'completed'
+        if not not_valid_datasets and completed_timestamp:
+            return (relval, "done", completed_timestamp)
+
+        # Get time when workflow became archived
+        archived_timestamp = None
+        for status in status_history:
+            if status["status"] in archived_status:
+                archived_timestamp = status["time"]
+                break
+
+        # Workflow was archived for more than the threshold
+        if archived_timestamp and archived_timestamp <= archived_threshold:
+            return (relval, "archived", archived_timestamp)
+
+        if not_valid_datasets:
+            datatiers = [ds.split("/")[-1] for ds in not_valid_datasets]
+            raise AssertionError(
+                f'Could not move {prepid} to "done" because '
+                f"{len(not_valid_datasets)} datasets are not VALID: "
+                f'{", ".join(datatiers)}'
+            )
 
-                raise AssertionError(
-                    f'Could not move {prepid} to "archived" because '
-                    f"{last_workflow_name} is not archived long enough"
-                )
+        last_workflow_name = last_workflow["name"]
+        if not completed_timestamp:
+            raise AssertionError(
+                f'Could not move {prepid} to "done" because '
+                f'{last_workflow} is not yet "completed"'
+            )
 
-        return results
+        raise AssertionError(
+            f'Could not move {prepid} to "archived" because '
+            f"{last_workflow_name} is not archived long enough"
+        )
 
     def move_relval_back_to_new(self, relval):
         """
         Try to move RelVal back to new
         """
+        return self.move_relvals_back_to_new([relval])[0]
+
+    def move_relvals_back_to_new(self, relvals):
+        """
+        Try to move RelVals back to new, statuses of all RelVals are saved with
+        a single bulk write
+        """
+        changes = [self.get_back_to_new_change(relval) for relval in relvals]
+        self.raise_errors(self.update_statuses(changes))
+        return relvals
+
+    def get_back_to_new_change(self, relval):
+        """
+        Reset resolved globaltags of RelVal and return (relval, status, timestamp)
+        change that moves it back to new
+        """
         for step in relval.get("steps"):
             step.set("resolved_globaltag", "")
 
-        self.update_status(relval, "new")
-        return relval
+        return (relval, "new", None)
 
     def move_relval_back_to_approved(self, relval):
         """
@@ -931,6 +1574,7 @@ class RelValController(ControllerBase):
 
         relval.set("campaign_timestamp", 0)
         relval.set("output_datasets", [])
+        relval.set("submission_stage", "")
         self.update_status(relval, "approved")
         return relval
 
@@ -1020,6 +1664,10 @@ class RelValController(ControllerBase):
             workflow_status_pairs.append((workflow_name, last_workflow_status))
 
         cmsweb_reject_workflows(workflow_status_pairs)
+        # Output datasets of rejected workflows are invalidated
+        for workflow in workflows:
+            for dataset in workflow.get("output_datasets", []):
+                invalidate_dbs_cache(dataset["name"])
 
     def update_workflows(self, relval):
         """
@@ -1029,31 +1677,76 @@ class RelValController(ControllerBase):
         relval_db = Database("relvals")
         with self.locker.get_lock(prepid):
             relval = self.get(prepid)
-            workflow_names = {w["name"] for w in relval.get("workflows")}
+            self.apply_stats_workflows(relval, self.fetch_stats_workflows(relval))
+            save_changes(relval_db, relval)
+
+        return relval
+
+    def fetch_stats_workflows(self, relval, known_workflows=None):
+        """
+        Return Stats2 workflows of RelVal's prepid and workflows of RelVal
+        that could not be found by prepid, workflows whose names are in known
+        workflows are not fetched again
+        """
+        prepid = relval.get_prepid()
+        workflow_names = {w["name"] for w in relval.get("workflows")}
+        if known_workflows is None:
             stats_workflows = get_workflows_from_stats_for_prepid(prepid)
-            workflow_names -= {w["RequestName"] for w in stats_workflows}
+        else:
+            stats_workflows = list(known_workflows)
+
+        workflow_names -= {w["RequestName"] for w in stats_workflows if w}
+        if workflow_names or known_workflows is None:
             self.logger.info(
                 "%s workflows that are not in stats: %s",
                 len(workflow_names),
                 workflow_names,
             )
             stats_workflows += get_workflows_from_stats(list(workflow_names))
-            all_workflows = {}
-            for workflow in stats_workflows:
-                if not workflow or not workflow.get("RequestName"):
-                    raise AssertionError("Could not find workflow in Stats2")
 
-                name = workflow.get("RequestName")
-                all_workflows[name] = workflow
-                self.logger.info("Found workflow %s", name)
+        return stats_workflows
 
-            output_datasets = self.get_output_datasets(relval, all_workflows)
-            workflows = self.pick_workflows(all_workflows, output_datasets)
-            relval.set("output_datasets", output_datasets)
-            relval.set("workflows", workflows)
-            relval_db.save(relval.get_json())
+    def fetch_stats_workflows_for_relvals(self, relvals, max_workers=8):
+        """
+        Fetch Stats2 workflows of many RelVals concurrently
+        Return a dictionary of prepids and lists of workflows or exceptions
+        that were raised while fetching them
+        """
+        results = {}
+        if not relvals:
+            return results
+
+        max_workers = min(len(relvals), max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(self.fetch_stats_workflows, relval) for relval in relvals
+            ]
+            for relval, future in zip(relvals, futures):
+                try:
+                    results[relval.get_prepid()] = future.result()
+                except Exception as ex:  # pylint: disable=broad-exception-caught
+                    results[relval.get_prepid()] = ex
 
-        return relval
+        return results
+
+    def apply_stats_workflows(self, relval, stats_workflows):
+        """
+        Set output datasets and computing workflows of RelVal from given
+        Stats2 workflows, this does not save RelVal to database
+        """
+        all_workflows = {}
+        for workflow in stats_workflows:
+            if not workflow or not workflow.get("RequestName"):
+                raise AssertionError("Could not find workflow in Stats2")
+
+            name = workflow.get("RequestName")
+            all_workflows[name] = workflow
+            self.logger.info("Found workflow %s", name)
+
+        output_datasets = self.get_output_datasets(relval, all_workflows)
+        workflows = self.pick_workflows(all_workflows, output_datasets)
+        relval.set("output_datasets", output_datasets)
+        relval.set("workflows", workflows)
 
     def get_output_datasets(self, relval, all_workflows):
         """
@@ -4,25 +4,22 @@ Module that contains TicketController class
 
 import json
 from copy import deepcopy
-from environment import (
-    REMOTE_PATH,
-    REMOTE_SSH_NODE,
-    REMOTE_SSH_PASSWORD,
-    REMOTE_SSH_USERNAME,
-)
+from environment import REMOTE_PATH
 from core_lib.database.database import Database
 from core_lib.controller.controller_base import ControllerBase
-from core_lib.utils.ssh_executor import SSHExecutor
 from core_lib.utils.common_utils import (
     clean_split,
-    get_scram_arch,
-    dbs_datasetlist,
     run_commands_in_cmsenv,
 )
 from core.model.ticket import Ticket
 from core.model.relval import RelVal
 from core.model.relval_step import RelValStep
 from core.controller.relval_controller import RelValController
+from core.utils.scram_arch import get_scram_arch
+from core.utils.ssh_pool import SSHPool
+from core.utils.voms_proxy import VOMSProxy
+from core.utils.dbs import get_dataset_names_for_patterns
+from core.utils.document_updates import save_changes, set_next_version
 
 
 class TicketController(ControllerBase):
@@ -55,6 +52,13 @@ class TicketController(ControllerBase):
 
         return ticket
 
+    def before_update(self, old_obj, new_obj, changed_values):
+        """
+        Bump version of the document, fail if it was changed in the meantime
+        """
+        # pylint: disable=unused-argument
+        set_next_version(old_obj, new_obj)
+
     def get_editing_info(self, obj):
         editing_info = super().get_editing_info(obj)
         prepid = obj.get_prepid()
@@ -95,38 +99,26 @@ class TicketController(ControllerBase):
 
         return True
 
-    def rewrite_gt_string_if_needed(self, workflow_id, step, gt_rewrite):
+    def get_gt_rewrite_pattern(self, step, gt_rewrite):
         """
-        Perform base dataset rewrite if needed:
-          - rewrite middle part of input dataset name for input steps
-          - rewrite middle part of --pileup_input for driver steps
+        Return dataset name pattern for base dataset rewrite of a step:
+          - middle part of input dataset name for input steps
+          - middle part of --pileup_input for driver steps
+        Return None if step has neither
         """
-        if not gt_rewrite:
-            return
-
-        input_dict = step["input"]
-        driver_dict = step["driver"]
-        if input_dict.get("dataset"):
+        input_dataset = step.get("input")["dataset"]
+        pileup_input = step.get("driver")["pileup_input"]
+        if input_dataset:
             # Input dataset step
-            input_dataset = input_dict["dataset"]
             self.logger.info(
                 "Will replace %s middle part with %s", input_dataset, gt_rewrite
             )
             input_dataset_split = input_dataset.split("/")
             input_dataset_split[2] = gt_rewrite
-            input_dataset = "/".join(input_dataset_split)
-            dataset_list = dbs_datasetlist(input_dataset)
-            if not dataset_list:
-                raise ValueError(
-                    f"Could not find {input_dataset} input dataset for {workflow_id} "
-                    f"after applying {gt_rewrite} GT rewrite"
-                )
+            return "/".join(input_dataset_split)
 
-            input_dataset = sorted([x["dataset"] for x in dataset_list])[-1]
-            input_dict["dataset"] = input_dataset
-        elif driver_dict.get("pileup_input"):
+        if pileup_input:
             # Driver step
-            pileup_input = driver_dict["pileup_input"]
             # Removing PU_ from the pileup input dataset because it is already
             # clear that PU dataset is PU without PU_
             gt_rewrite = gt_rewrite.replace("-PU_", "-")
@@ -142,16 +134,50 @@ class TicketController(ControllerBase):
             )
             pileup_input_split = pileup_input.split("/")
             pileup_input_split[2] = gt_rewrite
-            pileup_input = "/".join(pileup_input_split)
-            pileup_prefix = pileup_input[: pileup_input.index("/")]
-            dataset_list = dbs_datasetlist(pileup_input)
-            if not dataset_list:
-                raise ValueError(
-                    f"Could not find {pileup_input} PU dataset for {workflow_id}"
-                )
+            return "/".join(pileup_input_split)
 
-            pileup_input = sorted([x["dataset"] for x in dataset_list])[-1]
-            driver_dict["pileup_input"] = f"{pileup_prefix}{pileup_input}"
+        return None
+
+    def rewrite_gt_strings(self, relvals, gt_rewrite):
+        """
+        Perform base dataset rewrite of input and pileup datasets in all RelVals
+        All dataset patterns are collected first and then resolved in DBS
+        concurrently, each distinct pattern once
+        """
+        rewrites = []
+        for relval in relvals:
+            for step in relval.get("steps"):
+                pattern = self.get_gt_rewrite_pattern(step, gt_rewrite)
+                if pattern:
+                    rewrites.append((relval, step, pattern))
+
+        dataset_names = get_dataset_names_for_patterns([r[2] for r in rewrites])
+        self.logger.info(
+            "Resolved %s dataset patterns for %s steps", len(dataset_names), len(rewrites)
+        )
+        for relval, step, pattern in rewrites:
+            workflow_id = relval.get("workflow_id")
+            dataset_list = dataset_names[pattern]
+            if step.get("input")["dataset"]:
+                if not dataset_list:
+                    raise ValueError(
+                        f"Could not find {pattern} input dataset for {workflow_id} "
+                        f"after applying {gt_rewrite} GT rewrite"
+                    )
+
+                step_input = dict(step.get("input"))
+                step_input["dataset"] = dataset_list[-1]
+                step.set("input", step_input)
+            else:
+                if not dataset_list:
+                    raise ValueError(
+                        f"Could not find {pattern} PU dataset for {workflow_id}"
+                    )
+
+                pileup_prefix = pattern[: pattern.index("/")]
+                driver = dict(step.get("driver"))
+                driver["pileup_input"] = f"{pileup_prefix}{dataset_list[-1]}"
+                step.set("driver", driver)
 
     def recycle_input_with_gt_rewrite(self, relvals, gt_rewrite, recycle_input_of):
         """
@@ -223,8 +249,9 @@ class TicketController(ControllerBase):
         self.logger.debug(
             "Resolved conditions:\n%s", json.dumps(conditions_tree, indent=2)
         )
+        # Collect dataset templates of all RelVals and resolve them together
+        dataset_templates = []
         for relval, recycled_step, recycled_index in selected_relvals:
-            relval_steps = relval.get("steps")
             conditions = recycled_step.get("driver")["conditions"]
             cmssw = recycled_step.get_release()
             if conditions.startswith("auto:"):
@@ -237,18 +264,28 @@ class TicketController(ControllerBase):
             relval_name = relval.get_name()
             datatier = recycled_step.get("driver")["datatier"][-1]
             dataset = f"/RelVal{relval_name}/{cmssw}-{processing_string}-v*/{datatier}"
-            relval_id = relval.get("workflow_id")
             self.logger.debug(
-                "Recycled input dataset template %s for %s", dataset, relval_id
+                "Recycled input dataset template %s for %s",
+                dataset,
+                relval.get("workflow_id"),
             )
-            dataset_list = dbs_datasetlist(dataset)
+            dataset_templates.append(dataset)
+
+        dataset_names = get_dataset_names_for_patterns(dataset_templates)
+        for (relval, recycled_step, recycled_index), dataset in zip(
+            selected_relvals, dataset_templates
+        ):
+            relval_steps = relval.get("steps")
+            relval_name = relval.get_name()
+            relval_id = relval.get("workflow_id")
+            dataset_list = dataset_names[dataset]
             if not dataset_list:
                 raise ValueError(
                     f"Could not find a recyclable input for {relval_name} "
                     f"({relval_id}), query: {dataset}, step: {recycle_input_of}"
                 )
 
-            dataset = sorted([x["dataset"] for x in dataset_list])[-1]
+            dataset = dataset_list[-1]
             input_step_json = recycled_step.get_json()
             input_step_json["driver"] = {}
             input_step_json["input"] = {
@@ -375,11 +412,7 @@ class TicketController(ControllerBase):
             "core/utils/das.py",
             f"{remote_directory}/das.py",
         )
-        command = [
-            f"cd {remote_directory}",
-            "voms-proxy-init -voms cms --valid 4:00 --out $(pwd)/proxy.txt",
-        ]
-        ssh_executor.execute_command(command)
+        proxy_path = VOMSProxy().get_path(ssh_executor)
 
         # Defined a name for output file
         file_name = f"{ticket_prepid}.json"
@@ -387,7 +420,7 @@ class TicketController(ControllerBase):
         matrix_command = run_commands_in_cmsenv(
             [
                 f"cd {remote_directory}",
-                "export X509_USER_PROXY=$(pwd)/proxy.txt",
+                f"export X509_USER_PROXY={proxy_path}",
                 "$PYTHON_INT run_the_matrix_pdmv.py "
                 f"-l={workflow_ids} "
                 f"-w={matrix} "
@@ -409,6 +442,7 @@ class TicketController(ControllerBase):
         ]
         out, err, code = ssh_executor.execute_command(command)
         if code != 0:
+            VOMSProxy().invalidate_on_auth_error(err)
             raise RuntimeError(
                 f"Error code {code} creating RelVals. stdout: {out}, stderr: {err}"
             )
@@ -431,7 +465,6 @@ class TicketController(ControllerBase):
         n_streams = ticket.get("n_streams")
         gpu_dict = ticket.get("gpu")
         gpu_steps = ticket.get("gpu_steps")
-        rewrite_gt_string = ticket.get("rewrite_gt_string")
         events_factor = ticket.get("events_factor")
         relval_json = {
             "prepid": "TempRelValObject-00000",
@@ -466,7 +499,6 @@ class TicketController(ControllerBase):
                 events = max(1, int(int(events) * events_factor))
                 new_step["driver"]["relval"] = f"{events},{events_per_job}"
 
-            self.rewrite_gt_string_if_needed(workflow_id, new_step, rewrite_gt_string)
             relval_json["steps"].append(new_step)
 
         return RelVal(relval_json, False)
@@ -477,11 +509,6 @@ class TicketController(ControllerBase):
         """
         ticket_db = Database("tickets")
         ticket_prepid = ticket.get_prepid()
-        ssh_executor = SSHExecutor(
-            host=REMOTE_SSH_NODE,
-            username=REMOTE_SSH_USERNAME,
-            password=REMOTE_SSH_PASSWORD,
-        )
         relval_controller = RelValController()
         created_relvals = []
         with self.locker.get_lock(ticket_prepid):
@@ -489,7 +516,9 @@ class TicketController(ControllerBase):
             rewrite_gt_string = ticket.get("rewrite_gt_string")
             recycle_input_of = ticket.get("recycle_input_of")
             try:
-                workflows = self.generate_workflows(ticket, ssh_executor)
+                with SSHPool().connection() as ssh_executor:
+                    workflows = self.generate_workflows(ticket, ssh_executor)
+
                 # Iterate through workflows and create RelVal objects
                 relvals = []
                 for workflow_id, workflow_dict in workflows.items():
@@ -499,6 +528,10 @@ class TicketController(ControllerBase):
                         )
                     )
 
+                # Rewrite input and pileup datasets if needed
+                if rewrite_gt_string:
+                    self.rewrite_gt_strings(relvals, rewrite_gt_string)
+
                 # Handle recycling if needed
                 if recycle_input_of:
                     if rewrite_gt_string:
@@ -508,8 +541,17 @@ class TicketController(ControllerBase):
                     else:
                         self.recycle_input(relvals, relval_controller, recycle_input_of)
 
+                # Validate all RelVals before creating any of them
+                validation_results = relval_controller.validate(relvals)
+                for relval, errors in zip(relvals, validation_results):
+                    if errors:
+                        workflow_id = relval.get("workflow_id")
+                        raise AssertionError(
+                            f"Invalid RelVal for workflow {workflow_id}: {', '.join(errors)}"
+                        )
+
                 for relval in relvals:
-                    relval = relval_controller.create(relval.get_json())
+                    relval = relval_controller.create_validated(relval)
                     created_relvals.append(relval)
                     self.logger.info("Created %s", relval.get_prepid())
 
@@ -517,7 +559,7 @@ class TicketController(ControllerBase):
                 ticket.set("created_relvals", created_relval_prepids)
                 ticket.set("status", "done")
                 ticket.add_history("created_relvals", created_relval_prepids, None)
-                ticket_db.save(ticket.get_json())
+                save_changes(ticket_db, ticket)
             except Exception as ex:
                 self.logger.error("Error creating RelVal from ticket: %s", ex)
                 # Delete created relvals if there was an Exception
@@ -526,9 +568,6 @@ class TicketController(ControllerBase):
 
                 # And reraise the exception
                 raise ex
-            finally:
-                # Close all SSH connections
-                ssh_executor.close_connections()
 
         return [r.get("prepid") for r in created_relvals]
 
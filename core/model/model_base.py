@@ -1,6 +1,7 @@
 """
 Module that contains ModelBase class
 """
+import re
 from core_lib.model.model_base import ModelBase as PdmVModelBase
 
 
@@ -10,6 +11,119 @@ class ModelBase(PdmVModelBase):
     Has some convenience methods as well as somewhat smart setter
     Contains a bunch of sanity checks
     """
+    # Validation functions of model classes
+    __validators = {}
+
+    def __init__(self, json_input=None, check_attributes=True):
+        # Version of the stored document that object was loaded from
+        self.__version = (json_input or {}).get('_version') or 0
+        self.__changed_attributes = set()
+        self.__new_history = []
+        PdmVModelBase.__init__(self, json_input, check_attributes)
+        self.clear_changes()
+
+    def set(self, attribute, value=None):
+        """
+        Set attribute value and mark attribute as changed
+        """
+        result = PdmVModelBase.set(self, attribute, value)
+        self.mark_changed(attribute)
+        return result
+
+    def set_unchanged(self, attribute, value):
+        """
+        Set value without marking attribute as changed, e.g. when value is
+        replaced with its own copy
+        """
+        return PdmVModelBase.set(self, attribute, value)
+
+    def add_history(self, action, value, user, timestamp=None):
+        """
+        Add history entry, it is pushed to stored history when changes are saved
+        """
+        history_changed = 'history' in self.__changed_attributes
+        result = PdmVModelBase.add_history(self, action, value, user, timestamp)
+        if not history_changed:
+            # New entry can be pushed instead of saving the whole history
+            self.__changed_attributes.discard('history')
+            self.__new_history.append(self.get('history')[-1])
+
+        return result
+
+    def mark_changed(self, attribute):
+        """
+        Mark attribute as changed, e.g. when a nested object was changed
+        """
+        if hasattr(self, '_ModelBase__changed_attributes'):
+            self.__changed_attributes.add(attribute)
+
+    def get_version(self):
+        """
+        Return version of the stored document that object was loaded from
+        """
+        return self.__version
+
+    def set_version(self, version):
+        """
+        Set version that object will have when its whole document is saved
+        """
+        self.__version = version
+
+    def get_json(self):
+        """
+        Return object as a dictionary, objects that are stored as separate
+        documents also include version, so it is kept when whole document is saved
+        """
+        object_json = PdmVModelBase.get_json(self)
+        if '_id' in object_json:
+            object_json['_version'] = self.__version
+
+        return object_json
+
+    def get_changes(self):
+        """
+        Return a database update with changed attributes and new history
+        entries or None if nothing was changed since object was loaded or saved
+        """
+        if not self.__changed_attributes and not self.__new_history:
+            return None
+
+        update = {}
+        if self.__changed_attributes:
+            object_json = self.get_json()
+            update['$set'] = {attribute: object_json[attribute]
+                              for attribute in sorted(self.__changed_attributes)}
+
+        if self.__new_history:
+            update['$push'] = {'history': {'$each': list(self.__new_history)}}
+
+        return update
+
+    def clear_changes(self, version=None):
+        """
+        Forget changes after they were saved, optionally with a new document version
+        """
+        self.__changed_attributes = set()
+        self.__new_history = []
+        if version is not None:
+            self.__version = version
+
+    @staticmethod
+    def regex_check(regex):
+        """
+        Return a function that checks if value matches given regex
+        Regex is compiled once, when the check is made
+        """
+        match = re.compile(regex).match
+        return lambda value: match(value) is not None
+
+    @staticmethod
+    def optional_check(check):
+        """
+        Return a function that allows empty value or runs given check
+        """
+        return lambda value: not value or check(value)
+
     __cmssw_regex = 'CMSSW_[0-9]{1,3}_[0-9]{1,3}_[0-9X]{1,3}.{0,30}'  # CMSSW_ddd_ddd_ddd[_XXX...]
     __cmssw_path_regex = f'(/([a-zA-Z0-9_\\-\\.]+/)+{__cmssw_regex}|{__cmssw_regex})'
     __dataset_regex = '^/[a-zA-Z0-9\\-_]{1,99}/[a-zA-Z0-9\\.\\-_]{1,199}/[A-Z\\-]{1,50}$'
@@ -18,18 +132,85 @@ class ModelBase(PdmVModelBase):
     __ps_regex = '[a-zA-Z0-9_]{1,100}'  # Processing String
     __sample_tag_regex = '[a-zA-Z0-9_\\-]{0,75}'
     default_lambda_checks = {
-        'batch_name': lambda batch: ModelBase.matches_regex(batch, '[a-zA-Z0-9_\\-]{3,75}'),
-        'cmssw_release': lambda cmssw: ModelBase.matches_regex(cmssw, ModelBase.__cmssw_regex),
-        'cmssw_path': lambda cmssw: ModelBase.matches_regex(cmssw, ModelBase.__cmssw_path_regex),
+        'batch_name': regex_check('[a-zA-Z0-9_\\-]{3,75}'),
+        'cmssw_release': regex_check(__cmssw_regex),
+        'cmssw_path': regex_check(__cmssw_path_regex),
         'cpu_cores': lambda cpus: 1 <= cpus <= 8,
-        'dataset': lambda ds: ModelBase.matches_regex(ds, ModelBase.__dataset_regex),
-        'globaltag': lambda gt: ModelBase.matches_regex(gt, ModelBase.__globaltag_regex),
-        'label': lambda label: ModelBase.matches_regex(label, '[a-zA-Z0-9_]{0,75}'),
+        'dataset': regex_check(__dataset_regex),
+        'globaltag': regex_check(__globaltag_regex),
+        'label': regex_check('[a-zA-Z0-9_]{0,75}'),
         'matrix': lambda m: m in ('standard', 'upgrade', 'generator',
                                   'pileup', 'premix', 'extendedgen', 'gpu', 'data_highstats'),
         'memory': lambda mem: 0 <= mem <= 32000,
-        'processing_string': lambda ps: ModelBase.matches_regex(ps, ModelBase.__ps_regex),
-        'relval': lambda r: ModelBase.matches_regex(r, ModelBase.__relval_regex),
-        'sample_tag': lambda gt: ModelBase.matches_regex(gt, ModelBase.__sample_tag_regex),
-        'scram_arch': lambda sa: ModelBase.matches_regex(sa, '[a-z0-9_]{0,30}'),
+        'processing_string': regex_check(__ps_regex),
+        'relval': regex_check(__relval_regex),
+        'sample_tag': regex_check(__sample_tag_regex),
+        'scram_arch': regex_check('[a-z0-9_]{0,30}'),
     }
+
+    @classmethod
+    def get_validator(cls):
+        """
+        Return validation function of this class, it is built once per class
+        Function takes a JSON dictionary and returns a list of errors
+        """
+        validator = ModelBase.__validators.get(cls)
+        if validator is None:
+            validator = cls.__compile_validator()
+            ModelBase.__validators[cls] = validator
+
+        return validator
+
+    @classmethod
+    def __compile_validator(cls):
+        """
+        Build a function that runs checks of all attributes of given JSON
+        dictionary that are in the schema
+        Check functions of attributes, list items and dictionary values are
+        looked up once, so validation does not go through setter checks, but
+        checks are applied the same way as setter applies them
+        """
+        checks = []
+        for attribute in cls.schema():
+            value_check = cls.lambda_checks.get(attribute)
+            item_check = cls.lambda_checks.get(f'__{attribute}')
+            dict_checks = cls.lambda_checks.get(f'_{attribute}')
+            if value_check or item_check or dict_checks:
+                checks.append((attribute, value_check, item_check, dict_checks))
+
+        def check_value(value_check, item_check, dict_checks, value):
+            if value_check:
+                return value_check(value)
+
+            if item_check and isinstance(value, list):
+                return all(item_check(item) for item in value)
+
+            if dict_checks and isinstance(value, dict):
+                for key, check in dict_checks.items():
+                    try:
+                        if key in value and not check(value[key]):
+                            return False
+                    except AttributeError:
+                        # Values of other types are not checked by setter either
+                        pass
+
+            return True
+
+        def validate(json_input):
+            errors = []
+            for attribute, value_check, item_check, dict_checks in checks:
+                if attribute not in json_input:
+                    continue
+
+                try:
+                    if not check_value(value_check,
+                                       item_check,
+                                       dict_checks,
+                                       json_input[attribute]):
+                        errors.append(f'Invalid value of "{attribute}"')
+                except Exception as ex:  # pylint: disable=broad-exception-caught
+                    errors.append(f'Invalid value of "{attribute}": {ex}')
+
+            return errors
+
+        return validate
@@ -1,7 +1,9 @@
 """
 Module that contains RelVal class
 """
+import json
 from copy import deepcopy
+from hashlib import sha256
 from core.model.model_base import ModelBase
 from core.model.relval_step import RelValStep
 from core_lib.utils.common_utils import run_commands_in_cmsenv
@@ -51,6 +53,8 @@ class RelVal(ModelBase):
         'status': 'new',
         # Steps of RelVal
         'steps': [],
+        # Submission stage that RelVal is waiting in or processed by
+        'submission_stage': '',
         # Time per event in seconds
         'time_per_event': 1.0,
         # Workflow ID
@@ -75,18 +79,31 @@ class RelVal(ModelBase):
         'memory': ModelBase.lambda_check('memory'),
         '__output_datasets': ModelBase.lambda_check('dataset'),
         'sample_tag': ModelBase.lambda_check('sample_tag'),
-        'scram_arch': lambda s: not s or ModelBase.lambda_check('scram_arch')(s),
+        'scram_arch': ModelBase.optional_check(ModelBase.lambda_check('scram_arch')),
         'size_per_event': lambda spe: spe > 0.0,
         'status': lambda status: status in ('new', 'approved', 'submitting',
                                             'submitted', 'done', 'archived'),
         'steps': lambda s: len(s) > 0,
+        'submission_stage': lambda stage: stage in ('', 'config', 'inject',
+                                                    'approve', 'finalize'),
         'time_per_event': lambda tpe: tpe > 0.0,
         'workflow_id': lambda wf: wf >= 0,
-        'workflow_name': lambda wn: ModelBase.matches_regex(wn, '[a-zA-Z0-9_\\-]{0,99}')
+        'workflow_name': ModelBase.regex_check('[a-zA-Z0-9_\\-]{0,99}')
     }
 
-    def __init__(self, json_input=None, check_attributes=True):
-        if json_input:
+    def __init__(self, json_input=None, check_attributes=True, read_only=False):
+        self.__step_graph = None
+        self.__raw_steps = None
+        self.__shared = False
+        raw_steps = None
+        if json_input and read_only:
+            # Wrap stored document without copying or validating it
+            # Steps are built on first access
+            json_input = dict(json_input)
+            raw_steps = json_input.get('steps', [])
+            json_input['steps'] = []
+            check_attributes = False
+        elif json_input:
             json_input = deepcopy(json_input)
             step_objects = []
             for step_index, step_json in enumerate(json_input.get('steps', [])):
@@ -99,51 +116,161 @@ class RelVal(ModelBase):
 
             json_input['steps'] = step_objects
 
-            if not isinstance(json_input['workflow_id'], (float, int)):
-                json_input['workflow_id'] = float(json_input['workflow_id'])
+        if json_input and not isinstance(json_input['workflow_id'], (float, int)):
+            json_input['workflow_id'] = float(json_input['workflow_id'])
 
         ModelBase.__init__(self, json_input, check_attributes)
+        if raw_steps is not None:
+            self.__raw_steps = raw_steps
+            self.__shared = True
 
-    def get_cmsdrivers(self, for_submission=False):
+    def __build_steps(self):
+        """
+        Build step objects of a read-only RelVal
+        """
+        raw_steps = self.__raw_steps
+        self.__raw_steps = None
+        steps = [RelValStep(json_input=step_json,
+                            parent=self,
+                            check_attributes=False,
+                            read_only=True) for step_json in raw_steps]
+        self.set_unchanged('steps', steps)
+
+    def __unshare(self):
+        """
+        Copy values that are shared with the stored document before the first change
+        """
+        self.__shared = False
+        if self.__raw_steps is not None:
+            self.__build_steps()
+
+        for attribute in self.schema():
+            value = ModelBase.get(self, attribute)
+            if attribute != 'steps' and isinstance(value, (dict, list)):
+                self.set_unchanged(attribute, deepcopy(value))
+
+    def get(self, attribute):
+        """
+        Return attribute value, steps are built when they are first needed
+        """
+        if attribute == 'steps' and self.__raw_steps is not None:
+            self.__build_steps()
+
+        return ModelBase.get(self, attribute)
+
+    def set(self, attribute, value=None):
+        """
+        Set attribute value, shared values are copied before the first change
+        """
+        if self.__shared:
+            self.__unshare()
+
+        if attribute == 'steps':
+            # Step graph must be rebuilt for new steps
+            self.clear_step_graph()
+
+        return ModelBase.set(self, attribute, value)
+
+    def add_history(self, action, value, user, timestamp=None):
+        """
+        Add history entry, shared values are copied before the first change
+        """
+        if self.__shared:
+            self.__unshare()
+
+        return ModelBase.add_history(self, action, value, user, timestamp)
+
+    def get_json(self):
+        """
+        Return RelVal as a dictionary, steps of read-only RelVal are built
+        first, so they get schema defaults and normalized values
+        """
+        if self.__raw_steps is not None:
+            self.__build_steps()
+
+        return ModelBase.get_json(self)
+
+    def get_step_graph(self):
+        """
+        Return step graph - a dictionary of nodes keyed by id of step object
+        Each node has step index and config file name; input step index and
+        input eventcontent are added by the step when they are first needed
+        Graph is built once and dropped when steps are set
+        """
+        if self.__step_graph is None:
+            step_graph = {}
+            for index, step in enumerate(self.get('steps')):
+                if step.get_step_type() == 'input_file':
+                    config_file_name = None
+                else:
+                    config_file_name = f'step_{index + 1}_cfg'
+
+                step_graph[id(step)] = {'index': index,
+                                        'config_file_name': config_file_name}
+
+            self.__step_graph = step_graph
+
+        return self.__step_graph
+
+    def clear_step_graph(self):
+        """
+        Drop step graph, so it is built again when it is needed, e.g. after
+        steps or attributes of a step were changed
+        """
+        self.__step_graph = None
+
+    def get_step_node(self, step):
+        """
+        Return step graph node of given step
+        """
+        node = self.get_step_graph().get(id(step))
+        if node is None:
+            raise AssertionError(f'Step is not a child of {self.get_prepid()}')
+
+        return node
+
+    def get_cmsdrivers(self, for_submission=False, skip_configs=None):
         """
         Get all cmsDriver commands for this RelVal
+        Steps whose config file names are in skip configs are left out
         """
-        prepid = self.get_prepid()
         bash = ['#!/bin/bash',
                 '']
 
+        for cmssw, scram_arch, commands in self.get_cmsdriver_commands(for_submission,
+                                                                       skip_configs):
+            bash += run_commands_in_cmsenv(commands, cmssw, scram_arch).split('\n')
+
+        return '\n'.join(bash)
+
+    def get_cmsdriver_commands(self, for_submission=False, skip_configs=None):
+        """
+        Get cmsDriver commands of this RelVal grouped by consecutive steps that
+        run in the same environment - list of (CMSSW release, scram arch, commands)
+        Steps whose config file names are in skip configs are left out
+        """
         steps = self.get('steps')
         previous_cmssw = None
         previous_scram = None
         fragment = self.get('fragment')
+        groups = []
         commands = []
         for index, step in enumerate(steps):
             if index == 0 and step.get_step_type() == 'input_file' and for_submission:
                 continue
 
+            if skip_configs and step.get_config_file_name() in skip_configs:
+                continue
+
             step_cmssw = step.get_release()
             scram_arch = step.get_scram_arch()
 
             if commands and (step_cmssw != previous_cmssw or scram_arch != previous_scram):
-                bash += run_commands_in_cmsenv(commands, previous_cmssw, previous_scram).split('\n')
+                groups.append((previous_cmssw, previous_scram, commands))
                 commands = []
 
-            custom_fragment_name = None
-            if index == 0 and fragment and step.get_step_type() == 'cms_driver':
-                # If this is the first step, is cmsDriver and fragment is present,
-                # then add the fragment and rebuild CMSSW
-                fragment_name = step.get('driver')['fragment_name']
-                if not fragment_name:
-                    fragment_name = f'{prepid}-{index}-fragment'
-                else:
-                    # Sometimes there is a full path
-                    fragment_name = fragment_name.split('/')[-1]
-                    fragment_name = f'custom-{fragment_name}'
-
-                custom_fragment_name = f'Configuration/GenProduction/python/{fragment_name}'
-                if not custom_fragment_name.endswith('.py'):
-                    custom_fragment_name += '.py'
-
+            custom_fragment_name = self.get_custom_fragment_name(step)
+            if custom_fragment_name:
                 commands += self.get_fragment_command(fragment, custom_fragment_name).split('\n')
                 commands += ['']
 
@@ -155,9 +282,58 @@ class RelVal(ModelBase):
 
         if commands:
             commands += ['']
-            bash += run_commands_in_cmsenv(commands, previous_cmssw, previous_scram).split('\n')
+            groups.append((previous_cmssw, previous_scram, commands))
 
-        return '\n'.join(bash)
+        return groups
+
+    def get_custom_fragment_name(self, step):
+        """
+        Return custom fragment file name if this is the first step, it is
+        cmsDriver and fragment is present, otherwise None
+        """
+        if not self.get('fragment') or step.get_step_type() != 'cms_driver':
+            return None
+
+        index = step.get_index_in_parent()
+        if index != 0:
+            return None
+
+        fragment_name = step.get('driver')['fragment_name']
+        if not fragment_name:
+            fragment_name = f'{self.get_prepid()}-{index}-fragment'
+        else:
+            # Sometimes there is a full path
+            fragment_name = fragment_name.split('/')[-1]
+            fragment_name = f'custom-{fragment_name}'
+
+        custom_fragment_name = f'Configuration/GenProduction/python/{fragment_name}'
+        if not custom_fragment_name.endswith('.py'):
+            custom_fragment_name += '.py'
+
+        return custom_fragment_name
+
+    def get_config_keys(self):
+        """
+        Return a dictionary of config file name -> key of the config
+        Key is a hash of everything the generated config depends on: cmsDriver
+        command used for submission, release, scram arch and fragment
+        """
+        keys = {}
+        for step in self.get('steps'):
+            config_name = step.get_config_file_name()
+            if not config_name:
+                continue
+
+            custom_fragment_name = self.get_custom_fragment_name(step)
+            key_inputs = [config_name,
+                          step.get_release(),
+                          step.get_scram_arch(),
+                          step.get_command(custom_fragment=custom_fragment_name,
+                                           for_submission=True),
+                          self.get('fragment') if custom_fragment_name else '']
+            keys[config_name] = sha256(json.dumps(key_inputs).encode('utf-8')).hexdigest()
+
+        return keys
 
     def get_fragment_command(self, fragment, fragment_file):
         """
@@ -6,7 +6,7 @@ import weakref
 from copy import deepcopy
 
 from core.model.model_base import ModelBase
-from core_lib.utils.common_utils import get_scram_arch
+from core.utils.scram_arch import get_scram_arch
 
 
 class RelValStep(ModelBase):
@@ -80,11 +80,11 @@ class RelValStep(ModelBase):
     }
 
     lambda_checks = {
-        'cmssw_release': lambda cmssw: not cmssw or ModelBase.lambda_check('cmssw_release')(cmssw),
-        'config_id': lambda cid: ModelBase.matches_regex(cid, '[a-f0-9]{0,50}'),
+        'cmssw_release': ModelBase.optional_check(ModelBase.lambda_check('cmssw_release')),
+        'config_id': ModelBase.regex_check('[a-f0-9]{0,50}'),
         '_driver': {
-            'conditions': lambda c: not c or ModelBase.matches_regex(c, '[a-zA-Z0-9_]{0,50}'),
-            'era': lambda e: not e or ModelBase.matches_regex(e, '[a-zA-Z0-9_\\,]{0,50}'),
+            'conditions': ModelBase.optional_check(ModelBase.regex_check('[a-zA-Z0-9_]{0,50}')),
+            'era': ModelBase.optional_check(ModelBase.regex_check('[a-zA-Z0-9_\\,]{0,50}')),
             'scenario': lambda s: not s or s in {'pp', 'cosmics', 'nocoll', 'HeavyIons'},
         },
         '_gpu': {
@@ -93,41 +93,49 @@ class RelValStep(ModelBase):
             'gpu_memory': lambda m: m == '' or int(m) > 0,
         },
         '_input': {
-            'dataset': lambda ds: not ds or ModelBase.lambda_check('dataset')(ds),
-            'label': lambda l: not l or ModelBase.lambda_check('label')(l),
+            'dataset': ModelBase.optional_check(ModelBase.lambda_check('dataset')),
+            'label': ModelBase.optional_check(ModelBase.lambda_check('label')),
             'events': lambda m: m == '' or (m.isnumeric() and int(m) > 0),
         },
         'lumis_per_job': lambda l: l == '' or int(l) > 0,
-        'name': lambda n: ModelBase.matches_regex(n, '[a-zA-Z0-9_\\-]{1,150}'),
-        'scram_arch': lambda s: not s or ModelBase.lambda_check('scram_arch')(s),
+        'name': ModelBase.regex_check('[a-zA-Z0-9_\\-]{1,150}'),
+        'scram_arch': ModelBase.optional_check(ModelBase.lambda_check('scram_arch')),
     }
 
-    def __init__(self, json_input=None, parent=None, check_attributes=True):
+    def __init__(self, json_input=None, parent=None, check_attributes=True, read_only=False):
+        self.__shared = False
         if json_input:
-            json_input = deepcopy(json_input)
-            # Remove -- from argument names
-            schema = self.schema()
+            if read_only:
+                # Nested values are shared with the stored document until first change
+                json_input = dict(json_input)
+            else:
+                json_input = deepcopy(json_input)
+
+            # Schema is only read here, copy just the defaults that are used
+            schema = self._ModelBase__schema
             if json_input.get('input', {}).get('dataset'):
-                json_input['driver'] = schema.get('driver')
-                json_input['gpu'] = schema.get('gpu')
+                json_input['driver'] = deepcopy(schema['driver'])
+                json_input['gpu'] = deepcopy(schema['gpu'])
                 json_input['gpu']['requires'] = 'forbidden'
-                step_input = json_input['input']
+                step_input = dict(json_input['input'])
+                json_input['input'] = step_input
 
                 for key, default_value in schema['input'].items():
                     if key not in step_input:
-                        step_input[key] = default_value
+                        step_input[key] = deepcopy(default_value)
             else:
+                # Remove -- from argument names
                 json_input['driver'] = {k.lstrip('-'): v for k, v in json_input['driver'].items()}
-                json_input['input'] = schema.get('input')
+                json_input['input'] = deepcopy(schema['input'])
 
                 if json_input.get('gpu', {}).get('requires') not in ('optional', 'required'):
-                    json_input['gpu'] = schema.get('gpu')
+                    json_input['gpu'] = deepcopy(schema['gpu'])
                     json_input['gpu']['requires'] = 'forbidden'
 
                 driver = json_input['driver']
                 for key, default_value in schema['driver'].items():
                     if key not in driver:
-                        driver[key] = default_value
+                        driver[key] = deepcopy(default_value)
 
                 if driver.get('data') and driver.get('mc'):
                     raise AssertionError('Both --data and --mc are not allowed in the same step')
@@ -141,6 +149,25 @@ class RelValStep(ModelBase):
         else:
             self.parent = None
 
+        self.__shared = bool(json_input) and read_only
+
+    def set(self, attribute, value=None):
+        if self.__shared:
+            # Copy values that are shared with the stored document before the first change
+            self.__shared = False
+            for shared_attribute in ('driver', 'gpu', 'input'):
+                value_copy = deepcopy(ModelBase.get(self, shared_attribute))
+                self.set_unchanged(shared_attribute, value_copy)
+
+        parent = self.parent() if getattr(self, 'parent', None) else None
+        if parent is not None:
+            # Steps are saved as a part of the parent and nodes of parent's
+            # step graph depend on attributes of steps
+            parent.mark_changed('steps')
+            parent.clear_step_graph()
+
+        return ModelBase.set(self, attribute, value)
+
     def get_prepid(self):
         return 'RelValStep'
 
@@ -169,11 +196,7 @@ class RelValStep(ModelBase):
         """
         Return step's index in parent's list of steps
         """
-        for index, step in enumerate(self.parent().get('steps')):
-            if self == step:
-                return index
-
-        raise AssertionError(f'Step is not a child of {self.parent().get_prepid()}')
+        return self.parent().get_step_node(self)['index']
 
     def get_step_type(self):
         """
@@ -383,9 +406,19 @@ class RelValStep(ModelBase):
     def get_input_step_index(self):
         """
         Get index of step that will be used as input step for current step
+        Index is looked up once and then kept in parent's step graph
+        """
+        node = self.parent().get_step_node(self)
+        if 'input_step_index' not in node:
+            node['input_step_index'] = self.__find_input_step_index(node['index'])
+
+        return node['input_step_index']
+
+    def __find_input_step_index(self, index):
+        """
+        Scan steps before given index and find the one that is input for current step
         """
         all_steps = self.parent().get('steps')
-        index = self.get_index_in_parent()
         this_is_harvesting = self.has_step('HARVESTING')
         self_step = self.get('driver')['step']
         self_dataset_name = self.get('input')['dataset']
@@ -427,12 +460,24 @@ class RelValStep(ModelBase):
     def get_input_eventcontent(self, input_step=None):
         """
         Return which eventcontent should be used as input for current RelVal step
+        If input step is not given, it is looked up once and then kept in
+        parent's step graph
         """
-        if input_step is None:
+        if input_step is not None:
+            return self.__find_input_eventcontent(input_step)
+
+        node = self.parent().get_step_node(self)
+        if 'input_eventcontent' not in node:
             all_steps = self.parent().get('steps')
-            input_step_index = self.get_input_step_index()
-            input_step = all_steps[input_step_index]
+            input_step = all_steps[self.get_input_step_index()]
+            node['input_eventcontent'] = self.__find_input_eventcontent(input_step)
+
+        return node['input_eventcontent']
 
+    def __find_input_eventcontent(self, input_step):
+        """
+        Pick eventcontent of given input step that should be used as input
+        """
         this_is_harvesting = self.has_step('HARVESTING')
         self_step = self.get('driver')['step']
         this_is_alca = self_step and self_step[0].startswith('ALCA')
@@ -460,11 +505,7 @@ class RelValStep(ModelBase):
         """
         Return config file name without extension
         """
-        if self.get_step_type() == 'input_file':
-            return None
-
-        index = self.get_index_in_parent()
-        return f'step_{index + 1}_cfg'
+        return self.parent().get_step_node(self)['config_file_name']
 
     def get_relval_events(self):
         """
@@ -68,7 +68,7 @@ class Ticket(ModelBase):
     }
 
     lambda_checks = {
-        'prepid': lambda prepid: ModelBase.matches_regex(prepid, '[a-zA-Z0-9_\\-]{1,75}'),
+        'prepid': ModelBase.regex_check('[a-zA-Z0-9_\\-]{1,75}'),
         'batch_name': ModelBase.lambda_check('batch_name'),
         'cmssw_release': ModelBase.lambda_check('cmssw_path'),  # Allow path
         'cpu_cores': ModelBase.lambda_check('cpu_cores'),
@@ -83,10 +83,10 @@ class Ticket(ModelBase):
         'matrix': ModelBase.lambda_check('matrix'),
         'memory': ModelBase.lambda_check('memory'),
         'n_streams': lambda streams: 0 <= streams <= 16,
-        'rewrite_gt_string': lambda rgs: ModelBase.matches_regex(rgs, '[a-zA-Z0-9\\.\\-_]{0,199}'),
+        'rewrite_gt_string': ModelBase.regex_check('[a-zA-Z0-9\\.\\-_]{0,199}'),
         'sample_tag': ModelBase.lambda_check('sample_tag'),
         'status': lambda status: status in ('new', 'done'),
-        'scram_arch': lambda s: not s or ModelBase.lambda_check('scram_arch')(s),
+        'scram_arch': ModelBase.optional_check(ModelBase.lambda_check('scram_arch')),
         'workflow_ids': lambda wf: len(wf) > 0,
         '__workflow_ids': lambda wf: wf > 0,
 
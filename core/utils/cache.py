@@ -0,0 +1,113 @@
+"""
+Module that contains a thread safe in-memory cache with expiring entries
+"""
+import time
+from threading import Lock
+
+
+class TTLCache:
+    """
+    Thread safe cache where each entry expires after time-to-live seconds
+    If maximum size is set, least recently used entries are evicted first
+    Each cache is registered by name, so statistics of all of them can be reported
+    """
+
+    # All caches by name
+    __caches = {}
+    __caches_lock = Lock()
+
+    def __init__(self, name, ttl, max_size=0):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Key -> (expiration time, value), ordered from least to most recently used
+        self.__entries = {}
+        self.__lock = Lock()
+        with TTLCache.__caches_lock:
+            TTLCache.__caches[name] = self
+
+    def get(self, key, default=None):
+        """
+        Return cached value or default if key is not in cache or it is expired
+        """
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return default
+
+            # Move to the end as most recently used
+            self.__entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Add or replace a value in the cache, optionally with custom time-to-live
+        """
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (expires, value)
+            if self.max_size and len(self.__entries) > self.max_size:
+                self.__remove_expired()
+                while len(self.__entries) > self.max_size:
+                    del self.__entries[next(iter(self.__entries))]
+                    self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        Remove a single key or, if key is not given, all entries from the cache
+        """
+        with self.__lock:
+            if key is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop(key, None)
+
+    def __remove_expired(self):
+        """
+        Remove all expired entries, lock must be held by the caller
+        """
+        now = time.time()
+        expired = [key for key, (expires, _) in self.__entries.items() if expires <= now]
+        for key in expired:
+            del self.__entries[key]
+
+        self.evictions += len(expired)
+
+    def get_stats(self):
+        """
+        Return size, time-to-live and hit/miss counters of the cache
+        """
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.__entries),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0}
+
+    @classmethod
+    def get_cache(cls, name):
+        """
+        Return a cache with given name or None if it does not exist
+        """
+        with cls.__caches_lock:
+            return cls.__caches.get(name)
+
+    @classmethod
+    def get_all_stats(cls):
+        """
+        Return statistics of all caches by name
+        """
+        with cls.__caches_lock:
+            caches = dict(cls.__caches)
+
+        return {name: cache.get_stats() for name, cache in sorted(caches.items())}
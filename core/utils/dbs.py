@@ -0,0 +1,77 @@
+"""
+Module that contains cached DBS dataset lookups
+"""
+from concurrent.futures import ThreadPoolExecutor
+from core_lib.utils.common_utils import dbs_datasetlist
+from core.utils.cache import TTLCache
+
+
+# Access type of a dataset might change, e.g. when it is invalidated
+access_type_cache = TTLCache('dbs_access_types', ttl=300, max_size=20000)
+# New datasets matching a wildcard appear rarely
+dataset_name_cache = TTLCache('dbs_dataset_names', ttl=3600, max_size=5000)
+
+
+def get_access_types(datasets):
+    """
+    Return a dictionary of dataset names and their access types
+    Only datasets that are not in the cache are fetched from DBS
+    Datasets that could not be found are not in the dictionary
+    """
+    access_types = {}
+    missing = set()
+    for dataset in set(datasets):
+        access_type = access_type_cache.get(dataset)
+        if access_type is None:
+            missing.add(dataset)
+        else:
+            access_types[dataset] = access_type
+
+    if missing:
+        for dataset in dbs_datasetlist(list(missing)):
+            dataset_name = dataset['dataset']
+            if dataset_name not in missing:
+                continue
+
+            access_type = dataset.get('dataset_access_type', 'unknown')
+            access_type_cache.set(dataset_name, access_type)
+            access_types[dataset_name] = access_type
+
+    return access_types
+
+
+def get_dataset_names(dataset_pattern):
+    """
+    Return a sorted list of dataset names that match a name or a wildcard pattern
+    Empty results are not cached, so datasets that appear later will be found
+    """
+    dataset_names = dataset_name_cache.get(dataset_pattern)
+    if dataset_names is None:
+        dataset_names = sorted(x['dataset'] for x in dbs_datasetlist(dataset_pattern))
+        if dataset_names:
+            dataset_name_cache.set(dataset_pattern, dataset_names)
+
+    return list(dataset_names)
+
+
+def get_dataset_names_for_patterns(dataset_patterns, max_workers=8):
+    """
+    Return a dictionary of dataset patterns and sorted lists of matching dataset names
+    Each distinct pattern is looked up once, patterns are looked up concurrently
+    """
+    dataset_patterns = sorted(set(dataset_patterns))
+    if not dataset_patterns:
+        return {}
+
+    max_workers = min(len(dataset_patterns), max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dataset_names = executor.map(get_dataset_names, dataset_patterns)
+        return dict(zip(dataset_patterns, dataset_names))
+
+
+def invalidate_dbs_cache(dataset=None):
+    """
+    Remove a dataset or pattern from DBS caches or, if it is not given, clear the caches
+    """
+    access_type_cache.invalidate(dataset)
+    dataset_name_cache.invalidate(dataset)
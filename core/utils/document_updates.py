@@ -0,0 +1,109 @@
+"""
+Module that saves only changed attributes of model objects
+"""
+from uuid import uuid4
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def get_update(obj):
+    """
+    Return (query, update) of changed attributes and new history entries of an
+    object, update is applied only if stored document has the same version as
+    the one object was loaded from
+    Return None if nothing was changed
+    """
+    update = obj.get_changes()
+    if update is None:
+        return None
+
+    version = obj.get_version()
+    if version:
+        query = {'_id': obj.get('_id'), '_version': version}
+    else:
+        # Documents that were never updated this way do not have a version
+        query = {'_id': obj.get('_id'), '_version': {'$in': [0, None]}}
+
+    update.setdefault('$set', {})['_version'] = version + 1
+    return query, update
+
+
+def save_changes(database, obj):
+    """
+    Save changed attributes and new history entries of an object to database
+    Raise AssertionError if document was changed since the object was loaded
+    """
+    query_update = get_update(obj)
+    if query_update is None:
+        return
+
+    result = database.collection.update_one(*query_update)
+    if not result.matched_count:
+        raise AssertionError(f'{obj.get_prepid()} was changed in the meantime, please try again')
+
+    obj.clear_changes(obj.get_version() + 1)
+
+
+def set_next_version(old_obj, new_obj):
+    """
+    Give an object that replaces the whole stored document the next version,
+    so objects that were loaded before cannot save their changes over it
+    Raise AssertionError if object was edited from an older version
+    """
+    version = old_obj.get_version()
+    if new_obj.get_version() != version:
+        raise AssertionError(f'{old_obj.get_prepid()} was changed in the meantime, '
+                             'please try again')
+
+    new_obj.set_version(version + 1)
+
+
+def bulk_save_changes(database, objects):
+    """
+    Save changes of multiple objects with a single bulk write
+    Return a dictionary of prepids and errors of objects that were not saved
+    """
+    # Documents updated by this write are marked with a token that is unique
+    # to it, so they can be told apart from documents updated by other writers
+    write_token = uuid4().hex
+    requests = []
+    changed = []
+    for obj in objects:
+        query_update = get_update(obj)
+        if query_update is not None:
+            query, update = query_update
+            update['$set']['_write_token'] = write_token
+            requests.append(UpdateOne(query, update))
+            changed.append(obj)
+
+    if not requests:
+        return {}
+
+    errors = {}
+    try:
+        result = database.collection.bulk_write(requests, ordered=False)
+        matched_count = result.matched_count
+    except BulkWriteError as ex:
+        for write_error in ex.details.get('writeErrors', []):
+            prepid = changed[write_error['index']].get_prepid()
+            errors[prepid] = write_error.get('errmsg', 'Could not save')
+
+        matched_count = ex.details.get('nMatched', 0)
+
+    if matched_count + len(errors) < len(changed):
+        # Find objects whose document was not updated by this write
+        ids = [obj.get('_id') for obj in changed]
+        saved_ids = {document['_id']
+                     for document in database.collection.find({'_id': {'$in': ids},
+                                                               '_write_token': write_token},
+                                                              {'_id': 1})}
+        for obj in changed:
+            prepid = obj.get_prepid()
+            if prepid not in errors and obj.get('_id') not in saved_ids:
+                errors[prepid] = f'{prepid} was changed in the meantime, please try again'
+
+    for obj in changed:
+        if obj.get_prepid() not in errors:
+            obj.clear_changes(obj.get_version() + 1)
+
+    return errors
@@ -0,0 +1,284 @@
+"""
+Module that contains a stage queue persisted in the database
+"""
+import os
+import time
+import socket
+import logging
+from collections import Counter
+from threading import Condition, Lock, Thread
+from pymongo import ReplaceOne
+from core_lib.database.database import Database
+from core.utils.pipeline import Retry
+
+
+class DurableQueue:
+    """
+    Queue of a single pipeline stage kept in a database collection, so queued
+    items survive restarts and can be processed by workers of several instances
+    Each job is one document whose stage attribute is a checkpoint of the job
+    Worker leases documents, lease is extended while the job is processed and
+    the job becomes available again if the lease expires, e.g. instance died
+    """
+
+    # Seconds for which leased job is reserved for the worker
+    lease_time = 300
+    # Seconds between checks for jobs added by other instances
+    poll_interval = 5
+    # Identifier of this instance
+    owner = f'{socket.gethostname()}-{os.getpid()}'
+    # Names of jobs leased by this instance and lease keeper thread
+    __leased = set()
+    __leased_lock = Lock()
+    __lease_keeper = None
+
+    def __init__(self, collection_name, stage):
+        self.collection_name = collection_name
+        self.stage = stage
+        self.logger = logging.getLogger()
+        self.__condition = Condition()
+        self.__start_lease_keeper()
+
+    def get_collection(self):
+        """
+        Return database collection of the queue
+        """
+        return Database(self.collection_name).collection
+
+    def create_indexes(self):
+        """
+        Create index used to find available jobs of a stage
+        """
+        self.get_collection().create_index([('stage', 1), ('status', 1), ('added', 1)])
+
+    def put(self, job_name, item, key, delay=0, replace=True):
+        """
+        Put an item to the queue of this stage, optionally make it available
+        only after delay seconds
+        If replace is False, job is added only if it is not in the queue yet
+        """
+        document = self.__new_document(job_name, item, key, time.time(), delay)
+        collection = self.get_collection()
+        if replace:
+            collection.replace_one({'_id': job_name}, document, upsert=True)
+        else:
+            collection.update_one({'_id': job_name}, {'$setOnInsert': document}, upsert=True)
+
+        self.notify()
+
+    def put_many(self, jobs):
+        """
+        Put a list of (job name, item, group key) tuples to the queue of this
+        stage with a single database request
+        """
+        if not jobs:
+            return
+
+        now = time.time()
+        requests = [ReplaceOne({'_id': job_name},
+                               self.__new_document(job_name, item, key, now),
+                               upsert=True)
+                    for job_name, item, key in jobs]
+        self.get_collection().bulk_write(requests, ordered=False)
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def __new_document(self, job_name, item, key, now, delay=0):
+        """
+        Return database document of a newly queued job
+        """
+        return {'_id': job_name,
+                'stage': self.stage,
+                'item': item,
+                'group': key,
+                'status': 'queued',
+                'lease_owner': '',
+                'lease_expires': 0,
+                'added': now + delay,
+                'updated': now}
+
+    def notify(self):
+        """
+        Wake up a worker that is waiting for jobs
+        """
+        with self.__condition:
+            self.__condition.notify()
+
+    def __available_query(self, now, include_delayed=False):
+        """
+        Return query of jobs in this stage that are queued or have expired lease
+        Jobs that were put with delay are included only if include delayed is True
+        """
+        query = {'stage': self.stage,
+                 '$or': [{'status': 'queued'},
+                         {'status': 'leased', 'lease_expires': {'$lt': now}}]}
+        if not include_delayed:
+            query['added'] = {'$lte': now}
+
+        return query
+
+    def take(self, group_size, group_wait):
+        """
+        Wait for a ready job and lease it together with up to group size
+        available jobs of the same group
+        """
+        while True:
+            jobs = self.__lease_ready(group_size, group_wait)
+            if jobs:
+                return jobs
+
+            with self.__condition:
+                self.__condition.wait(self.poll_interval)
+
+    def __lease_ready(self, group_size, group_wait):
+        """
+        Lease a ready job and jobs of its group, return empty list if there is
+        no ready job
+        """
+        now = time.time()
+        collection = self.get_collection()
+        candidates = list(collection.find(self.__available_query(now),
+                                          {'_id': 1, 'group': 1, 'added': 1}).sort('added', 1))
+        group_sizes = Counter(self.__hashable(job.get('group')) for job in candidates)
+        for candidate in candidates:
+            key = self.__hashable(candidate.get('group'))
+            if key is not None and group_sizes[key] < group_size:
+                if candidate['added'] + group_wait > now:
+                    continue
+
+            job = self.__lease(candidate['_id'], now)
+            if job is None:
+                # Another worker was faster
+                continue
+
+            jobs = [job]
+            if key is not None:
+                for other in candidates:
+                    if len(jobs) >= group_size:
+                        break
+
+                    if other is candidate or self.__hashable(other.get('group')) != key:
+                        continue
+
+                    other_job = self.__lease(other['_id'], now)
+                    if other_job is not None:
+                        jobs.append(other_job)
+
+            return jobs
+
+        return []
+
+    @staticmethod
+    def __hashable(key):
+        """
+        Return group key that can be compared and counted, lists are stored
+        in database instead of tuples
+        """
+        return tuple(key) if isinstance(key, list) else key
+
+    def __lease(self, job_name, now):
+        """
+        Lease a single available job, return (job name, item, group key, time added)
+        or None
+        """
+        query = self.__available_query(now)
+        query['_id'] = job_name
+        document = self.get_collection().find_one_and_update(
+            query,
+            {'$set': {'status': 'leased',
+                      'lease_owner': self.owner,
+                      'lease_expires': now + self.lease_time,
+                      'updated': now}})
+        if document is None:
+            return None
+
+        with self.__leased_lock:
+            DurableQueue.__leased.add(job_name)
+
+        return (job_name,
+                document['item'],
+                self.__hashable(document.get('group')),
+                document['added'])
+
+    def done(self, job, result, next_stage):
+        """
+        Move job to the queue of the next stage, put it back to this stage if it
+        should be retried or remove it from the queue if result is None or
+        there is no next stage
+        """
+        job_name = job[0]
+        collection = self.get_collection()
+        now = time.time()
+        try:
+            query = {'_id': job_name, 'stage': self.stage, 'lease_owner': self.owner}
+            if isinstance(result, Retry):
+                collection.update_one(query,
+                                      {'$set': {'item': result.item,
+                                                'status': 'queued',
+                                                'lease_owner': '',
+                                                'lease_expires': 0,
+                                                'added': now + result.delay,
+                                                'updated': now}})
+            elif result is not None and next_stage is not None:
+                collection.update_one(query,
+                                      {'$set': {'stage': next_stage.name,
+                                                'item': result,
+                                                'group': next_stage.get_key(result),
+                                                'status': 'queued',
+                                                'lease_owner': '',
+                                                'lease_expires': 0,
+                                                'added': now,
+                                                'updated': now}})
+                next_stage.queue.notify()
+            else:
+                collection.delete_one(query)
+        finally:
+            with self.__leased_lock:
+                DurableQueue.__leased.discard(job_name)
+
+    def get_names(self):
+        """
+        Return names of jobs waiting in this stage, including delayed ones
+        """
+        query = self.__available_query(time.time(), include_delayed=True)
+        jobs = self.get_collection().find(query, {'_id': 1}).sort('added', 1)
+        return [job['_id'] for job in jobs]
+
+    def get_all_names(self):
+        """
+        Return names of all jobs in the queue collection in any stage or status
+        """
+        return set(self.get_collection().distinct('_id'))
+
+    def __start_lease_keeper(self):
+        """
+        Start a thread that extends leases of jobs that are being processed
+        """
+        with self.__leased_lock:
+            if DurableQueue.__lease_keeper is not None:
+                return
+
+            DurableQueue.__lease_keeper = Thread(target=self.__keep_leases,
+                                                 name='queue-lease-keeper',
+                                                 daemon=True)
+            DurableQueue.__lease_keeper.start()
+
+    def __keep_leases(self):
+        """
+        Periodically extend leases of jobs leased by this instance
+        """
+        while True:
+            time.sleep(self.lease_time / 3)
+            with self.__leased_lock:
+                leased = list(DurableQueue.__leased)
+
+            if not leased:
+                continue
+
+            try:
+                now = time.time()
+                self.get_collection().update_many(
+                    {'_id': {'$in': leased}, 'lease_owner': self.owner, 'status': 'leased'},
+                    {'$set': {'lease_expires': now + self.lease_time, 'updated': now}})
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                self.logger.error('Error extending queue leases: %s', ex)
@@ -0,0 +1,182 @@
+"""
+Module that sends email notifications in the background
+"""
+import time
+import atexit
+import logging
+from itertools import count
+from threading import Condition, Lock, Thread
+from environment import NOTIFICATION_DIGEST_WINDOW
+from core.utils.cache import TTLCache
+from core.utils.emailer import Emailer
+
+
+# Recipients by users in object history
+recipients_cache = TTLCache('email_recipients', ttl=600, max_size=5000)
+
+
+class Notifier:
+    """
+    Outbound notification queue that is drained by a background thread
+    Notifications of the same campaign to the same recipient that are queued
+    within digest window are sent as a single digest email
+    All instances share the same queue
+    Queue is kept only in memory, it is flushed when application exits
+    normally, but notifications that are still waiting are lost if the
+    process is killed
+    """
+
+    # Seconds to wait for more notifications of the same recipient and campaign
+    digest_window = NOTIFICATION_DIGEST_WINDOW
+    # Shared state of all instances
+    __condition = Condition()
+    # (recipient, campaign) -> list of (event id, time added, subject, text)
+    __buckets = {}
+    __event_ids = count(1)
+    __sender = None
+    __stats_lock = Lock()
+    __stats = {
+        'queued': 0,
+        'emails_sent': 0,
+        'digests_sent': 0,
+        'send_failures': 0,
+    }
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+
+    def get_recipients(self, obj):
+        """
+        Return recipients of notifications about an object, recipients depend
+        only on users in object history, so they are cached by these users
+        """
+        users = tuple(sorted({entry.get('user', '') for entry in obj.get('history')}))
+        recipients = recipients_cache.get(users)
+        if recipients is None:
+            recipients = sorted(set(Emailer().get_recipients(obj)))
+            recipients_cache.set(users, recipients)
+
+        return list(recipients)
+
+    def notify(self, obj, campaign, subject, text):
+        """
+        Queue a notification about an object for all its recipients
+        Text should not include greeting, it is added when email is sent
+        """
+        recipients = self.get_recipients(obj)
+        if not recipients:
+            return
+
+        now = time.time()
+        with Notifier.__condition:
+            event = (next(Notifier.__event_ids), now, subject, text.strip())
+            for recipient in recipients:
+                Notifier.__buckets.setdefault((recipient, campaign), []).append(event)
+
+            Notifier.__condition.notify()
+
+        with Notifier.__stats_lock:
+            Notifier.__stats['queued'] += 1
+
+        self.__start_sender()
+
+    def __start_sender(self):
+        """
+        Start a thread that sends queued notifications
+        """
+        with Notifier.__condition:
+            if Notifier.__sender is not None:
+                return
+
+            Notifier.__sender = Thread(target=self.__send_loop, name='notifier', daemon=True)
+            Notifier.__sender.start()
+            atexit.register(self.flush)
+
+    def __send_loop(self):
+        """
+        Wait until buckets are older than digest window and send them
+        """
+        while True:
+            with Notifier.__condition:
+                while True:
+                    now = time.time()
+                    first_added = [events[0][1] for events in Notifier.__buckets.values()]
+                    due_time = min(first_added) + self.digest_window if first_added else None
+                    if due_time is not None and due_time <= now:
+                        break
+
+                    Notifier.__condition.wait(due_time - now if due_time else None)
+
+                due = self.__pop_buckets(now)
+
+            self.__send(due)
+
+    def __pop_buckets(self, now):
+        """
+        Remove and return buckets that waited for digest window, all buckets if
+        now is None, condition must be held
+        """
+        due = {}
+        for key, events in list(Notifier.__buckets.items()):
+            if now is None or events[0][1] + self.digest_window <= now:
+                due[key] = Notifier.__buckets.pop(key)
+
+        return due
+
+    def flush(self):
+        """
+        Send all queued notifications immediately
+        """
+        with Notifier.__condition:
+            due = self.__pop_buckets(None)
+
+        self.__send(due)
+
+    def __send(self, buckets):
+        """
+        Send one email for every distinct list of events, recipients that got
+        the same events of a campaign are put to the same email
+        """
+        emails = {}
+        for (recipient, campaign), events in buckets.items():
+            events = tuple(sorted(events))
+            emails.setdefault((campaign, events), []).append(recipient)
+
+        emailer = Emailer()
+        for (campaign, events), recipients in emails.items():
+            if len(events) == 1:
+                subject = events[0][2]
+                body = f'Hello,\n\n{events[0][3]}\n'
+            else:
+                subject = f'{len(events)} notifications about {campaign}'
+                body = f'Hello,\n\nThere are {len(events)} notifications about {campaign}:\n'
+                for _, _, event_subject, text in events:
+                    body += f'\n{event_subject}\n{text}\n'
+
+            try:
+                emailer.send(subject, body, sorted(recipients))
+                with Notifier.__stats_lock:
+                    Notifier.__stats['emails_sent'] += 1
+                    if len(events) > 1:
+                        Notifier.__stats['digests_sent'] += 1
+
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                self.logger.error('Error sending "%s" to %s: %s', subject, recipients, ex)
+                with Notifier.__stats_lock:
+                    Notifier.__stats['send_failures'] += 1
+
+    def get_stats(self):
+        """
+        Return number of queued notifications and sent emails
+        """
+        with Notifier.__condition:
+            pending = len({event[0]
+                           for events in Notifier.__buckets.values()
+                           for event in events})
+
+        with Notifier.__stats_lock:
+            stats = dict(Notifier.__stats)
+
+        stats['pending'] = pending
+        stats['digest_window'] = self.digest_window
+        return stats
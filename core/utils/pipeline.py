@@ -0,0 +1,331 @@
+"""
+Module that contains a pipeline of stages with separate queues and workers
+"""
+import time
+import logging
+from collections import Counter, deque
+from threading import Condition, Lock, Thread
+from core.utils.timing import LatencyTracker
+
+
+class Retry:  # pylint: disable=too-few-public-methods
+    """
+    Result of a stage function that puts the item back to the queue of the
+    same stage to be processed again after delay seconds
+    """
+
+    def __init__(self, item, delay):
+        self.item = item
+        self.delay = delay
+
+
+class MemoryQueue:
+    """
+    In-memory queue of a single stage
+    Queue items are (job name, item, group key, time added) tuples
+    Grouped item is ready when its group is full or it waited long enough
+    for other items of the group, items with None key are always ready
+    Items put with delay are added in the future and are not ready until then
+    """
+
+    def __init__(self):
+        self.__queue = deque()
+        self.__condition = Condition()
+
+    def put(self, job_name, item, key, delay=0):
+        """
+        Put an item to the queue, optionally make it ready only after delay seconds
+        """
+        with self.__condition:
+            self.__queue.append((job_name, item, key, time.time() + delay))
+            self.__condition.notify()
+
+    def put_many(self, jobs):
+        """
+        Put a list of (job name, item, group key) tuples to the queue
+        """
+        with self.__condition:
+            now = time.time()
+            for job_name, item, key in jobs:
+                self.__queue.append((job_name, item, key, now))
+
+            self.__condition.notify_all()
+
+    def take(self, group_size, group_wait):
+        """
+        Wait for an item that is ready and take it together with up to group
+        size queued items of the same group
+        """
+        with self.__condition:
+            while True:
+                now = time.time()
+                group_sizes = Counter(job[2]
+                                      for job in self.__queue
+                                      if job[2] is not None and job[3] <= now)
+                timeout = None
+                for job in self.__queue:
+                    key = job[2]
+                    if job[3] > now:
+                        ready_time = job[3]
+                    elif key is None or group_sizes[key] >= group_size:
+                        return self.__pop_group(job, group_size, now)
+                    else:
+                        ready_time = job[3] + group_wait
+                        if ready_time <= now:
+                            return self.__pop_group(job, group_size, now)
+
+                    wait_time = ready_time - now
+                    timeout = wait_time if timeout is None else min(timeout, wait_time)
+
+                self.__condition.wait(timeout)
+
+    def __pop_group(self, job, group_size, now):
+        """
+        Remove job and queued jobs of the same group that are not delayed from
+        the queue, condition must be held
+        """
+        self.__queue.remove(job)
+        group = [job]
+        key = job[2]
+        if key is None:
+            return group
+
+        for queued_job in list(self.__queue):
+            if len(group) >= group_size:
+                break
+
+            if queued_job[2] == key and queued_job[3] <= now:
+                self.__queue.remove(queued_job)
+                group.append(queued_job)
+
+        return group
+
+    def done(self, job, result, next_stage):
+        """
+        Hand result of a processed job to the next stage or put it back to
+        this queue if it should be retried
+        """
+        if isinstance(result, Retry):
+            self.put(job[0], result.item, job[2], result.delay)
+        elif result is not None and next_stage is not None:
+            next_stage.add(job[0], result)
+
+    def get_names(self):
+        """
+        Return names of queued jobs
+        """
+        with self.__condition:
+            return [job[0] for job in self.__queue]
+
+
+class Stage:
+    """
+    Single pipeline stage with its own queue and pool of worker threads
+    Function of a stage takes an item and returns an item for the next stage,
+    None if item should not go any further or Retry to process it again later
+    If group key function is given, worker takes up to group size queued items
+    with the same key at once and function takes and returns a list of items
+    Items with None key are always processed alone
+    If function raises an exception, items are put back to the queue and
+    retried with increasing delay
+    Time that items wait in the queue and processing time are tracked
+    """
+
+    # Seconds before items are retried after the first and after repeated errors
+    error_delay = 30
+    max_error_delay = 1800
+
+    def __init__(self, name, function, workers, *, group_key=None, group_size=1, group_wait=0,
+                 queue=None):
+        self.name = name
+        self.function = function
+        self.next_stage = None
+        self.group_key = group_key
+        self.group_size = group_size
+        # Seconds to wait for more items of the same group to be queued
+        self.group_wait = group_wait
+        self.queue = queue if queue is not None else MemoryQueue()
+        self.queue_wait = LatencyTracker.get_tracker(f'stage.{name}.queue_wait')
+        self.processing = LatencyTracker.get_tracker(f'stage.{name}.processing')
+        self.logger = logging.getLogger()
+        # Worker name -> (job name, start time) of job that is being processed
+        self.__jobs = {}
+        # Job name -> number of consecutive errors of the stage function
+        self.__errors = {}
+        self.__jobs_lock = Lock()
+        self.__workers = []
+        for index in range(workers):
+            worker_name = f'{name}-{index + 1}'
+            worker = Thread(target=self.__work, args=(worker_name,), name=worker_name, daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def get_key(self, item):
+        """
+        Return group key of an item or None if item is not grouped
+        """
+        if self.group_key and self.group_size > 1:
+            return self.group_key(item)
+
+        return None
+
+    def add(self, job_name, item):
+        """
+        Put an item to the queue of this stage
+        """
+        self.logger.debug('Adding %s to %s stage queue', job_name, self.name)
+        self.queue.put(job_name, item, self.get_key(item))
+
+    def add_many(self, jobs):
+        """
+        Put a list of (job name, item) tuples to the queue of this stage at once
+        """
+        self.logger.debug('Adding %s jobs to %s stage queue', len(jobs), self.name)
+        self.queue.put_many([(job_name, item, self.get_key(item)) for job_name, item in jobs])
+
+    def __work(self, worker_name):
+        """
+        Worker loop: take items, process them and hand results to the next stage
+        """
+        while True:
+            try:
+                jobs = self.queue.take(self.group_size, self.group_wait)
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                self.logger.error('Error taking job from %s stage queue: %s', self.name, ex)
+                time.sleep(5)
+                continue
+
+            job_names = [job[0] for job in jobs]
+            start_time = time.time()
+            for job in jobs:
+                self.queue_wait.record(max(0, start_time - job[3]))
+
+            with self.__jobs_lock:
+                self.__jobs[worker_name] = (', '.join(job_names), start_time)
+
+            # Jobs are never dropped unless function returns None for them
+            results = [Retry(job[1], self.error_delay) for job in jobs]
+            try:
+                if self.group_key:
+                    group_results = self.function([job[1] for job in jobs])
+                    if len(group_results) != len(jobs):
+                        raise ValueError(f'Expected {len(jobs)} results, '
+                                         f'got {len(group_results)}')
+
+                    results = group_results
+                else:
+                    results = [self.function(jobs[0][1])]
+
+                with self.__jobs_lock:
+                    for job_name in job_names:
+                        self.__errors.pop(job_name, None)
+
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                results = self.get_error_retries(jobs)
+                self.logger.error('Error in %s stage for %s, retrying in %ss: %s',
+                                  self.name,
+                                  ', '.join(job_names),
+                                  results[0].delay,
+                                  ex)
+            finally:
+                self.processing.record(time.time() - start_time)
+                for job, result in zip(jobs, results):
+                    try:
+                        self.queue.done(job, result, self.next_stage)
+                    except Exception as ex:  # pylint: disable=broad-exception-caught
+                        self.logger.error('Error handing over %s from %s stage: %s',
+                                          job[0],
+                                          self.name,
+                                          ex)
+
+                with self.__jobs_lock:
+                    self.__jobs.pop(worker_name, None)
+
+    def get_error_retries(self, jobs):
+        """
+        Return Retry results that put jobs back to the queue after stage
+        function failed, delay doubles with every consecutive error
+        """
+        with self.__jobs_lock:
+            errors = max(self.__errors.get(job[0], 0) for job in jobs) + 1
+            for job in jobs:
+                self.__errors[job[0]] = errors
+
+        delay = min(self.error_delay * 2 ** (errors - 1), self.max_error_delay)
+        return [Retry(job[1], delay) for job in jobs]
+
+    def get_names_in_queue(self):
+        """
+        Return names of jobs waiting in the queue of this stage
+        """
+        return self.queue.get_names()
+
+    def get_worker_status(self):
+        """
+        Return job name and time spent on the job of every worker of this stage
+        """
+        now = time.time()
+        with self.__jobs_lock:
+            jobs = dict(self.__jobs)
+
+        status = {}
+        for worker in self.__workers:
+            job_name, start_time = jobs.get(worker.name, (None, None))
+            status[worker.name] = {'job_name': job_name,
+                                   'job_time': int(now - start_time) if start_time else None,
+                                   'stage': self.name}
+
+        return status
+
+
+class Pipeline:
+    """
+    Sequence of stages where output of one stage is input of the next one
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    def add(self, job_name, item):
+        """
+        Put an item to the first stage of the pipeline
+        """
+        self.stages[0].add(job_name, item)
+
+    def add_many(self, jobs):
+        """
+        Put a list of (job name, item) tuples to the first stage of the pipeline
+        """
+        self.stages[0].add_many(jobs)
+
+    def get_stage(self, name):
+        """
+        Return stage with given name
+        """
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+
+        raise ValueError(f'Stage {name} does not exist')
+
+    def get_names_in_queue(self):
+        """
+        Return names of jobs waiting in any of the stage queues
+        """
+        names = []
+        for stage in self.stages:
+            names.extend(stage.get_names_in_queue())
+
+        return names
+
+    def get_worker_status(self):
+        """
+        Return status of workers of all stages
+        """
+        status = {}
+        for stage in self.stages:
+            status.update(stage.get_worker_status())
+
+        return status
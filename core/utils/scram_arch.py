@@ -0,0 +1,68 @@
+"""
+Module that resolves scram arch of CMSSW releases through a shared cache
+"""
+import logging
+from threading import Thread
+from core_lib.database.database import Database
+from core_lib.utils.common_utils import get_scram_arch as fetch_scram_arch
+from core.utils.cache import TTLCache
+
+
+# Scram arch of a release practically never changes
+scram_arch_cache = TTLCache('scram_arch', ttl=12 * 3600)
+
+
+def get_scram_arch(cmssw_release):
+    """
+    Return scram arch of given CMSSW release or None if it could not be found
+    """
+    if not cmssw_release:
+        return None
+
+    scram_arch = scram_arch_cache.get(cmssw_release)
+    if scram_arch:
+        return scram_arch
+
+    scram_arch = fetch_scram_arch(cmssw_release)
+    if scram_arch:
+        # Releases that were not found are not cached, they might appear later
+        scram_arch_cache.set(cmssw_release, scram_arch)
+
+    return scram_arch
+
+
+def get_active_releases():
+    """
+    Return a set of CMSSW releases of tickets and RelVals that are not done yet
+    """
+    releases = set()
+    relval_statuses = ['new', 'approved', 'submitting', 'submitted']
+    relval_query = {'deleted': {'$ne': True}, 'status': {'$in': relval_statuses}}
+    ticket_query = {'deleted': {'$ne': True}, 'status': 'new'}
+    releases.update(Database('relvals').collection.distinct('cmssw_release', relval_query))
+    releases.update(Database('tickets').collection.distinct('cmssw_release', ticket_query))
+    return {release for release in releases if release}
+
+
+def prewarm_scram_arch_cache():
+    """
+    Resolve scram archs of all active releases in a background thread
+    """
+    logger = logging.getLogger()
+
+    def prewarm():
+        try:
+            releases = get_active_releases()
+            # Releases might be stored as paths, tickets resolve by release name only
+            releases = sorted(releases | {release.split('/')[-1] for release in releases})
+            logger.info('Prewarming scram arch cache with %s releases', len(releases))
+            for release in releases:
+                get_scram_arch(release)
+
+            logger.info('Scram arch cache prewarmed: %s', scram_arch_cache.get_stats())
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            logger.error('Error prewarming scram arch cache: %s', ex)
+
+    thread = Thread(target=prewarm, name='scram-arch-prewarm', daemon=True)
+    thread.start()
+    return thread
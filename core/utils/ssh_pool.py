@@ -0,0 +1,280 @@
+"""
+Module that contains a pool of reusable SSH connections to the remote node
+"""
+import time
+import logging
+from contextlib import contextmanager
+from threading import Condition, Thread
+from environment import (
+    REMOTE_SSH_NODE,
+    REMOTE_SSH_USERNAME,
+    REMOTE_SSH_PASSWORD,
+)
+from core_lib.utils.ssh_executor import SSHExecutor
+from core.utils.timing import LatencyTracker
+
+
+class SSHPool:
+    """
+    Bounded pool of SSH executors to the remote node
+    All instances share the same connections, so handshake and authentication
+    are done once per connection and not once per remote operation
+    Connections are checked before reuse, closed after being idle for too long
+    and kept alive while they are in the pool
+    Background jobs, e.g. submission, can hold only some of the connections,
+    so user requests do not wait for long running background jobs
+    """
+
+    # Maximum number of open connections
+    max_size = 8
+    # Maximum number of connections used by background jobs at once
+    max_background = 5
+    # Seconds after which unused connection is closed
+    idle_timeout = 600
+    # Seconds between SSH keep-alive packets
+    keepalive_interval = 60
+    # Seconds that connection can be idle before it is probed with a command
+    probe_after = 60
+    # Seconds to wait for a free connection in user requests and background jobs
+    acquire_timeout = 120
+    background_acquire_timeout = 1800
+    # Shared state of all pool instances
+    __condition = Condition()
+    __idle = []
+    __in_use = 0
+    __background_in_use = 0
+    __reaper = None
+    __stats = {
+        'acquired': 0,
+        'created': 0,
+        'closed_unhealthy': 0,
+        'closed_idle': 0,
+        'waited': 0,
+        'wait_total': 0.0,
+        'wait_max': 0.0,
+    }
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.acquire_wait = LatencyTracker.get_tracker('ssh_pool.acquire_wait')
+
+    @contextmanager
+    def connection(self, background=False):
+        """
+        Context manager that lends an SSH executor and returns it to the pool
+        Background jobs should set background to True
+        """
+        ssh_executor = self.acquire(background)
+        try:
+            yield ssh_executor
+        finally:
+            self.release(ssh_executor, background)
+
+    def acquire(self, background=False):
+        """
+        Take an idle healthy connection or create a new one
+        Wait for a free connection if pool or background limit is full
+        Connections that were idle for a while are probed outside the lock
+        """
+        start_time = time.time()
+        timeout = self.background_acquire_timeout if background else self.acquire_timeout
+        while True:
+            ssh_executor, idle_since = self.__reserve(background, start_time, timeout)
+            if ssh_executor is None:
+                try:
+                    ssh_executor = SSHExecutor(host=REMOTE_SSH_NODE,
+                                               username=REMOTE_SSH_USERNAME,
+                                               password=REMOTE_SSH_PASSWORD)
+                except Exception:
+                    with self.__condition:
+                        self.__unreserve(background)
+
+                    raise
+
+                with self.__condition:
+                    SSHPool.__stats['created'] += 1
+                    self.__start_reaper()
+            elif time.time() - idle_since > self.probe_after and not self.responds(ssh_executor):
+                self.__close(ssh_executor)
+                with self.__condition:
+                    SSHPool.__stats['closed_unhealthy'] += 1
+                    self.__unreserve(background)
+
+                continue
+
+            return self.__lend(ssh_executor, start_time)
+
+    def __reserve(self, background, start_time, timeout):
+        """
+        Wait for a free slot and reserve it, return an idle connection with
+        time since when it was idle or (None, None) if a new one should be created
+        """
+        with self.__condition:
+            while True:
+                self.__close_expired()
+                if SSHPool.__in_use < self.max_size and (
+                    not background or SSHPool.__background_in_use < self.max_background
+                ):
+                    SSHPool.__in_use += 1
+                    if background:
+                        SSHPool.__background_in_use += 1
+
+                    while SSHPool.__idle:
+                        ssh_executor, idle_since = SSHPool.__idle.pop()
+                        if self.is_healthy(ssh_executor):
+                            return ssh_executor, idle_since
+
+                        SSHPool.__stats['closed_unhealthy'] += 1
+                        self.__close(ssh_executor)
+
+                    return None, None
+
+                remaining = timeout - (time.time() - start_time)
+                if remaining <= 0:
+                    raise RuntimeError('Timed out waiting for a free SSH connection '
+                                       f'to {REMOTE_SSH_NODE}')
+
+                self.__condition.wait(remaining)
+
+    def __unreserve(self, background):
+        """
+        Free a reserved slot, condition must be held
+        """
+        SSHPool.__in_use -= 1
+        if background:
+            SSHPool.__background_in_use -= 1
+
+        self.__condition.notify_all()
+
+    def __lend(self, ssh_executor, start_time):
+        """
+        Record the wait time of a connection that is lent
+        """
+        wait_time = time.time() - start_time
+        with self.__condition:
+            SSHPool.__stats['acquired'] += 1
+            if wait_time > 0.01:
+                SSHPool.__stats['waited'] += 1
+
+            SSHPool.__stats['wait_total'] += wait_time
+            SSHPool.__stats['wait_max'] = max(SSHPool.__stats['wait_max'], wait_time)
+
+        self.acquire_wait.record(wait_time)
+        return ssh_executor
+
+    def release(self, ssh_executor, background=False):
+        """
+        Return connection to the pool, close it if it is broken
+        """
+        healthy = self.is_healthy(ssh_executor)
+        if healthy:
+            self.__set_keepalive(ssh_executor)
+        else:
+            self.__close(ssh_executor)
+
+        with self.__condition:
+            if healthy:
+                SSHPool.__idle.append((ssh_executor, time.time()))
+            else:
+                SSHPool.__stats['closed_unhealthy'] += 1
+
+            self.__unreserve(background)
+
+    def responds(self, ssh_executor):
+        """
+        Return whether remote node responds to a command over the connection
+        """
+        try:
+            _, _, exit_code = ssh_executor.execute_command('true')
+            return exit_code == 0
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            self.logger.warning('SSH connection does not respond: %s', ex)
+            return False
+
+    @staticmethod
+    def is_healthy(ssh_executor):
+        """
+        Return whether connection can be reused
+        Executor that did not connect yet is healthy, it will connect on first use
+        """
+        ssh_client = getattr(ssh_executor, 'ssh_client', None)
+        if ssh_client is None:
+            return True
+
+        transport = ssh_client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def __set_keepalive(self, ssh_executor):
+        """
+        Make transport send keep-alive packets while connection is idle
+        """
+        ssh_client = getattr(ssh_executor, 'ssh_client', None)
+        transport = ssh_client.get_transport() if ssh_client else None
+        if transport is not None:
+            transport.set_keepalive(self.keepalive_interval)
+
+    def __close(self, ssh_executor):
+        """
+        Close connections of an executor
+        """
+        try:
+            ssh_executor.close_connections()
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            self.logger.warning('Error closing SSH connection: %s', ex)
+
+    def __close_expired(self):
+        """
+        Close connections that were idle for longer than idle timeout, condition must be held
+        """
+        now = time.time()
+        expired = [pair for pair in SSHPool.__idle if now - pair[1] > self.idle_timeout]
+        if not expired:
+            return
+
+        SSHPool.__idle = [pair for pair in SSHPool.__idle if now - pair[1] <= self.idle_timeout]
+        for ssh_executor, _ in expired:
+            SSHPool.__stats['closed_idle'] += 1
+            self.__close(ssh_executor)
+
+    def __start_reaper(self):
+        """
+        Start a thread that closes expired idle connections, condition must be held
+        """
+        if SSHPool.__reaper is not None:
+            return
+
+        def reap():
+            while True:
+                time.sleep(max(1, self.idle_timeout / 2))
+                with self.__condition:
+                    self.__close_expired()
+
+        SSHPool.__reaper = Thread(target=reap, name='ssh-pool-reaper', daemon=True)
+        SSHPool.__reaper.start()
+
+    def close_all(self):
+        """
+        Close all idle connections
+        """
+        with self.__condition:
+            idle = SSHPool.__idle
+            SSHPool.__idle = []
+            for ssh_executor, _ in idle:
+                self.__close(ssh_executor)
+
+    def get_stats(self):
+        """
+        Return pool size and acquire wait time statistics
+        """
+        with self.__condition:
+            stats = dict(SSHPool.__stats)
+            stats['idle'] = len(SSHPool.__idle)
+            stats['in_use'] = SSHPool.__in_use
+            stats['background_in_use'] = SSHPool.__background_in_use
+            stats['max_size'] = self.max_size
+            stats['max_background'] = self.max_background
+            acquired = stats['acquired']
+            stats['wait_avg'] = round(stats['wait_total'] / acquired, 4) if acquired else 0.0
+            stats['wait_total'] = round(stats['wait_total'], 4)
+            stats['wait_max'] = round(stats['wait_max'], 4)
+            return stats
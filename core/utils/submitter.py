@@ -1,40 +1,183 @@
 """
 Module that has all classes used for request submission to computing
 """
+import json
 import time
+import random
+from contextlib import ExitStack
+from threading import Lock, Thread
 from environment import (
     REMOTE_PATH,
-    REMOTE_SSH_NODE,
-    REMOTE_SSH_USERNAME,
-    REMOTE_SSH_PASSWORD,
     SERVICE_URL,
     CMSWEB_URL,
     DEVELOPMENT,
     GRID_USER_CERT,
     GRID_USER_KEY,
 )
-from core_lib.utils.ssh_executor import SSHExecutor
 from core_lib.utils.locker import Locker
 from core_lib.database.database import Database
 from core_lib.utils.connection_wrapper import ConnectionWrapper
 from core_lib.utils.submitter import Submitter as BaseSubmitter
 from core_lib.utils.common_utils import clean_split, refresh_workflows_in_stats
-from core.utils.emailer import Emailer
+from core.utils.notifier import Notifier
+from core.utils.ssh_pool import SSHPool
+from core.utils.pipeline import Pipeline, Retry, Stage
+from core.utils.durable_queue import DurableQueue
+from core.utils.voms_proxy import VOMSProxy
+from core.utils.timing import timed
+from core.utils.document_updates import save_changes
 
 
 class RequestSubmitter(BaseSubmitter):
     """
     Subclass of base submitter that is tailored for RelVal submission
+    Submission is split into stages - config generation and upload on the remote
+    machine, injection to ReqMgr2, approval and finalization - each with its own
+    queue and workers, so remote and cmsweb work of different RelVals overlaps
     """
 
+    # Submission stages in order
+    stages = ("config", "inject", "approve", "finalize")
+    # Number of workers of each submission stage
+    stage_workers = {"config": 5, "inject": 3, "approve": 2, "finalize": 2}
+    # Collection that keeps queued RelVals and their stages
+    queue_collection = "submission_queue"
+    # Maximum number of RelVals whose configs are generated in one environment
+    config_group_size = 20
+    # Seconds to wait for more RelVals of the same config group
+    config_group_wait = 2
+    # Maximum number of workflows whose status is checked and that are approved together
+    approve_batch_size = 20
+    # Seconds to wait for more injected workflows to approve together
+    approve_group_wait = 1
+    # First and maximum delay in seconds between workflow status checks
+    approve_poll_delay = 0.5
+    approve_poll_max_delay = 8
+    # Seconds after which workflows are approved even if ReqMgr2 does not show them
+    approve_timeout = 120
+    # Number of times each submission stage is retried after a transient error
+    stage_retries = {"config": 1, "inject": 3, "approve": 5, "finalize": 5}
+    # First and maximum delay in seconds before a stage is retried
+    retry_delay = 30
+    retry_max_delay = 600
+    # Seconds of clock difference with ReqMgr2 allowed when looking for
+    # workflows created by a failed injection attempt
+    inject_clock_margin = 60
+    # Errors that will not go away if stage is retried, e.g. invalid RelVal
+    permanent_errors = (AssertionError, ValueError, KeyError, TypeError)
+    # Pipeline and RelVal controller shared by all submitter instances
+    __pipeline = None
+    __pipeline_lock = Lock()
+    __controller = None
+
+    def start(self, relval_controller):
+        """
+        Start submission workers and, in the background, put RelVals that were
+        left in submission, e.g. because of a restart, back to the queue
+        """
+        RequestSubmitter.__controller = relval_controller
+        self.get_pipeline()
+        Thread(target=self.recover_orphans, name="submission-recovery", daemon=True).start()
+
     def add(self, relval, relval_controller):
         """
-        Add a RelVal to the submission queue
+        Add a RelVal to the first stage of the submission pipeline
         """
+        RequestSubmitter.__controller = relval_controller
         prepid = relval.get_prepid()
-        super().add_task(
-            prepid, self.submit_relval, relval=relval, controller=relval_controller
+        self.set_submission_stage(relval, "config")
+        self.get_pipeline().add(prepid, self.get_config_item(relval))
+
+    def enqueue(self, relvals, relval_controller):
+        """
+        Add RelVals whose config submission stage was already saved to the first
+        stage of the submission pipeline at once
+        """
+        RequestSubmitter.__controller = relval_controller
+        jobs = [(relval.get_prepid(), self.get_config_item(relval)) for relval in relvals]
+        self.get_pipeline().add_many(jobs)
+
+    def get_controller(self):
+        """
+        Return RelVal controller used by submission stages
+        """
+        if RequestSubmitter.__controller is None:
+            raise RuntimeError("Submitter was not started with a RelVal controller")
+
+        return RequestSubmitter.__controller
+
+    def get_config_item(self, relval):
+        """
+        Return queue item of the config stage
+        """
+        # RelVals with the same release and scram arch share config generation
+        group = self.get_controller().get_config_group(relval)
+        return {"prepid": relval.get_prepid(), "group": group}
+
+    def recover_orphans(self):
+        """
+        Put RelVals that are in submission, but are not in the queue, back to
+        the queue at their recorded stage
+        """
+        try:
+            pipeline = self.get_pipeline()
+            pipeline.stages[0].queue.create_indexes()
+            queued = pipeline.stages[0].queue.get_all_names()
+            query = {
+                "$or": [
+                    {"status": "submitting"},
+                    {"submission_stage": {"$nin": ["", None]}},
+                ]
+            }
+            relvals = Database("relvals").collection.find(query, {"prepid": 1})
+            orphans = [entry["prepid"] for entry in relvals if entry["prepid"] not in queued]
+            for prepid in orphans:
+                with Locker().get_lock(prepid):
+                    relval = self.get_controller().get(prepid)
+                    stage = relval.get("submission_stage") or "config"
+                    if stage == "config":
+                        relval.set("submission_stage", stage)
+                        save_changes(Database("relvals"), relval)
+                        item = self.get_config_item(relval)
+                    else:
+                        item = {"prepid": prepid}
+
+                    self.logger.info("Recovering %s submission at %s stage", prepid, stage)
+                    stage = pipeline.get_stage(stage)
+                    stage.queue.put(prepid, item, stage.get_key(item), replace=False)
+
+            self.logger.info("Recovered %s orphaned submissions", len(orphans))
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            self.logger.error("Error recovering orphaned submissions: %s", ex)
+
+    def __handle_stage_error(self, relval, stage, item, error):
+        """
+        Handle error that occured in a submission stage
+        RelVal stays in the failed stage and the stage is retried after a
+        jittered exponential delay, so outputs of completed stages are kept
+        RelVal is reset only if error is permanent or there are no retries left
+        Return Retry or None if submission should not continue
+        """
+        prepid = relval.get_prepid()
+        retries = dict(item.get("retries", {}))
+        attempt = retries.get(stage, 0) + 1
+        if isinstance(error, self.permanent_errors) or attempt > self.stage_retries[stage]:
+            self.__handle_error(relval, str(error))
+            return None
+
+        retries[stage] = attempt
+        delay = min(self.retry_max_delay, self.retry_delay * 2 ** (attempt - 1))
+        delay *= random.uniform(0.5, 1.5)
+        self.logger.warning(
+            "Error in %s stage of %s, retry %s/%s in %.0fs: %s",
+            stage,
+            prepid,
+            attempt,
+            self.stage_retries[stage],
+            delay,
+            error,
         )
+        return Retry(dict(item, retries=retries), delay)
 
     def __handle_error(self, relval, error_message):
         """
@@ -42,25 +185,25 @@ class RequestSubmitter(BaseSubmitter):
         """
         self.logger.error(error_message)
         relval_db = Database("relvals")
+        campaign = relval.get_campaign()
         relval.set("status", "new")
         relval.set("campaign_timestamp", 0)
+        relval.set("submission_stage", "")
         relval.add_history("submission", "failed", "automatic")
         for step in relval.get("steps"):
             step.set("config_id", "")
             step.set("resolved_globaltag", "")
 
-        relval_db.save(relval.get_json())
+        save_changes(relval_db, relval)
         service_url = SERVICE_URL
-        emailer = Emailer()
         prepid = relval.get_prepid()
         subject = f"RelVal {prepid} submission failed"
-        body = f"Hello,\n\nUnfortunately submission of {prepid} failed.\n"
+        body = f"Unfortunately submission of {prepid} failed.\n"
         body += (
             f"You can find this relval at " f"{service_url}/relvals?prepid={prepid}\n"
         )
         body += f"Error message:\n\n{error_message}"
-        recipients = emailer.get_recipients(relval)
-        emailer.send(subject, body, recipients)
+        Notifier().notify(relval, campaign, subject, body)
 
     def __handle_success(self, relval):
         """
@@ -71,9 +214,8 @@ class RequestSubmitter(BaseSubmitter):
         cmsweb_url = CMSWEB_URL
         self.logger.info("Submission of %s succeeded", prepid)
         service_url = SERVICE_URL
-        emailer = Emailer()
         subject = f"RelVal {prepid} submission succeeded"
-        body = f"Hello,\n\nSubmission of {prepid} succeeded.\n"
+        body = f"Submission of {prepid} succeeded.\n"
         body += (
             f"You can find this relval at " f"{service_url}/relvals?prepid={prepid}\n"
         )
@@ -82,26 +224,26 @@ class RequestSubmitter(BaseSubmitter):
             body += "\nNOTE: This was submitted from a development instance of RelVal machine "
             body += "and this job will never start running in computing!\n"
 
-        recipients = emailer.get_recipients(relval)
-        emailer.send(subject, body, recipients)
+        Notifier().notify(relval, relval.get_campaign(), subject, body)
 
-    def prepare_workspace(self, relval, controller, ssh_executor, relval_dir):
+    def prepare_workspace(self, relval, controller, ssh_executor, relval_dir, skip_configs=None):
         """
         Clean or create a remote directory and upload all needed files
+        Configs whose names are in skip configs are not generated and uploaded
         """
         prepid = relval.get_prepid()
         self.logger.info("Preparing workspace for %s", prepid)
         # Get cmsDriver script
-        config_script = controller.get_cmsdriver(relval, for_submission=True)
+        config_script = controller.get_cmsdriver(
+            relval, for_submission=True, skip_configs=skip_configs
+        )
         # Get config upload script
-        upload_script = controller.get_config_upload_file(relval)
+        upload_script = controller.get_config_upload_file(relval, skip_configs)
 
-        # Re-create the directory and create a voms proxy there
+        # Re-create the directory, shared voms proxy is used there
         command = [
             f"rm -rf {relval_dir}",
             f"mkdir -p {relval_dir}",
-            f"cd {relval_dir}",
-            "voms-proxy-init -voms cms --valid 4:00 --out $(pwd)/proxy.txt",
         ]
         ssh_executor.execute_command(command)
 
@@ -132,12 +274,13 @@ class RequestSubmitter(BaseSubmitter):
         command = [
             f"cd {relval_dir}",
             "chmod +x config_generate.sh",
-            "export X509_USER_PROXY=$(pwd)/proxy.txt",
+            f"export X509_USER_PROXY={VOMSProxy().get_path(ssh_executor)}",
             "./config_generate.sh",
         ]
         stdout, stderr, exit_code = ssh_executor.execute_command(command)
         self.logger.debug("Exit code %s for %s config generation", exit_code, prepid)
         if exit_code != 0:
+            VOMSProxy().invalidate_on_auth_error(stderr)
             raise RuntimeError(f"Error generating configs for {prepid}.\n{stderr}")
 
         return stdout
@@ -150,26 +293,139 @@ class RequestSubmitter(BaseSubmitter):
         command = [
             f"cd {relval_dir}",
             "chmod +x config_upload.sh",
-            "export X509_USER_PROXY=$(pwd)/proxy.txt",
+            f"export X509_USER_PROXY={VOMSProxy().get_path(ssh_executor)}",
             "./config_upload.sh",
         ]
         stdout, stderr, exit_code = ssh_executor.execute_command(command)
         self.logger.debug("Exit code %s for %s config upload", exit_code, prepid)
         if exit_code != 0:
+            VOMSProxy().invalidate_on_auth_error(stderr)
             raise RuntimeError(f"Error uploading configs for {prepid}.\n{stderr}")
 
+        return self.parse_config_hashes(stdout)
+
+    def parse_config_hashes(self, stdout):
+        """
+        Return list of (config name, config hash) tuples from config upload output
+        """
         stdout = [x for x in clean_split(stdout, "\n") if "DocID" in x]
         # Get all lines that have DocID as tuples split by space
         stdout = [tuple(clean_split(x.strip(), " ")[1:]) for x in stdout]
         return stdout
 
+    def prepare_group_workspace(
+        self, relvals, controller, ssh_executor, group_dir, skip_configs=None
+    ):
+        """
+        Clean or create a remote directory for a group of RelVals and upload
+        config generation script and config uploader
+        """
+        prepids = [relval.get_prepid() for relval in relvals]
+        self.logger.info("Preparing group workspace for %s", ", ".join(prepids))
+        config_script = controller.get_group_cmsdriver(relvals, skip_configs)
+        command = [
+            f"rm -rf {group_dir}",
+            f"mkdir -p {group_dir}",
+        ]
+        ssh_executor.execute_command(command)
+        ssh_executor.upload_as_file(config_script, f"{group_dir}/config_generate.sh")
+        ssh_executor.upload_file(
+            "./core_lib/utils/config_uploader.py", f"{group_dir}/config_uploader.py"
+        )
+
+    def run_group_script(self, controller, ssh_executor, group_dir, script):
+        """
+        Run a group script in group directory and split its output by prepid
+        Return output of each RelVal and stderr of the whole script
+        """
+        command = [
+            f"cd {group_dir}",
+            f"chmod +x {script}",
+            f"export X509_USER_PROXY={VOMSProxy().get_path(ssh_executor)}",
+            f"./{script}",
+        ]
+        stdout, stderr, exit_code = ssh_executor.execute_command(command)
+        self.logger.debug("Exit code %s for group %s", exit_code, script)
+        if exit_code != 0:
+            VOMSProxy().invalidate_on_auth_error(stderr)
+
+        return controller.split_group_output(stdout), stderr
+
+    def generate_group_configs(self, relvals, controller, skip_configs=None):
+        """
+        Generate and upload configs of RelVals of the same config group in one
+        remote directory and environment
+        Skip configs is a dictionary of prepid -> config file names to leave out
+        Return config hashes and error messages by prepid
+        """
+        prepids = [relval.get_prepid() for relval in relvals]
+        group_dir = f"{REMOTE_PATH.rstrip('/')}/group-{prepids[0]}"
+        config_hashes = {}
+        errors = {}
+        with SSHPool().connection(background=True) as ssh:
+            with timed("submission.group_prepare_workspace"):
+                self.prepare_group_workspace(
+                    relvals, controller, ssh, group_dir, skip_configs
+                )
+
+            with timed("submission.group_generate_configs"):
+                outputs, stderr = self.run_group_script(
+                    controller, ssh, group_dir, "config_generate.sh"
+                )
+
+            generated = []
+            for relval in relvals:
+                prepid = relval.get_prepid()
+                exit_code, output = outputs.get(prepid, (None, stderr))
+                if exit_code != 0:
+                    errors[prepid] = f"Error generating configs for {prepid}.\n{output}"
+                else:
+                    generated.append(relval)
+
+            if generated:
+                upload_script = controller.get_group_config_upload_file(
+                    generated, skip_configs
+                )
+                ssh.upload_as_file(upload_script, f"{group_dir}/config_upload.sh")
+                with timed("submission.group_upload_configs"):
+                    outputs, stderr = self.run_group_script(
+                        controller, ssh, group_dir, "config_upload.sh"
+                    )
+
+                for relval in generated:
+                    prepid = relval.get_prepid()
+                    exit_code, output = outputs.get(prepid, (None, stderr))
+                    if exit_code != 0:
+                        errors[prepid] = f"Error uploading configs for {prepid}.\n{output}"
+                    else:
+                        config_hashes[prepid] = self.parse_config_hashes(output)
+
+            # Remove remote group directory
+            ssh.execute_command([f"rm -rf {group_dir}"])
+
+        return config_hashes, errors
+
+    def set_known_config_ids(self, relval, known_config_ids):
+        """
+        Set config_id of steps whose configs were already uploaded and clear
+        config_id of all other steps
+        Return names of configs that do not need to be generated
+        """
+        for step in relval.get("steps"):
+            step_config_name = step.get_config_file_name()
+            if step_config_name:
+                step.set("config_id", known_config_ids.get(step_config_name, ""))
+
+        return set(known_config_ids)
+
     def update_steps_with_config_hashes(self, relval, config_hashes):
         """
         Iterate through RelVal steps and set config_id values
+        Steps that already have config_id set are skipped
         """
         for step in relval.get("steps"):
             step_config_name = step.get_config_file_name()
-            if not step_config_name:
+            if not step_config_name or step.get("config_id"):
                 continue
 
             step_name = step.get("name")
@@ -197,65 +453,430 @@ class RequestSubmitter(BaseSubmitter):
                 step_name = step.get("name")
                 raise ValueError(f"Missing hash for step {step_name}")
 
-    def submit_relval(self, relval, controller):
+    def get_pipeline(self):
         """
-        Method that is used by submission workers. This is where the actual submission happens
+        Return the submission pipeline, create it on first use
         """
-        prepid = relval.get_prepid()
-        workspace_dir = REMOTE_PATH.rstrip("/")
-        relval_dir = f"{workspace_dir}/{prepid}"
-        prepid = relval.get_prepid()
+        with RequestSubmitter.__pipeline_lock:
+            if RequestSubmitter.__pipeline is None:
+                stages = [
+                    Stage(
+                        "config",
+                        self.stage_config,
+                        self.stage_workers["config"],
+                        group_key=lambda item: item["group"],
+                        group_size=self.config_group_size,
+                        group_wait=self.config_group_wait,
+                        queue=DurableQueue(self.queue_collection, "config"),
+                    )
+                ]
+                stages += [
+                    Stage(
+                        name,
+                        function,
+                        self.stage_workers[name],
+                        queue=DurableQueue(self.queue_collection, name),
+                    )
+                    for name, function in (
+                        ("inject", self.stage_inject),
+                        ("finalize", self.stage_finalize),
+                    )
+                ]
+                # All injected workflows can be checked and approved together
+                stages.insert(
+                    2,
+                    Stage(
+                        "approve",
+                        self.stage_approve,
+                        self.stage_workers["approve"],
+                        group_key=lambda item: "approve",
+                        group_size=self.approve_batch_size,
+                        group_wait=self.approve_group_wait,
+                        queue=DurableQueue(self.queue_collection, "approve"),
+                    ),
+                )
+                RequestSubmitter.__pipeline = Pipeline(stages)
+
+            return RequestSubmitter.__pipeline
+
+    def get_worker_status(self):
+        """
+        Return job name and job time of workers of all submission stages
+        """
+        return self.get_pipeline().get_worker_status()
+
+    def get_names_in_queue(self):
+        """
+        Return prepids of RelVals waiting in any of the submission stage queues
+        """
+        return self.get_pipeline().get_names_in_queue()
+
+    def set_submission_stage(self, relval, stage):
+        """
+        Record the stage that RelVal is handed over to
+        """
+        self.logger.debug("%s submission stage: %s", relval.get_prepid(), stage)
+        relval.set("submission_stage", stage)
+        save_changes(Database("relvals"), relval)
+
+    def run_stage(self, stage, item, function):
+        """
+        Lock and reload RelVal, check that it is still expected in the given stage
+        and run the stage function on it
+        If RelVal is already past this stage, e.g. instance was restarted after the
+        stage was done, but before queue was updated, hand it to the next stage
+        Return item for the next stage, Retry if stage failed with a transient
+        error or None if submission should not continue
+        """
+        prepid = item["prepid"]
         self.logger.debug("Will try to acquire lock for %s", prepid)
         with Locker().get_lock(prepid):
-            self.logger.info("Locked %s for submission", prepid)
-            relval_db = Database("relvals")
-            relval = controller.get(prepid)
+            self.logger.info("Locked %s for %s stage", prepid, stage)
+            relval = self.get_controller().get(prepid)
+            relval_stage = relval.get("submission_stage")
+            if relval_stage in self.stages and (
+                self.stages.index(relval_stage) > self.stages.index(stage)
+            ):
+                self.logger.info("%s is already in %s stage", prepid, relval_stage)
+                return item
+
+            if relval_stage != stage:
+                self.logger.warning(
+                    "%s is in %s submission stage, skipping %s stage",
+                    prepid,
+                    relval.get("submission_stage"),
+                    stage,
+                )
+                return None
+
             try:
-                self.check_for_submission(relval)
-                with SSHExecutor(
-                    host=REMOTE_SSH_NODE,
-                    username=REMOTE_SSH_USERNAME,
-                    password=REMOTE_SSH_PASSWORD,
-                ) as ssh:
-                    # Start executing commands
-                    self.prepare_workspace(relval, controller, ssh, relval_dir)
-                    # Create configs
+                return function(relval, item)
+            except Exception as ex:
+                return self.__handle_stage_error(relval, stage, item, ex)
+
+    def stage_config(self, items):
+        """
+        Generate configs on the remote machine and upload them to ReqMgr2
+        RelVals of the same config group are handled together
+        """
+        if len(items) == 1:
+            return [self.run_stage("config", items[0], self.configure_relval)]
+
+        return self.configure_relval_group(items)
+
+    def configure_relval(self, relval, item):
+        """
+        Generate and upload configs of a single RelVal
+        """
+        self.check_for_submission(relval)
+        prepid = relval.get_prepid()
+        controller = self.get_controller()
+        known_config_ids = controller.get_known_config_ids([relval]).get(prepid, {})
+        skip_configs = self.set_known_config_ids(relval, known_config_ids)
+        if len(skip_configs) < len(relval.get_config_keys()):
+            relval_dir = f"{REMOTE_PATH.rstrip('/')}/{prepid}"
+            with SSHPool().connection(background=True) as ssh:
+                # Start executing commands
+                with timed("submission.prepare_workspace"):
+                    self.prepare_workspace(
+                        relval, controller, ssh, relval_dir, skip_configs
+                    )
+
+                # Create configs
+                with timed("submission.generate_configs"):
                     self.generate_configs(relval, ssh, relval_dir)
-                    # Upload configs
+
+                # Upload configs
+                with timed("submission.upload_configs"):
                     config_hashes = self.upload_configs(relval, ssh, relval_dir)
-                    # Remove remote relval directory
-                    ssh.execute_command([f"rm -rf {relval_dir}"])
-
-                self.logger.debug(config_hashes)
-                # Iterate through uploaded configs and save their hashes in RelVal steps
-                self.update_steps_with_config_hashes(relval, config_hashes)
-                # Submit job dict to ReqMgr2
-                job_dict = controller.get_job_dict(relval)
-                cmsweb_url = CMSWEB_URL
-                grid_cert = GRID_USER_CERT
-                grid_key = GRID_USER_KEY
-                connection = ConnectionWrapper(
-                    host=cmsweb_url, cert_file=grid_cert, key_file=grid_key
+
+                # Remove remote relval directory
+                ssh.execute_command([f"rm -rf {relval_dir}"])
+
+            self.logger.debug(config_hashes)
+            # Iterate through uploaded configs and save their hashes in RelVal steps
+            self.update_steps_with_config_hashes(relval, config_hashes)
+            controller.save_config_ids(relval)
+        else:
+            self.logger.info("All configs of %s were already uploaded", prepid)
+
+        self.set_submission_stage(relval, "inject")
+        return item
+
+    def configure_relval_group(self, items):
+        """
+        Generate and upload configs of multiple RelVals in one remote environment
+        Failure of one RelVal does not affect the others
+        Return items for the next stage in the same order as given items
+        """
+        controller = self.get_controller()
+        prepids = sorted(item["prepid"] for item in items)
+        results = {}
+        with ExitStack() as stack:
+            self.logger.debug("Will try to acquire locks for %s", ", ".join(prepids))
+            for prepid in prepids:
+                stack.enter_context(Locker().get_lock(prepid))
+
+            self.logger.info("Locked %s for config stage", ", ".join(prepids))
+            items_by_prepid = {item["prepid"]: item for item in items}
+            relvals = []
+            for prepid in prepids:
+                relval = controller.get(prepid)
+                relval_stage = relval.get("submission_stage")
+                if relval_stage in self.stages and relval_stage != "config":
+                    # Same as in run_stage, hand it over to the next stage
+                    self.logger.info("%s is already in %s stage", prepid, relval_stage)
+                    results[prepid] = items_by_prepid[prepid]
+                    continue
+
+                if relval_stage != "config":
+                    self.logger.warning(
+                        "%s is in %s submission stage, skipping config stage",
+                        prepid,
+                        relval.get("submission_stage"),
+                    )
+                    continue
+
+                try:
+                    self.check_for_submission(relval)
+                    relvals.append(relval)
+                except Exception as ex:
+                    self.__handle_error(relval, str(ex))
+
+            if not relvals:
+                return [results.get(item["prepid"]) for item in items]
+
+            known_config_ids = controller.get_known_config_ids(relvals)
+            skip_configs = {}
+            to_generate = []
+            for relval in relvals:
+                prepid = relval.get_prepid()
+                skip_configs[prepid] = self.set_known_config_ids(
+                    relval, known_config_ids.get(prepid, {})
                 )
-                workflow_name = self.submit_job_dict(job_dict, connection)
-                # Update RelVal after successful submission
-                relval.set("workflows", [{"name": workflow_name}])
-                relval.set("status", "submitted")
-                relval.add_history("submission", "succeeded", "automatic")
-                relval_db.save(relval.get_json())
-                time.sleep(3)
-                self.approve_workflow(workflow_name, connection)
+                if len(skip_configs[prepid]) < len(relval.get_config_keys()):
+                    to_generate.append(relval)
+                else:
+                    self.logger.info("All configs of %s were already uploaded", prepid)
+
+            config_hashes = {}
+            errors = {}
+            if to_generate:
+                try:
+                    config_hashes, errors = self.generate_group_configs(
+                        to_generate, controller, skip_configs
+                    )
+                except Exception as ex:
+                    errors = {relval.get_prepid(): str(ex) for relval in to_generate}
+
+            for relval in relvals:
+                prepid = relval.get_prepid()
+                try:
+                    if prepid in errors:
+                        raise RuntimeError(errors[prepid])
+
+                    if prepid in config_hashes:
+                        self.logger.debug(config_hashes[prepid])
+                        self.update_steps_with_config_hashes(relval, config_hashes[prepid])
+                        controller.save_config_ids(relval)
+
+                    self.set_submission_stage(relval, "inject")
+                    results[prepid] = items_by_prepid[prepid]
+                except Exception as ex:
+                    results[prepid] = self.__handle_stage_error(
+                        relval, "config", items_by_prepid[prepid], ex
+                    )
+
+        return [results.get(item["prepid"]) for item in items]
+
+    def stage_inject(self, item):
+        """
+        Submit job dict to ReqMgr2
+        """
+
+        def run(relval, item):
+            self.check_for_submission(relval)
+            job_dict = self.get_controller().get_job_dict(relval)
+            connection = ConnectionWrapper(
+                host=CMSWEB_URL, cert_file=GRID_USER_CERT, key_file=GRID_USER_KEY
+            )
+            try:
+                workflow_name = None
+                if "inject_started" in item:
+                    # Previous attempt might have failed after ReqMgr2 created
+                    # the workflow, e.g. timeout while waiting for the response
+                    workflow_name = self.find_injected_workflow(
+                        relval.get_prepid(), item["inject_started"], connection
+                    )
+
+                if workflow_name:
+                    self.logger.info(
+                        "%s was already injected as %s", relval.get_prepid(), workflow_name
+                    )
+                else:
+                    item.setdefault("inject_started", time.time())
+                    with timed("submission.inject"):
+                        workflow_name = self.submit_job_dict(job_dict, connection)
+            finally:
                 connection.close()
-                if not DEVELOPMENT:
-                    refresh_workflows_in_stats([workflow_name])
 
-            except Exception as ex:
-                self.__handle_error(relval, str(ex))
-                return
+            # Update RelVal after successful submission
+            relval.set("workflows", [{"name": workflow_name}])
+            relval.set("status", "submitted")
+            relval.add_history("submission", "succeeded", "automatic")
+            self.set_submission_stage(relval, "approve")
+            return dict(item, workflow=workflow_name)
+
+        return self.run_stage("inject", item, run)
+
+    def find_injected_workflow(self, prepid, since, connection):
+        """
+        Return name of a workflow of given prepid that was created in ReqMgr2
+        after given time, i.e. by a previous attempt of the same injection,
+        None if there is no such workflow
+        """
+        response = connection.api(
+            "GET",
+            f"/reqmgr2/data/request?mask=RequestTransition&prep_id={prepid}",
+            headers={"Accept": "application/json"},
+        )
+        # Allow some clock difference between this machine and ReqMgr2
+        since -= self.inject_clock_margin
+        workflows = []
+        for entry in json.loads(response).get("result", []):
+            for name, workflow in entry.items():
+                if not isinstance(workflow, dict):
+                    continue
+
+                transitions = workflow.get("RequestTransition") or [{}]
+                created = transitions[0].get("UpdateTime", 0)
+                if created >= since:
+                    workflows.append((created, name))
 
+        return max(workflows)[1] if workflows else None
+
+    def get_workflow_statuses(self, workflow_names, connection):
+        """
+        Return a dictionary of workflow names and their statuses in ReqMgr2
+        Statuses of all workflows are fetched with a single request
+        Workflows that ReqMgr2 does not know yet are not in the dictionary
+        """
+        if not workflow_names:
+            return {}
+
+        query = "&".join(f"name={name}" for name in sorted(workflow_names))
+        response = connection.api(
+            "GET",
+            f"/reqmgr2/data/request?mask=RequestStatus&{query}",
+            headers={"Accept": "application/json"},
+        )
+        statuses = {}
+        for entry in json.loads(response).get("result", []):
+            for name, workflow in entry.items():
+                if name in workflow_names and isinstance(workflow, dict):
+                    status = workflow.get("RequestStatus")
+                    if status:
+                        statuses[name] = status
+
+        return statuses
+
+    def wait_for_workflows(self, workflow_names, connection):
+        """
+        Poll ReqMgr2 until all workflows are visible or approve timeout is
+        reached, return a dictionary of workflow names and their statuses
+        Delay between checks is reset when some workflows appeared and
+        doubled up to maximum delay when none did
+        """
+        statuses = {}
+        pending = set(workflow_names)
+        delay = self.approve_poll_delay
+        deadline = time.time() + self.approve_timeout
+        while pending:
+            try:
+                found = self.get_workflow_statuses(pending, connection)
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                self.logger.warning("Error getting workflow statuses: %s", ex)
+                found = {}
+
+            statuses.update(found)
+            pending -= set(found)
+            if not pending:
+                break
+
+            if time.time() + delay > deadline:
+                self.logger.warning(
+                    "ReqMgr2 does not show %s, will try to approve anyway",
+                    ", ".join(sorted(pending)),
+                )
+                break
+
+            self.logger.debug("Waiting %.1fs for %s", delay, ", ".join(sorted(pending)))
+            time.sleep(delay)
+            if found:
+                delay = self.approve_poll_delay
+            else:
+                delay = min(delay * 2, self.approve_poll_max_delay)
+
+        return statuses
+
+    def stage_approve(self, items):
+        """
+        Wait until injected workflows appear in ReqMgr2 and approve them
+        Workflows of all given RelVals are checked together over one connection
+        and RelVals are not locked while waiting
+        """
+        controller = self.get_controller()
+        for item in items:
+            if not item.get("workflow"):
+                # Items recovered after restart do not have the workflow name
+                workflows = controller.get(item["prepid"]).get("workflows")
+                item["workflow"] = workflows[-1]["name"] if workflows else ""
+
+        connection = ConnectionWrapper(
+            host=CMSWEB_URL, cert_file=GRID_USER_CERT, key_file=GRID_USER_KEY
+        )
+        try:
+            workflow_names = {item["workflow"] for item in items if item["workflow"]}
+            with timed("submission.wait_for_workflows"):
+                statuses = self.wait_for_workflows(workflow_names, connection)
+
+            def run(relval, item):
+                workflow_name = relval.get("workflows")[-1]["name"]
+                status = statuses.get(workflow_name, "new")
+                if status == "new":
+                    with timed("submission.approve"):
+                        self.approve_workflow(workflow_name, connection)
+                elif status != "assignment-approved":
+                    raise AssertionError(f"Cannot approve {workflow_name} in {status} status")
+
+                self.set_submission_stage(relval, "finalize")
+                return item
+
+            return [self.run_stage("approve", item, run) for item in items]
+        finally:
+            connection.close()
+
+    def stage_finalize(self, item):
+        """
+        Refresh workflow in Stats2, notify users and update RelVal workflows
+        """
+
+        def run(relval, _item):
+            if not DEVELOPMENT:
+                with timed("submission.refresh_stats"):
+                    refresh_workflows_in_stats([relval.get("workflows")[-1]["name"]])
+
+            self.set_submission_stage(relval, "")
             self.__handle_success(relval)
+            return relval
+
+        relval = self.run_stage("finalize", item, run)
+        if relval is None or isinstance(relval, Retry):
+            return relval
 
         if not DEVELOPMENT:
-            controller.update_workflows(relval)
+            with timed("submission.update_workflows"):
+                self.get_controller().update_workflows(relval)
 
-        self.logger.info("Successfully finished %s submission", prepid)
+        self.logger.info("Successfully finished %s submission", relval.get_prepid())
+        return None
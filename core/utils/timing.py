@@ -0,0 +1,108 @@
+"""
+Module that keeps rolling latency statistics of timed operations
+"""
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock, RLock
+
+
+class LatencyTracker:
+    """
+    Thread safe rolling window of latency samples with percentiles
+    Each tracker is registered by name, so statistics of all of them can be reported
+    """
+
+    # All trackers by name
+    __trackers = {}
+    __trackers_lock = RLock()
+
+    def __init__(self, name, window=1000):
+        self.name = name
+        self.window = window
+        self.count = 0
+        self.__samples = deque(maxlen=window)
+        self.__lock = Lock()
+        with LatencyTracker.__trackers_lock:
+            LatencyTracker.__trackers[name] = self
+
+    def record(self, seconds):
+        """
+        Add a latency sample in seconds
+        """
+        with self.__lock:
+            self.__samples.append(seconds)
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """
+        Context manager that records time spent inside it, also if it raises
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(time.time() - start_time)
+
+    @staticmethod
+    def percentile(sorted_samples, percent):
+        """
+        Return nearest-rank percentile of sorted samples
+        """
+        if not sorted_samples:
+            return None
+
+        rank = math.ceil(percent / 100 * len(sorted_samples))
+        return sorted_samples[max(0, rank - 1)]
+
+    def get_stats(self):
+        """
+        Return number of samples, mean, p50, p95, p99 and max of the window in seconds
+        """
+        with self.__lock:
+            samples = sorted(self.__samples)
+            count = self.count
+
+        def rounded(value):
+            return round(value, 3) if value is not None else None
+
+        return {'count': count,
+                'window': len(samples),
+                'mean': rounded(sum(samples) / len(samples)) if samples else None,
+                'p50': rounded(self.percentile(samples, 50)),
+                'p95': rounded(self.percentile(samples, 95)),
+                'p99': rounded(self.percentile(samples, 99)),
+                'max': rounded(samples[-1]) if samples else None}
+
+    @classmethod
+    def get_tracker(cls, name, window=1000):
+        """
+        Return a tracker with given name, create it if it does not exist
+        """
+        with cls.__trackers_lock:
+            tracker = cls.__trackers.get(name)
+            if tracker is None:
+                tracker = cls(name, window)
+
+            return tracker
+
+    @classmethod
+    def get_all_stats(cls, prefix=''):
+        """
+        Return statistics of all trackers whose names start with prefix by name
+        """
+        with cls.__trackers_lock:
+            trackers = dict(cls.__trackers)
+
+        return {name: tracker.get_stats()
+                for name, tracker in sorted(trackers.items())
+                if name.startswith(prefix)}
+
+
+def timed(name):
+    """
+    Context manager that records time spent inside it to a tracker with given name
+    """
+    return LatencyTracker.get_tracker(name).time()
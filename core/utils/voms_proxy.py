@@ -0,0 +1,134 @@
+"""
+Module that manages a VOMS proxy shared by all remote workspaces
+"""
+import time
+import logging
+from threading import Lock
+from environment import REMOTE_PATH, REMOTE_SSH_NODE
+from core.utils.timing import timed
+
+
+class VOMSProxy:
+    """
+    Single VOMS proxy on the remote node that is created once, reused by all
+    submissions and tickets and renewed before it expires
+    All instances share the same proxy state
+    """
+
+    # Path of proxy file on the remote node
+    path = f'{REMOTE_PATH.rstrip("/")}/proxy.txt'
+    # Requested proxy validity in hours
+    validity_hours = 4
+    # Renew proxy if it has less seconds than this left
+    renew_margin = 3600
+    # Parts of error output of remote commands that mean proxy was not accepted
+    auth_errors = ('proxy', 'x509', 'certificate', 'ssl', 'authentication')
+    # Shared state of all instances
+    __lock = Lock()
+    __created = 0
+    __expires = 0
+    __stats = {
+        'renewals': 0,
+        'renewal_failures': 0,
+        'reused': 0,
+        'checks': 0,
+    }
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+
+    def get_path(self, ssh_executor):
+        """
+        Return path of a proxy that is valid for at least renew margin seconds,
+        create or renew it using given SSH executor if needed
+        """
+        with self.__lock:
+            VOMSProxy.__stats['checks'] += 1
+            if VOMSProxy.__expires - time.time() >= self.renew_margin:
+                return self.path
+
+            if not VOMSProxy.__expires:
+                # Proxy might be left valid by previous run of the application
+                time_left = self.get_time_left(ssh_executor)
+                if time_left >= self.renew_margin:
+                    self.logger.info('Reusing existing VOMS proxy with %ss left', time_left)
+                    now = time.time()
+                    VOMSProxy.__stats['reused'] += 1
+                    VOMSProxy.__expires = now + time_left
+                    # Approximate creation time from requested validity
+                    VOMSProxy.__created = min(now, VOMSProxy.__expires - self.validity_hours * 3600)
+                    return self.path
+
+            with timed('voms_proxy.renew'):
+                self.__renew(ssh_executor)
+
+            return self.path
+
+    def get_time_left(self, ssh_executor):
+        """
+        Return seconds left until proxy expires, 0 if there is no valid proxy
+        """
+        command = [f'voms-proxy-info -file {self.path} -timeleft 2>/dev/null || echo 0']
+        stdout, _, _ = ssh_executor.execute_command(command)
+        try:
+            return max(0, int(stdout.strip().split('\n')[-1]))
+        except ValueError:
+            return 0
+
+    def __renew(self, ssh_executor):
+        """
+        Create a new proxy and atomically replace the old one, lock must be held
+        """
+        self.logger.info('Creating VOMS proxy %s on %s', self.path, REMOTE_SSH_NODE)
+        directory = self.path.rsplit('/', 1)[0]
+        command = [
+            f'mkdir -p {directory}',
+            f'voms-proxy-init -voms cms --valid {self.validity_hours}:00 --out {self.path}.new',
+            f'mv {self.path}.new {self.path}',
+        ]
+        stdout, stderr, exit_code = ssh_executor.execute_command([' && '.join(command)])
+        if exit_code != 0:
+            VOMSProxy.__stats['renewal_failures'] += 1
+            raise RuntimeError(f'Error creating VOMS proxy: {stdout}\n{stderr}')
+
+        now = time.time()
+        time_left = self.get_time_left(ssh_executor)
+        if not time_left:
+            # Fall back to requested validity if proxy info is not available
+            time_left = self.validity_hours * 3600
+
+        VOMSProxy.__stats['renewals'] += 1
+        VOMSProxy.__created = now
+        VOMSProxy.__expires = now + time_left
+
+    def invalidate(self):
+        """
+        Forget the proxy, so it is checked and renewed on next use
+        """
+        with self.__lock:
+            VOMSProxy.__created = 0
+            VOMSProxy.__expires = 0
+
+    def invalidate_on_auth_error(self, error_output):
+        """
+        Invalidate the proxy if error output of a remote command shows that
+        proxy was not accepted, so it is checked and renewed on next use
+        """
+        error_output = error_output.lower()
+        if any(auth_error in error_output for auth_error in self.auth_errors):
+            self.logger.warning('Remote command failed with authentication error, '
+                                'VOMS proxy will be checked again')
+            self.invalidate()
+
+    def get_stats(self):
+        """
+        Return proxy age, time left and renewal counters
+        """
+        with self.__lock:
+            now = time.time()
+            stats = dict(VOMSProxy.__stats)
+            stats['node'] = REMOTE_SSH_NODE
+            stats['path'] = self.path
+            stats['age'] = int(now - VOMSProxy.__created) if VOMSProxy.__created else None
+            stats['time_left'] = max(0, int(VOMSProxy.__expires - now))
+            return stats
@@ -40,6 +40,9 @@ Attributes:
     APPLICATION_CLIENT_ID (str): This is ID for target application (audience),
         registered in CERN Application Portal, that handles OIDC authentication flow 
         for PdmV applications or RelVal application.
+    NOTIFICATION_DIGEST_WINDOW (int): Seconds to wait for more email notifications
+        about the same campaign before they are sent to a user as a single digest.
+        Default value: 60
 """
 import os
 import inspect
@@ -67,6 +70,7 @@ CALLBACK_CLIENT_ID: str = os.getenv("CALLBACK_CLIENT_ID", "")
 CALLBACK_CLIENT_SECRET: str = os.getenv("CALLBACK_CLIENT_SECRET", "")
 APPLICATION_CLIENT_ID: str = os.getenv("APPLICATION_CLIENT_ID", "")
 SECRET_KEY: str = os.getenv("SECRET_KEY", "")
+NOTIFICATION_DIGEST_WINDOW: int = int(os.getenv("NOTIFICATION_DIGEST_WINDOW", "60"))
 
 # Raise an error if they are empty variables
 missing_environment_variables: dict[str, str] = {
@@ -0,0 +1,12 @@
+"""
+Gunicorn configuration, it is loaded from the working directory
+"""
+
+
+def post_worker_init(_worker):
+    """
+    Start background services of the application in the worker process
+    """
+    # pylint: disable=import-outside-toplevel
+    from main import start_services
+    start_services()
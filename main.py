@@ -4,6 +4,8 @@ Main module that starts flask web server
 import os
 import os.path
 import sys
+import atexit
+import signal
 import pathlib
 import datetime
 import logging
@@ -16,6 +18,10 @@ import environment
 from core_lib.database.database import Database
 from core_lib.utils.username_filter import UsernameFilter
 from core_lib.middlewares.auth import AuthenticationMiddleware
+from core.utils.scram_arch import prewarm_scram_arch_cache
+from core.utils.submitter import RequestSubmitter
+from core.utils.ssh_pool import SSHPool
+from core.controller.relval_controller import RelValController
 from api.system_api import (
     LockerStatusAPI,
     UserInfoAPI,
@@ -24,6 +30,8 @@ from api.system_api import (
     ObjectsInfoAPI,
     BuildInfoAPI,
     UptimeInfoAPI,
+    MetricsAPI,
+    InvalidateCacheAPI,
 )
 from api.search_api import SearchAPI, SuggestionsAPI, WildSearchAPI
 from api.ticket_api import (
@@ -38,6 +46,7 @@ from api.ticket_api import (
 )
 from api.relval_api import (
     CreateRelValAPI,
+    ValidateRelValsAPI,
     DeleteRelValAPI,
     UpdateRelValAPI,
     GetRelValAPI,
@@ -45,6 +54,7 @@ from api.relval_api import (
     GetCMSDriverAPI,
     GetConfigUploadAPI,
     GetRelValJobDictAPI,
+    GetRelValJobDictsAPI,
     GetDefaultRelValStepAPI,
     RelValNextStatus,
     RelValPreviousStatus,
@@ -132,6 +142,8 @@ api.add_resource(SubmissionQueueAPI, "/api/system/queue")
 api.add_resource(ObjectsInfoAPI, "/api/system/objects_info")
 api.add_resource(BuildInfoAPI, "/api/system/build_info")
 api.add_resource(UptimeInfoAPI, "/api/system/uptime")
+api.add_resource(MetricsAPI, "/api/system/metrics")
+api.add_resource(InvalidateCacheAPI, "/api/system/invalidate_cache")
 
 api.add_resource(SettingsAPI, "/api/settings/get", "/api/settings/get/<string:name>")
 
@@ -157,6 +169,7 @@ api.add_resource(
 )
 
 api.add_resource(CreateRelValAPI, "/api/relvals/create")
+api.add_resource(ValidateRelValsAPI, "/api/relvals/validate")
 api.add_resource(DeleteRelValAPI, "/api/relvals/delete")
 api.add_resource(UpdateRelValAPI, "/api/relvals/update")
 api.add_resource(GetRelValAPI, "/api/relvals/get/<string:prepid>")
@@ -168,6 +181,7 @@ api.add_resource(
 api.add_resource(GetCMSDriverAPI, "/api/relvals/get_cmsdriver/<string:prepid>")
 api.add_resource(GetConfigUploadAPI, "/api/relvals/get_config_upload/<string:prepid>")
 api.add_resource(GetRelValJobDictAPI, "/api/relvals/get_dict/<string:prepid>")
+api.add_resource(GetRelValJobDictsAPI, "/api/relvals/get_dicts")
 api.add_resource(GetDefaultRelValStepAPI, "/api/relvals/get_default_step")
 api.add_resource(RelValNextStatus, "/api/relvals/next_status")
 api.add_resource(RelValPreviousStatus, "/api/relvals/previous_status")
@@ -236,11 +250,35 @@ Database.add_search_rename("relvals", "output_dataset", "output_datasets")
 setup_logging(debug=environment.DEBUG, log_folder_path=environment.LOG_FOLDER)
 
 
+def start_services():
+    """
+    Start background services of the application, this is done in main() or
+    by server's start hook, e.g. in gunicorn.conf.py, and not on import, so
+    tools that import this module and reloader process do not start them
+    """
+    # Resolve scram archs of active releases in the background
+    prewarm_scram_arch_cache()
+
+    # Make sure indexes used by bulk RelVal operations exist
+    relval_controller = RelValController()
+    relval_controller.create_indexes()
+
+    # Start submission workers and recover RelVals that were left in submission
+    RequestSubmitter().start(relval_controller)
+
+    # Close idle SSH connections to the remote node when application stops
+    atexit.register(SSHPool().close_all)
+
+
 def main():
     """
     Main function: start Flask web server
     """
     logger = logging.getLogger()
+    # Exit normally on SIGTERM, e.g. container stop, so exit handlers send
+    # queued notifications and close SSH connections, gunicorn workers
+    # already do this
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     if os.environ.get("WERKZEUG_RUN_MAIN") != "true":
         # Do only once, before the reloader
         pid = os.getpid()
@@ -248,6 +286,10 @@ def main():
         with open("relval.pid", "w", encoding='utf-8') as pid_file:
             pid_file.write(str(pid))
 
+    if not environment.DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        # Reloader process only watches files and restarts the server process
+        start_services()
+
     logger.info(
         "Starting... Debug: %s, Host: %s, Port: %s",
         environment.DEBUG,
@@ -0,0 +1,369 @@
+"""
+Script that benchmarks RelVal rendering hot paths on synthetic RelVals
+It runs offline - no database, SSH or cmsweb access is needed
+Results can be compared to a baseline that is saved by the first run:
+  python3 benchmark_rendering.py --baseline baseline.json
+Timings depend on the machine, so baseline is not committed and should be
+made on the same machine, e.g. before a change, or replaced explicitly:
+  python3 benchmark_rendering.py --save-baseline baseline.json
+"""
+import sys
+import os
+import os.path
+import json
+import time
+import timeit
+import hashlib
+import logging
+import argparse
+import statistics
+import tracemalloc
+# Dummy values for variables that environment module requires,
+# none of them are used by the benchmarked functions
+for _variable in ('REMOTE_PATH', 'CMSWEB_URL', 'REMOTE_SSH_USERNAME', 'REMOTE_SSH_PASSWORD',
+                  'MONGO_DB_USERNAME', 'MONGO_DB_PASSWORD', 'MONGO_DB_HOST', 'GRID_USER_CERT',
+                  'GRID_USER_KEY', 'LOG_FOLDER', 'CALLBACK_CLIENT_ID', 'CALLBACK_CLIENT_SECRET',
+                  'APPLICATION_CLIENT_ID', 'SECRET_KEY'):
+    os.environ.setdefault(_variable, 'benchmark')
+
+os.environ['CMSWEB_URL'] = 'https://cmsweb.cern.ch'
+# pylint: disable-next=wrong-import-position
+sys.path.append(os.path.abspath(os.path.pardir))
+# pylint: disable=wrong-import-position
+from core.model.relval import RelVal
+from core.controller.relval_controller import RelValController
+# pylint: enable=wrong-import-position
+
+
+cmssw_release = 'CMSSW_14_0_0'
+scram_arch = 'el8_amd64_gcc12'
+globaltag = '140X_mcRun3_2024_realistic_v3'
+
+
+def make_step(name, step, eventcontent, datatier, **kwargs):
+    """
+    Return a cmsDriver step dictionary
+    """
+    driver = {'conditions': 'auto:phase1_2024_realistic',
+              'datatier': datatier,
+              'era': 'Run3_2024',
+              'eventcontent': eventcontent,
+              'geometry': 'DB:Extended',
+              'mc': True,
+              'number': '10',
+              'step': step}
+    driver.update(kwargs.pop('driver', {}))
+    step_dict = {'name': name,
+                 'config_id': hashlib.md5(name.encode('utf-8')).hexdigest(),
+                 'driver': driver,
+                 'resolved_globaltag': globaltag,
+                 'scram_arch': scram_arch}
+    step_dict.update(kwargs)
+    return step_dict
+
+
+def make_input_step(name, runs, ranges_per_run):
+    """
+    Return an input file step dictionary with a lumisection map
+    """
+    lumisection = {str(355000 + run): [[i * 100 + 1, i * 100 + 50] for i in range(ranges_per_run)]
+                   for run in range(runs)}
+    return {'name': name,
+            'input': {'dataset': '/JetMET/Run2022C-v1/RAW',
+                      'label': 'rv',
+                      'lumisection': lumisection,
+                      'run': [],
+                      'events': 0},
+            'scram_arch': scram_arch}
+
+
+def make_gen_step(name='TTbar_14TeV'):
+    """
+    Return a generator step dictionary
+    """
+    return make_step(name,
+                     ['GEN', 'SIM'],
+                     ['FEVTDEBUG'],
+                     ['GEN-SIM'],
+                     driver={'relval': '9000,100',
+                             'beamspot': 'Realistic25ns13p6TeVEarly2022Collision',
+                             'fragment_name': 'TTbar_14TeV_TuneCP5_cfi'})
+
+
+def make_digi_reco_steps(prefix, pileup=False):
+    """
+    Return DIGI, RECO and HARVESTING step dictionaries
+    """
+    digi_driver = {'pileup_input': 'das:/RelValMinBias/CMSSW_14_0_0-v1/GEN-SIM'} if pileup else {}
+    if pileup:
+        digi_driver['pileup'] = 'Run3_Flat55To75_PoissonOOTPU'
+
+    return [make_step(f'{prefix}DIGI',
+                      ['DIGI:pdigi_valid', 'L1', 'DIGI2RAW', 'HLT:@relval2024'],
+                      ['FEVTDEBUGHLT'],
+                      ['GEN-SIM-DIGI-RAW'],
+                      driver=digi_driver),
+            make_step(f'{prefix}RECO',
+                      ['RAW2DIGI', 'L1Reco', 'RECO', 'RECOSIM', 'PAT',
+                       'VALIDATION:@standardValidation', 'DQM:@standardDQM'],
+                      ['RECOSIM', 'MINIAODSIM', 'NANOEDMAODSIM', 'DQM'],
+                      ['GEN-SIM-RECO', 'MINIAODSIM', 'NANOAODSIM', 'DQMIO'],
+                      driver={'nStreams': '2'}),
+            make_step(f'{prefix}HARVEST',
+                      ['HARVESTING:@standardValidation+@standardDQM'],
+                      [],
+                      ['DQMIO'],
+                      driver={'filetype': 'DQM'})]
+
+
+def make_relval(shape, steps, **kwargs):
+    """
+    Return a synthetic RelVal dictionary
+    """
+    relval = {'_id': f'{cmssw_release}__benchmark-{shape}-00001',
+              'prepid': f'{cmssw_release}__benchmark-{shape}-00001',
+              'batch_name': 'benchmark',
+              'campaign_timestamp': 1700000000,
+              'cmssw_release': cmssw_release,
+              'cpu_cores': 8,
+              'label': 'rsb',
+              'matrix': 'standard',
+              'memory': 16000,
+              'sample_tag': 'Run3',
+              'scram_arch': scram_arch,
+              'steps': steps,
+              'workflow_id': 12434.0,
+              'workflow_name': shape}
+    relval.update(kwargs)
+    return relval
+
+
+def get_synthetic_relvals():
+    """
+    Return a dictionary of synthetic RelVals of various shapes
+    """
+    long_steps = [make_gen_step()]
+    for index in range(4):
+        long_steps += make_digi_reco_steps(f'Step{index}', pileup=index % 2 == 1)
+
+    long_steps += [make_step('NANO',
+                             ['NANO'],
+                             ['NANOAODSIM'],
+                             ['NANOAODSIM'],
+                             driver={'customise_commands':
+                                         'process.Timing = cms.Service("Timing")'}),
+                   make_step('FINALHARVEST', ['HARVESTING:@nanoAODDQM'], [], ['DQMIO'])]
+    gpu = {'requires': 'required',
+           'gpu_memory': '8000',
+           'cuda_capabilities': ['7.5', '8.0'],
+           'cuda_runtime': '12.0',
+           'gpu_name': '',
+           'cuda_driver_version': '',
+           'cuda_runtime_version': ''}
+    return {
+        'gen_only': make_relval('gen_only', [make_gen_step()]),
+        'gen_fragment': make_relval('gen_fragment',
+                                    [make_gen_step()],
+                                    fragment='import FWCore.ParameterSet.Config as cms\n' * 50),
+        'gen_digi_reco': make_relval('gen_digi_reco',
+                                     [make_gen_step()] + make_digi_reco_steps('')),
+        'premix': make_relval('premix',
+                              [make_gen_step()] + make_digi_reco_steps('PU', pileup=True)),
+        'data_small_lumis': make_relval('data_small_lumis',
+                                        [make_input_step('RunJetMET2022C', 5, 3),
+                                         make_step('HLTDR3',
+                                                   ['L1REPACK:Full', 'HLT:@relval2024'],
+                                                   ['FEVTDEBUGHLT'],
+                                                   ['FEVTDEBUGHLT'],
+                                                   driver={'data': True, 'mc': False}),
+                                         make_step('RECODR3',
+                                                   ['RAW2DIGI', 'L1Reco', 'RECO', 'DQM'],
+                                                   ['RECO', 'DQM'],
+                                                   ['RECO', 'DQMIO'],
+                                                   driver={'data': True, 'mc': False}),
+                                         make_step('HARVESTDR3',
+                                                   ['HARVESTING:dqmHarvesting'],
+                                                   [],
+                                                   [],
+                                                   driver={'data': True,
+                                                           'mc': False,
+                                                           'filetype': 'DQM'})]),
+        'data_large_lumis': make_relval('data_large_lumis',
+                                        [make_input_step('RunJetMET2022C', 400, 25),
+                                         make_step('RECODR3',
+                                                   ['RAW2DIGI', 'L1Reco', 'RECO', 'DQM'],
+                                                   ['RECO', 'DQM'],
+                                                   ['RECO', 'DQMIO'],
+                                                   driver={'data': True, 'mc': False}),
+                                         make_step('HARVESTDR3',
+                                                   ['HARVESTING:dqmHarvesting'],
+                                                   [],
+                                                   [],
+                                                   driver={'data': True,
+                                                           'mc': False,
+                                                           'filetype': 'DQM'})]),
+        'alca': make_relval('alca',
+                            [make_input_step('RunZeroBias2022C', 20, 5),
+                             make_step('RECODR3',
+                                       ['RAW2DIGI', 'L1Reco', 'RECO'],
+                                       ['RECO'],
+                                       ['RECO'],
+                                       driver={'data': True, 'mc': False}),
+                             make_step('ALCARECO',
+                                       ['ALCA:SiStripCalZeroBias+TkAlMinBias'],
+                                       ['ALCARECO'],
+                                       ['ALCARECO'],
+                                       driver={'data': True, 'mc': False}),
+                             make_step('ALCAHARVEST',
+                                       ['ALCAHARVEST:SiStripQuality+TkAlMinBias'],
+                                       [],
+                                       [],
+                                       driver={'data': True, 'mc': False})]),
+        'gpu': make_relval('gpu',
+                           [make_gen_step()] + [dict(step, gpu=gpu)
+                                                for step in make_digi_reco_steps('GPU')],
+                           matrix='gpu'),
+        'long_15_steps': make_relval('long_15_steps', long_steps),
+    }
+
+
+def get_benchmarks(relval_json, controller):
+    """
+    Return a dictionary of benchmarked functions for given RelVal dictionary
+    Scripts are built directly, bypassing the rendered script cache
+    """
+    relval = RelVal(json_input=relval_json)
+    steps = relval.get('steps')
+    last_index = len(steps) - 1
+    return {
+        'RelVal()': lambda: RelVal(json_input=relval_json),
+        'RelVal(read_only)': lambda: RelVal(json_input=relval_json, read_only=True),
+        'get_cmsdrivers': relval.get_cmsdrivers,
+        'get_cmsdrivers(submission)': lambda: relval.get_cmsdrivers(True),
+        'get_config_upload_file': lambda: controller.build_config_upload_file(relval),
+        'get_job_dict': lambda: controller.get_job_dict(relval),
+        'get_request_string': relval.get_request_string,
+        'get_processing_string': lambda: relval.get_processing_string(last_index),
+    }
+
+
+def measure(function, number, repeat):
+    """
+    Return timing and allocation statistics of a function
+    """
+    times = timeit.Timer(function).repeat(repeat=repeat, number=number)
+    times = [t / number * 1e6 for t in times]
+    # Memory allocated by a single call: peak and still held after the call, e.g. the result
+    tracemalloc.start()
+    try:
+        result = function()
+        retained, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+
+    return {'min_us': round(min(times), 2),
+            'median_us': round(statistics.median(times), 2),
+            'peak_kib': round(peak / 1024, 2),
+            'retained_kib': round(retained / 1024, 2)}
+
+
+def run_benchmarks(name_filter, number, repeat):
+    """
+    Run all benchmarks that match the filter and return results by name
+    """
+    controller = RelValController()
+    results = {}
+    for shape, relval_json in get_synthetic_relvals().items():
+        for function_name, function in get_benchmarks(relval_json, controller).items():
+            name = f'{shape}:{function_name}'
+            if name_filter and name_filter not in name:
+                continue
+
+            results[name] = measure(function, number, repeat)
+            result = results[name]
+            print('%-50s %12.2f us %12.2f us %10.2f KiB %10.2f KiB' % (name,
+                                                                          result['min_us'],
+                                                                          result['median_us'],
+                                                                          result['peak_kib'],
+                                                                          result['retained_kib']))
+
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Print comparison of results and baseline, return names of regressed benchmarks
+    """
+    regressions = []
+    print()
+    print('%-50s %12s %12s %8s' % ('Benchmark', 'Baseline', 'Current', 'Ratio'))
+    for name, result in results.items():
+        if name not in baseline:
+            print('%-50s %12s %12.2f us %8s' % (name, '-', result['min_us'], 'new'))
+            continue
+
+        baseline_time = baseline[name]['min_us']
+        ratio = result['min_us'] / baseline_time if baseline_time else 1.0
+        mark = ''
+        if ratio > threshold:
+            regressions.append(name)
+            mark = ' REGRESSION'
+
+        print('%-50s %9.2f us %9.2f us %7.2fx%s' % (name,
+                                                   baseline_time,
+                                                   result['min_us'],
+                                                   ratio,
+                                                   mark))
+
+    return regressions
+
+
+def main():
+    """
+    Run benchmarks, save or compare them to the baseline
+    """
+    parser = argparse.ArgumentParser(description='Benchmark RelVal rendering')
+    parser.add_argument('--filter', default='', help='Run only benchmarks containing this string')
+    parser.add_argument('--number', type=int, default=20, help='Calls per repetition')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of repetitions')
+    parser.add_argument('--save-baseline', help='Save results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='Compare results to this JSON file, save them if it does not exist')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=1.25,
+                        help='Slowdown ratio that is reported as a regression')
+    args = parser.parse_args()
+    # Rendering functions log every call
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print('%-50s %15s %15s %14s %14s' % ('Benchmark', 'Min', 'Median', 'Peak', 'Retained'))
+    start_time = time.time()
+    results = run_benchmarks(args.filter, args.number, args.repeat)
+    print('Ran %s benchmarks in %.2fs' % (len(results), time.time() - start_time))
+    if args.baseline and not os.path.isfile(args.baseline):
+        print('Baseline %s does not exist, results will be saved to it' % (args.baseline))
+        args.save_baseline = args.baseline
+        args.baseline = None
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+        print('Baseline saved to %s' % (args.save_baseline))
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        if regressions:
+            print('%s benchmarks are more than %.2fx slower than baseline' % (len(regressions),
+                                                                             args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
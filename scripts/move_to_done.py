@@ -49,33 +49,42 @@ def get_database_credentials() -> dict[str, str | int]:
     return database_variables
 
 
-def move_to_done(host, client_credentials):
+def move_to_done(host, client_credentials, batch_size=50):
     """
     Try to move all submitted RelVals to next status
+    RelVals are sent in batches, so web application fetches their workflows
+    from Stats2 concurrently and saves them with a single bulk write
 
     Args:
         host (str): RelVal web application domain
         client_credentials (dict[str, str]): Credentials for requesting access tokens
             to authenticate request to the SSO
+        batch_size (int): Number of RelVals sent in a single request
     """
     connection = http.client.HTTPSConnection(host=host, timeout=300)
     headers = {'Content-Type': 'application/json'}
     relval_db = Database('relvals')
+    # Collect all prepids first, because moved RelVals disappear from the query
+    prepids = []
     relvals = [{}]
     page = 0
     while relvals:
         relvals = relval_db.query(query_string='status=submitted', page=page)
         page += 1
-        for relval in relvals:
-            print(relval['prepid'])
-            headers["Authorization"] = get_access_token(credentials=client_credentials)
-            connection.request('POST',
-                               '/relval/api/relvals/next_status',
-                               json.dumps(relval),
-                               headers=headers)
-            response = connection.getresponse()
-            response_text = json.loads(response.read())['message']
-            print('  %s %s' % (response.code, response_text))
+        prepids.extend(relval['prepid'] for relval in relvals)
+
+    print('%s submitted RelVals' % (len(prepids)))
+    for start in range(0, len(prepids), batch_size):
+        batch = prepids[start:start + batch_size]
+        print(', '.join(batch))
+        headers["Authorization"] = get_access_token(credentials=client_credentials)
+        connection.request('POST',
+                           '/relval/api/relvals/next_status',
+                           json.dumps([{'prepid': prepid} for prepid in batch]),
+                           headers=headers)
+        response = connection.getresponse()
+        response_text = json.loads(response.read())['message']
+        print('  %s %s' % (response.code, response_text))
 
 
 def main():